@@ -111,12 +111,15 @@ def globOrder(order, h5):
             sockMap[sSpec[0]] = [sSpec[1]]
         else:
             ids = []
-            for f in glob.iglob(sSpec[1]):
-                dc = f2dc(f)
-                if h5 != None:
-                    PyTablesPersister.saveResult(dc, h5)
-                km.registerDataContainer(dc)
-                ids.append(dc.id)
+
+            def dcs(pattern):
+                for f in glob.iglob(pattern):
+                    dc = f2dc(f)
+                    if h5 != None:
+                        PyTablesPersister.saveResult(dc, h5)
+                    ids.append(dc.id)
+                    yield dc
+            km.registerDataContainers(dcs(sSpec[1]))
             sockMap[sSpec[0]] = ids
     return (sockMap, order[1])
 
@@ -0,0 +1,769 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2006-2014, Rectorate of the University of Freiburg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the Freiburg Materials Research Center,
+#   University of Freiburg nor the names of its contributors may be used to
+#   endorse or promote products derived from this software without specific
+#   prior written permission.
+#
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+This module provides the DCCache class
+
+which is used by the KnowledgeManager to keep recently requested
+DataContainers in memory. The cache is bounded by the total number of
+raw data bytes and by the number of cached items. Which item is evicted
+when the cache runs full is decided by an exchangeable eviction policy.
+Items evicted from memory or too large for it may be kept by a
+SpillCache, which stores the arrays of the DataContainers as .npy
+files and maps them back into memory upon access.
+The SingleFlight class makes sure that concurrent requests for the same
+DataContainer trigger a single load only, while the LoaderPool class
+loads DataContainers in the background and returns Future instances.
+"""
+
+from __future__ import with_statement
+from collections import OrderedDict
+import cPickle
+import heapq
+import itertools
+import os
+import shutil
+import sys
+import threading
+from types import (ListType, TupleType)
+import numpy
+
+# Arrays smaller than this are pickled along with the DataContainer by
+# SpillCache instead of being stored as separate .npy files:
+SPILL_MIN_ARRAY_BYTES = 4096
+
+
+def rawDataBytes(dc):
+    """
+    Returns the number of raw data bytes of the given DataContainer.
+    SampleContainer.rawDataBytes returns a (nested) list, which is
+    summed up here.
+    """
+    size = dc.rawDataBytes
+    if isinstance(size, (ListType, TupleType)):
+        return sum([rawDataBytes(column) for column in dc.columns])
+    return size
+
+
+class EvictionPolicy(object):
+    """
+    Base class for eviction policies of a DCCache.
+    A policy keeps track of the cached keys and decides which key has
+    to be removed next if the cache runs full.
+    """
+    name = None
+
+    def insert(self, key, size):
+        """
+        Is called when a new key has been added to the cache.
+        """
+        raise NotImplementedError
+
+    def access(self, key):
+        """
+        Is called upon each cache hit on key.
+        """
+        raise NotImplementedError
+
+    def remove(self, key):
+        """
+        Is called when key has been removed from the cache explicitly.
+        """
+        raise NotImplementedError
+
+    def pop(self):
+        """
+        Returns the key that should be evicted next and forgets about it.
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """
+        Forgets about all keys.
+        """
+        raise NotImplementedError
+
+    def keys(self):
+        """
+        Returns the tracked keys in the order in which they would be
+        evicted, i.e. starting with the key pop() would return.
+        """
+        raise NotImplementedError
+
+
+class LRUPolicy(EvictionPolicy):
+    """
+    Evicts the least recently used item first. All operations are O(1).
+    """
+    name = 'lru'
+
+    def __init__(self):
+        self._order = OrderedDict()
+
+    def insert(self, key, size):
+        self._order[key] = None
+
+    def access(self, key):
+        del self._order[key]
+        self._order[key] = None
+
+    def remove(self, key):
+        del self._order[key]
+
+    def pop(self):
+        key = iter(self._order).next()
+        del self._order[key]
+        return key
+
+    def clear(self):
+        self._order.clear()
+
+    def keys(self):
+        return self._order.keys()
+
+
+class GDSFPolicy(EvictionPolicy):
+    """
+    Greedy-Dual-Size-Frequency policy: Each item is rated by
+    L + frequency / size, where L is the rating of the item that has
+    been evicted last. Small and frequently requested items are thus
+    kept in favour of large ones, while the inflation value L ages
+    items that have not been requested for a long time.
+    Operations are O(log n).
+    """
+    name = 'gdsf'
+
+    def __init__(self):
+        self.clear()
+
+    def _push(self, key):
+        size, frequency = self._meta[key]
+        entry = [self._inflation + float(frequency) / size,
+                 self._counter, key]
+        self._counter += 1
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+
+    def _invalidate(self, key):
+        # Entries are invalidated lazily, since removing them from the
+        # heap would be O(n).
+        self._entries.pop(key)[2] = None
+
+    def insert(self, key, size):
+        self._meta[key] = (max(size, 1), 1)
+        self._push(key)
+
+    def access(self, key):
+        size, frequency = self._meta[key]
+        self._meta[key] = (size, frequency + 1)
+        self._invalidate(key)
+        self._push(key)
+
+    def remove(self, key):
+        self._invalidate(key)
+        del self._meta[key]
+
+    def pop(self):
+        while True:
+            priority, counter, key = heapq.heappop(self._heap)
+            if key is not None:
+                break
+        self._inflation = priority
+        del self._entries[key]
+        del self._meta[key]
+        return key
+
+    def clear(self):
+        self._heap = []
+        self._entries = {}
+        self._meta = {}
+        self._inflation = 0.0
+        self._counter = 0
+
+    def keys(self):
+        return [entry[2] for entry in sorted(self._entries.itervalues())]
+
+
+POLICIES = dict([(policy.name, policy) for policy in [LRUPolicy,
+                                                      GDSFPolicy]])
+
+
+def getPolicy(policy):
+    """
+    Returns an EvictionPolicy instance.
+    policy -- EvictionPolicy instance or name of a registered policy
+              ('lru' or 'gdsf')
+    """
+    if isinstance(policy, EvictionPolicy):
+        return policy
+    try:
+        return POLICIES[policy]()
+    except KeyError:
+        raise ValueError("Unknown eviction policy '%s'." % (policy, ))
+
+
+class DCCache(object):
+    """
+    Hash indexed cache for DataContainers, bounded by the total size of
+    the cached items and by their number.
+    Usage:
+        cache = DCCache(max_size=256 * 1024 * 1024, max_number=100)
+        cache.put(dc.id, dc, rawDataBytes(dc))
+        dc = cache.get(dc_id)  # None if dc_id is not cached
+    The limits and the eviction policy may be changed at runtime by
+    setting the attributes max_size, max_number and policy.
+    Hits, misses, evictions and rejections (items too large to be cached
+    at all) are counted, see get_stats(). All methods are thread-safe.
+    Evicted and rejected items are passed to the second tier given as
+    spill, if any, and are moved back to memory upon a hit there.
+    """
+    def __init__(self, max_size, max_number, policy='lru', spill=None):
+        """
+        Arguments:
+        - max_size: maximum sum of item sizes in bytes
+        - max_number: maximum number of items
+        - policy: EvictionPolicy instance or name of a registered
+                  policy, see POLICIES
+        - spill: SpillCache instance or None
+        """
+        self._lock = threading.RLock()
+        self._items = {}
+        self._policy = getPolicy(policy)
+        self._max_size = max_size
+        self._max_number = max_number
+        self.spill = spill
+        self.size = 0
+        self.reset_stats()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._items:
+                return True
+        return self.spill is not None and key in self.spill
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.rejections = 0
+
+    def get_stats(self):
+        """
+        Returns a dictionary with the counters and the current
+        utilization of the cache.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'rejections': self.rejections,
+                    'size': self.size, 'number': len(self._items),
+                    'max_size': self._max_size,
+                    'max_number': self._max_number,
+                    'policy': self._policy.name}
+
+    def get(self, key, default=None):
+        """
+        Returns the item cached for key or default on a cache miss.
+        """
+        with self._lock:
+            try:
+                value, size = self._items[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._policy.access(key)
+                return value
+        if self.spill is None:
+            return default
+        item = self.spill.get(key)
+        if item is None:
+            return default
+        value, size = item
+        self.put(key, value, size)
+        return value
+
+    def put(self, key, value, size):
+        """
+        Adds value to the cache, evicting other items if necessary.
+        Returns whether the value has been cached in memory.
+        """
+        with self._lock:
+            if key in self._items:
+                self._policy.access(key)
+                return True
+            cached = size <= self._max_size and self._max_number >= 1
+            if cached:
+                evicted = self._shrink(self._max_size - size,
+                                       self._max_number - 1)
+                self._items[key] = (value, size)
+                self.size += size
+                self._policy.insert(key, size)
+            else:
+                self.rejections += 1
+                evicted = [(key, value, size)]
+        self._spill(evicted)
+        return cached
+
+    def _spill(self, evicted):
+        # called without holding the lock, since this writes files
+        if self.spill is not None:
+            for key, value, size in evicted:
+                self.spill.put(key, value, size)
+
+    def remove(self, key):
+        """
+        Removes key from the cache, if present.
+        """
+        with self._lock:
+            try:
+                value, size = self._items.pop(key)
+            except KeyError:
+                pass
+            else:
+                self.size -= size
+                self._policy.remove(key)
+        if self.spill is not None:
+            self.spill.remove(key)
+
+    def clear(self):
+        """
+        Removes all items from the cache, including the second tier.
+        Counters are not reset.
+        """
+        with self._lock:
+            self._items.clear()
+            self._policy.clear()
+            self.size = 0
+        if self.spill is not None:
+            self.spill.clear()
+
+    def _shrink(self, max_size, max_number):
+        evicted = []
+        while self.size > max_size or len(self._items) > max_number:
+            key = self._policy.pop()
+            value, size = self._items.pop(key)
+            self.size -= size
+            self.evictions += 1
+            evicted.append((key, value, size))
+        return evicted
+
+    def _set_max_size(self, max_size):
+        with self._lock:
+            self._max_size = max_size
+            evicted = self._shrink(self._max_size, self._max_number)
+        self._spill(evicted)
+    max_size = property(lambda self: self._max_size, _set_max_size)
+
+    def _set_max_number(self, max_number):
+        with self._lock:
+            self._max_number = max_number
+            evicted = self._shrink(self._max_size, self._max_number)
+        self._spill(evicted)
+    max_number = property(lambda self: self._max_number, _set_max_number)
+
+    def _set_policy(self, policy):
+        policy = getPolicy(policy)
+        with self._lock:
+            # keys are inserted starting with the next one to be evicted,
+            # such that the new policy starts from the same recency order
+            for key in self._policy.keys():
+                policy.insert(key, self._items[key][1])
+            self._policy = policy
+    policy = property(lambda self: self._policy, _set_policy)
+
+
+class SpillCache(object):
+    """
+    Second tier of a DCCache, which keeps items on disk. The arrays of
+    a DataContainer are written to .npy files, whereas the remainder is
+    pickled. Upon a hit the arrays are mapped into memory by
+    numpy.load(mmap_mode='r'), such that only the parts that are
+    accessed are read. Since sealed DataContainers are immutable, the
+    files never have to be invalidated. The cache is bounded by the
+    total size of its files and evicts the least recently used item
+    first. Hits, misses, evictions and rejections are counted, see
+    get_stats(). All methods are thread-safe.
+    Usage:
+        cache = DCCache(max_size, max_number,
+                        spill=SpillCache(directory, max_size))
+    """
+    def __init__(self, directory, max_size,
+                 min_array_bytes=SPILL_MIN_ARRAY_BYTES):
+        """
+        Arguments:
+        - directory: directory for the files, which is created upon
+          the first put(). Each instance uses a subdirectory of its
+          own, which is removed by clear().
+        - max_size: maximum total size of the files in bytes, 0
+          disables the cache
+        - min_array_bytes: arrays smaller than this are pickled
+        """
+        self.directory = directory
+        self.min_array_bytes = min_array_bytes
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._max_size = max_size
+        self._root = None
+        self._counter = itertools.count()
+        self.size = 0
+        self.reset_stats()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.rejections = 0
+
+    def get_stats(self):
+        """
+        Returns a dictionary with the counters and the current
+        utilization of the cache.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'rejections': self.rejections,
+                    'size': self.size, 'number': len(self._entries),
+                    'max_size': self._max_size}
+
+    def _newPath(self):
+        with self._lock:
+            if self._root is None or not os.path.isdir(self._root):
+                from tempfile import mkdtemp
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                self._root = mkdtemp(prefix='spill-', dir=self.directory)
+            return os.path.join(self._root, str(self._counter.next()))
+
+    def _write(self, path, value):
+        os.mkdir(path)
+        names = []
+
+        def persistent_id(obj):
+            if isinstance(obj, numpy.ndarray) and not obj.dtype.hasobject \
+                   and obj.nbytes >= self.min_array_bytes:
+                name = "array_%d.npy" % len(names)
+                numpy.save(os.path.join(path, name), obj)
+                names.append(name)
+                return name
+            return None
+        handle = open(os.path.join(path, 'item.pickle'), 'wb')
+        try:
+            pickler = cPickle.Pickler(handle, 2)
+            pickler.persistent_id = persistent_id
+            pickler.dump(value)
+        finally:
+            handle.close()
+        return sum([os.path.getsize(os.path.join(path, name)) \
+                        for name in names + ['item.pickle']])
+
+    def _read(self, path):
+        handle = open(os.path.join(path, 'item.pickle'), 'rb')
+        try:
+            unpickler = cPickle.Unpickler(handle)
+            unpickler.persistent_load = lambda name: numpy.load(
+                os.path.join(path, name), mmap_mode='r')
+            return unpickler.load()
+        finally:
+            handle.close()
+
+    def put(self, key, value, size):
+        """
+        Writes value to disk, evicting other items if necessary.
+        size is the size of value in memory, which is returned along
+        with value by get(). Returns whether the value has been cached.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = self._entries.pop(key)
+                return True
+            # size approximates the size of the files, rejecting large
+            # values here avoids writing them in vain upon each miss
+            if self._max_size <= 0 or size > self._max_size:
+                self.rejections += 1
+                return False
+        path = None
+        try:
+            path = self._newPath()
+            nbytes = self._write(path, value)
+        except (IOError, OSError, cPickle.PicklingError, TypeError):
+            nbytes = None
+        with self._lock:
+            cached = key in self._entries
+            if cached:
+                # written by a concurrent put() in the meantime
+                evicted = [path]
+            elif nbytes is None or nbytes > self._max_size:
+                self.rejections += 1
+                evicted = [path]
+            else:
+                evicted = self._shrink(self._max_size - nbytes)
+                self._entries[key] = (path, nbytes, size)
+                self.size += nbytes
+                cached = True
+        self._delete(evicted)
+        return cached
+
+    def get(self, key):
+        """
+        Returns a tuple (value, size) or None on a cache miss.
+        """
+        with self._lock:
+            try:
+                path, nbytes, size = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries[key] = (path, nbytes, size)
+        try:
+            value = self._read(path)
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+            # evicted by a concurrent put()
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value, size
+
+    def remove(self, key):
+        """
+        Removes key from the cache, if present.
+        """
+        with self._lock:
+            try:
+                path, nbytes, size = self._entries.pop(key)
+            except KeyError:
+                return
+            self.size -= nbytes
+        self._delete([path])
+
+    def clear(self):
+        """
+        Removes all items and the files of this instance.
+        Counters are not reset.
+        """
+        with self._lock:
+            root = self._root
+            self._entries.clear()
+            self._root = None
+            self.size = 0
+        self._delete([root])
+
+    def _shrink(self, max_size):
+        evicted = []
+        while self.size > max_size and self._entries:
+            path, nbytes, size = self._entries.popitem(last=False)[1]
+            self.size -= nbytes
+            self.evictions += 1
+            evicted.append(path)
+        return evicted
+
+    def _delete(self, paths):
+        # Arrays mapped into memory stay valid after their files have
+        # been deleted, except on Windows, where deleting fails.
+        for path in paths:
+            if path is not None:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _set_max_size(self, max_size):
+        with self._lock:
+            self._max_size = max_size
+            evicted = self._shrink(self._max_size)
+        self._delete(evicted)
+    max_size = property(lambda self: self._max_size, _set_max_size)
+
+
+class _Flight(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """
+    Suppresses duplicate concurrent calls: If several threads call do()
+    with the same key at the same time, the function is executed by the
+    first thread only, while the other threads wait for its result.
+    Usage:
+        flights = SingleFlight()
+        dc = flights.do(dc_id, loadFunction, dc_id)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        Returns function(*args, **kwargs) or the result of the call
+        with the same key that is in progress already. Exceptions are
+        raised in all waiting threads.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+        if leader:
+            try:
+                flight.result = function(*args, **kwargs)
+            except:
+                flight.exc_info = sys.exc_info()
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+        else:
+            flight.event.wait()
+        if flight.exc_info is not None:
+            raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+        return flight.result
+
+    def __len__(self):
+        return len(self._flights)
+
+
+class Future(object):
+    """
+    Result of a call submitted to a LoaderPool. Resembles the Future
+    class of the concurrent.futures module, which is not available
+    for all supported versions of Python.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def _set(self, result=None, exc_info=None):
+        self._result = result
+        self._exc_info = exc_info
+        self._event.set()
+
+    def done(self):
+        """
+        Returns whether the call has finished.
+        """
+        return self._event.isSet()
+
+    def _wait(self, timeout):
+        self._event.wait(timeout)
+        if not self._event.isSet():
+            raise RuntimeError("Timeout waiting for the result.")
+
+    def result(self, timeout=None):
+        """
+        Waits for the call to finish and returns its result or raises
+        its exception. RuntimeError is raised if the call has not
+        finished after timeout seconds.
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Waits for the call to finish and returns the exception raised
+        by it or None.
+        """
+        self._wait(timeout)
+        if self._exc_info is None:
+            return None
+        return self._exc_info[1]
+
+
+class LoaderPool(object):
+    """
+    Executes calls on a bounded number of daemon threads, which are
+    started on demand. Used by the KnowledgeManager in order to load
+    DataContainers in the background.
+    Usage:
+        pool = LoaderPool(4)
+        future = pool.submit(loadFunction, dc_id)
+        dc = future.result()
+    """
+    def __init__(self, max_threads):
+        from Queue import Queue
+        self.max_threads = max_threads
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._idle = 0
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Schedules function(*args, **kwargs) and returns a Future.
+        """
+        future = Future()
+        with self._lock:
+            self._queue.put((future, function, args, kwargs))
+            if self._queue.qsize() > self._idle \
+                   and len(self._threads) < self.max_threads:
+                thread = threading.Thread(target=self._work,
+                                          name="LoaderPool-%d" \
+                                              % len(self._threads))
+                thread.setDaemon(True)
+                self._threads.append(thread)
+                thread.start()
+        return future
+
+    def _work(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+            future, function, args, kwargs = self._queue.get()
+            with self._lock:
+                self._idle -= 1
+            try:
+                future._set(function(*args, **kwargs))
+            except:
+                future._set(exc_info=sys.exc_info())
+            # drop references to the result before waiting
+            future = function = args = kwargs = None
+
+    def __len__(self):
+        return len(self._threads)
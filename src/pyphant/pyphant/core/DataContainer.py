@@ -81,6 +81,71 @@ _logger = logging.getLogger("pyphant")
 #Default string encoding
 enc = lambda s: unicode(s, "utf-8")
 
+#Format of the hashes generated by seal(), see hashArray():
+#1 -- MD5 of the pickled arrays, 32 hex digits (former versions)
+#2 -- MD5 of the raw array buffers, prefixed by 'v2_'
+HASH_VERSION = 2
+#Arrays larger than this are hashed as the MD5 of the MD5 digests of
+#their chunks of this size (hash format 2):
+HASH_CHUNK_BYTES = 16 * 1024 * 1024
+#Maximum number of threads hashing the chunks of a large array:
+HASH_THREADS = 4
+
+
+def formatHash(hexdigest, version=HASH_VERSION):
+    u"""Returns the .hash attribute for the given MD5 hex digest."""
+    if version == 1:
+        return enc(hexdigest)
+    return u"v%d_%s" % (version, hexdigest)
+
+
+def hashVersion(hash):
+    u"""Returns the format version of the given .hash attribute."""
+    if hash.startswith(u"v"):
+        return int(hash[1:hash.index(u"_")])
+    return 1
+
+
+def _chunkDigests(raw):
+    chunks = [raw[start:start + HASH_CHUNK_BYTES] \
+                  for start in xrange(0, raw.nbytes, HASH_CHUNK_BYTES)]
+    digests = [None] * len(chunks)
+
+    def work(first, step):
+        for index in xrange(first, len(chunks), step):
+            digests[index] = hashlib.md5(chunks[index]).digest()
+    try:
+        import multiprocessing
+        cpus = multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        cpus = 1
+    step = max(1, min(HASH_THREADS, cpus, len(chunks)))
+    # hashlib releases the GIL while digesting large buffers
+    threads = [threading.Thread(target=work, args=(first, step)) \
+                   for first in xrange(1, step)]
+    for thread in threads:
+        thread.start()
+    work(0, step)
+    for thread in threads:
+        thread.join()
+    return ''.join(digests)
+
+
+def hashArray(m, array, version=HASH_VERSION):
+    u"""Updates the hash object m with the content of the given array.
+    Format 2 reads the buffer of C contiguous arrays without copying
+    it, object arrays are pickled as in format 1."""
+    if version == 1 or array.dtype.hasobject:
+        m.update(array.dumps())
+        return
+    m.update(array.dtype.str)
+    m.update(str(array.shape))
+    raw = numpy.ascontiguousarray(array).reshape(-1).view(numpy.uint8)
+    if raw.nbytes <= HASH_CHUNK_BYTES:
+        m.update(raw)
+    else:
+        m.update(_chunkDigests(raw))
+
 
 def parseId(id):
     u"""Returns tuple (HASH, TYPESTRING) from given .id attribute."""
@@ -156,7 +221,7 @@ class DataContainer(object):
                 "be modified anymore.")
         self.lock.release()
 
-    def generateHash(self, m=None):
+    def generateHash(self, m=None, version=HASH_VERSION):
         if m == None:
             m = hashlib.md5()
         m.update(self.longname)
@@ -164,7 +229,13 @@ class DataContainer(object):
         m.update(self.machine)
         m.update(self.creator)
         m.update(str(self.attributes))
-        return enc(m.hexdigest())
+        return formatHash(m.hexdigest(), version)
+
+    def verifyHash(self):
+        u"""Returns whether the .hash attribute of the sealed container
+        matches its content. Containers sealed by former versions are
+        verified using the hash format they have been sealed with."""
+        return self.hash == self.generateHash(version=hashVersion(self.hash))
 
     def seal(self, id=None):
         with self.lock:
@@ -238,12 +309,12 @@ class SampleContainer(DataContainer):
         return [column.rawDataBytes for column in self.columns]
     rawDataBytes = property(_getRawDataBytes)
 
-    def generateHash(self, m=None):
+    def generateHash(self, m=None, version=HASH_VERSION):
         if m == None:
             m = hashlib.md5()
-        super(SampleContainer, self).generateHash(m)
+        super(SampleContainer, self).generateHash(m, version)
         m.update(u''.join([c.hash for c in self.columns]))
-        return enc(m.hexdigest())
+        return formatHash(m.hexdigest(), version)
 
     def __deepcopy__(self, memo):
         self.lock.acquire()
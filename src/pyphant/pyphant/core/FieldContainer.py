@@ -59,7 +59,8 @@ import copy
 import hashlib
 import numpy
 from pyphant.quantities import (isQuantity, Quantity, _prefixes)
-from pyphant.core.DataContainer import DataContainer, enc, _logger
+from pyphant.core.DataContainer import (DataContainer, _logger,
+                                        HASH_VERSION, formatHash, hashArray)
 from types import NoneType
 
 #Default variables of indices
@@ -312,21 +313,18 @@ Concerning the ordering of data matrices and the dimension list consult http://w
         self.lock.release()
         return res
 
-    def generateHash(self, m=None):
+    def generateHash(self, m=None, version=HASH_VERSION):
         if m == None:
             m = hashlib.md5()
-        super(FieldContainer, self).generateHash(m)
-        #m.update(str(self.data.tolist()))
-        m.update(self.data.dumps())
+        super(FieldContainer, self).generateHash(m, version)
+        hashArray(m, self.data, version)
         m.update(str(self.unit))
         if self.error != None:
-            #m.update(str(self.error.tolist()))
-            m.update(self.error.dumps())
+            hashArray(m, self.error, version)
         if self.mask != None:
-            #m.update(str(self.mask.tolist()))
-            m.update(self.mask.dumps())
+            hashArray(m, self.mask, version)
         [m.update(dim.hash) for dim in self._dimensions]
-        return enc(m.hexdigest())
+        return formatHash(m.hexdigest(), version)
 
     def seal(self, id=None):
         with self.lock:
@@ -413,7 +411,7 @@ Concerning the ordering of data matrices and the dimension list consult http://w
         self.unit = newUnit / unitAmplitude
 
     def __eq__(self, other, rtol=1e-5, atol=1e-8):
-        if type(self) != type(other):
+        if not isinstance(other, FieldContainer):
             if type(other) != IndexMarker and type(other) != NoneType:
                 _logger.debug(
                     'Cannot compare objects '
@@ -705,11 +703,27 @@ Concerning the ordering of data matrices and the dimension list consult http://w
     def __repr__(self):
         return self.__str__()
 
+    def _getDataShape(self):
+        return self.data.shape
+
+    def _sliceArrays(self, args):
+        """
+        Returns a tuple (data, error, mask) of the arrays indexed by the
+        list of index arguments args. error and mask may be None.
+        """
+        data = self.data[args]
+        error = mask = None
+        if self.error != None:
+            error = self.error[args]
+        if self.mask != None:
+            mask = self.mask[args]
+        return data, error, mask
+
     def __getitem__(self, args):
         if isinstance(args, type("")):
             args = [args]
         if isinstance(args, type(1)):
-            if args >= len(self.data):
+            if args >= self._getDataShape()[0]:
                 raise IndexError('index out of bound')
         try:
             len(args)
@@ -720,7 +734,7 @@ Concerning the ordering of data matrices and the dimension list consult http://w
                 arg, self._dimensions[dim]
                 ) for dim, arg in enumerate(args)
             ]
-        data = self.data[args]
+        data, slicedError, slicedMask = self._sliceArrays(args)
         attributes = copy.deepcopy(self.attributes)
         mask = None
         error = None
@@ -740,15 +754,13 @@ Concerning the ordering of data matrices and the dimension list consult http://w
             dimensions.append(copy.deepcopy(self._dimensions[i]))
         if data.shape != (1,):
             data = data.squeeze()
-            if self.mask != None:
-                mask = self.mask[args].squeeze()
-            if self.error != None:
-                error = self.error[args].squeeze()
+            if slicedMask != None:
+                mask = slicedMask.squeeze()
+            if slicedError != None:
+                error = slicedError.squeeze()
         else:
-            if self.mask != None:
-                mask = self.mask[args]
-            if self.error != None:
-                error = self.error[args]
+            mask = slicedMask
+            error = slicedError
         field = FieldContainer(data, dimensions=dimensions,
                                longname=self.longname,
                                shortname=self.shortname,
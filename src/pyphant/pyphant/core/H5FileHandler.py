@@ -33,6 +33,7 @@
 """
 This module provides the H5FileHandler class.
 """
+from __future__ import with_statement
 import tables
 from pyphant.core import DataContainer
 from pyphant.quantities import Quantity
@@ -42,6 +43,8 @@ import os
 from pyphant.core import PyTablesPersister
 from pyphant.core.DataContainer import IndexMarker
 from pyphant.core.Helpers import (utf82uc, emd52dict)
+from pyphant.core.SQLiteWrapper import repr2attr
+from ast import literal_eval
 _logger = logging.getLogger("pyphant")
 
 im = IndexMarker()
@@ -57,6 +60,10 @@ im_summary = {'id': im_id, 'longname': utf82uc(im.longname),
 class H5FileHandler(object):
     """
     This class is used to handle IO operations on HDF5 files.
+    The file is opened for the duration of a with-block, during which
+    the calling thread holds PyTablesPersister.h5Lock. Files opened
+    read only use the handle kept open by PyTablesPersister.handlePool,
+    whereas a pooled handle is closed before the file is written.
     """
     def __init__(self, filename, mode='a'):
         """
@@ -74,20 +81,44 @@ class H5FileHandler(object):
         self.filename = filename
         self.mode = mode
         if mode == 'w':
-            tmphandle = tables.openFile(self.filename, 'w')
-            tmphandle.close()
+            with PyTablesPersister.h5Lock:
+                tmphandle = self._openWritable('w')
+                tmphandle.close()
             self.mode = 'a'
         self.handle = None
 
     def __enter__(self):
         assert self.handle is None
-        self.handle = tables.openFile(self.filename, self.mode)
+        PyTablesPersister.h5Lock.acquire()
+        try:
+            if self.mode == 'r':
+                self.handle = PyTablesPersister.handlePool.get(self.filename)
+            else:
+                self.handle = self._openWritable(self.mode)
+        except:
+            PyTablesPersister.h5Lock.release()
+            raise
         return self
 
+    def _openWritable(self, mode):
+        pool = PyTablesPersister.handlePool
+        pool.invalidate(self.filename)
+        try:
+            return tables.openFile(self.filename, mode)
+        except ValueError:
+            # The file is still open read only, e.g. as the target of
+            # an external link of another pooled file.
+            pool.clear()
+            return tables.openFile(self.filename, mode)
+
     def __exit__(self, type, value, traceback):
         if self.handle is not None:
-            self.handle.close()
-            self.handle = None
+            try:
+                if self.mode != 'r':
+                    self.handle.close()
+            finally:
+                self.handle = None
+                PyTablesPersister.h5Lock.release()
 
     def getNodeAndTypeFromId(self, dcId):
         """
@@ -118,38 +149,63 @@ class H5FileHandler(object):
                 return True
         return False
 
-    def loadDataContainer(self, dcId):
+    def loadDataContainer(self, dcId, lazy=False, fields=None):
         """
         Loads a DataContainer from the HDF5 file and returns it as a
         DataContainer instance.
         dcId -- emd5 of the DC to be returned
+        lazy -- whether to defer reading the arrays of FieldContainers
+                until they are accessed, see
+                PyTablesPersister.LazyFieldContainer
+        fields -- identity map of loaded FieldContainers, whose
+                  dimensions are reused, see PyTablesPersister.loadField
         """
         resNode, uriType = self.getNodeAndTypeFromId(dcId)
         if uriType == 'field':
-            result = self.loadField(resNode)
+            result = self.loadField(resNode, lazy, fields)
         elif uriType == 'sample':
-            result = self.loadSample(resNode)
+            result = self.loadSample(resNode, lazy, fields)
         else:
             raise TypeError(
                 "Unknown result uriType in <%s>" % (resNode._v_title, )
                 )
         return result
 
-    def loadField(self, resNode):
+    def loadFieldSlice(self, dcId, args):
+        """
+        Reads the given part of a FieldContainer from the HDF5 file and
+        returns it as a FieldContainer with correspondingly sliced
+        dimensions. Only the requested hyperslab of the arrays is read.
+        dcId -- emd5 of the FieldContainer
+        args -- index arguments as for FieldContainer.__getitem__(), i.e.
+                an int, a slice or a string of the form '1mm:3mm'
+                denoting a physical range of the according dimension,
+                or a tuple of these for several dimensions.
+        """
+        resNode, uriType = self.getNodeAndTypeFromId(dcId)
+        if uriType != 'field':
+            raise TypeError("%s does not denote a FieldContainer." % dcId)
+        return self.loadField(resNode, lazy=True)[args]
+
+    def loadField(self, resNode, lazy=False, fields=None):
         """
         Loads a FieldContainer from the given node and returns it as an
         instance. This method is intended for internal use only.
         resNode -- node at which the FieldContainer is located in the file.
+        lazy, fields -- see loadDataContainer()
         """
-        return PyTablesPersister.loadField(self.handle, resNode)
+        return PyTablesPersister.loadField(self.handle, resNode, lazy,
+                                           fields)
 
-    def loadSample(self, resNode):
+    def loadSample(self, resNode, lazy=False, fields=None):
         """
         Loads a SampleContainer from the given node and returns it as an
         instance. This method is intended for internal use only.
         resNode -- node at which the SampleContainer is located in the file.
+        lazy, fields -- see loadDataContainer()
         """
-        return PyTablesPersister.loadSample(self.handle, resNode)
+        return PyTablesPersister.loadSample(self.handle, resNode, lazy,
+                                            fields)
 
     def loadSummary(self, dcId=None):
         """
@@ -159,8 +215,13 @@ class H5FileHandler(object):
                 IndexMarker object, u'IndexMarker' is returned.
                 If dcId == None, a dictionary that maps emd5s to summaries
                 is returned, where IndexMarker objects are ignored.
+                It is read from the table /summary, which is maintained
+                by saveDataContainer() and saveRecipe(), if possible.
         """
         if dcId is None:
+            summary = self._readSummaryTable()
+            if summary is not None:
+                return summary
             summary = {}
             for group in self.handle.walkGroups(where="/results"):
                 currDcId = group._v_attrs.TITLE
@@ -193,10 +254,9 @@ class H5FileHandler(object):
                 pass  # machine, creator set by emd52dict(dcId) before
             attributes = {}
             if uriType == 'field':
-                for key in resNode.data._v_attrs._v_attrnamesuser:
-                    attributes[key] = self.handle.getNodeAttr(
-                        resNode.data, key
-                        )
+                dataNode = PyTablesPersister.getArrayNode(resNode, 'data')
+                for key in dataNode._v_attrs._v_attrnamesuser:
+                    attributes[key] = dataNode._v_attrs[key]
                 unit = eval(utf82uc(self.handle.getNodeAttr(resNode, "unit")))
                 summary['unit'] = unit
                 dimTable = resNode.dimensions
@@ -222,10 +282,166 @@ class H5FileHandler(object):
             summary['attributes'] = attributes
         return summary
 
+    def _getResultNames(self):
+        try:
+            return set(self.handle.getNode("/results")._v_groups.keys())
+        except tables.NoSuchNodeError:
+            return set()
+
+    def _readSummaryTable(self):
+        """
+        Returns the summaries of all DCs as loadSummary() does, read from
+        the table /summary in one pass, or None if the file has no such
+        table, the table cannot be read or it does not cover exactly the
+        groups of /results, e.g. since the file has been changed by a
+        former version of pyphant. See _getSummaryRecord() for the format.
+        """
+        try:
+            table = self.handle.getNode("/summary")
+        except tables.NoSuchNodeError:
+            return None
+        if not isinstance(table, tables.VLArray) \
+               or not isinstance(table.atom, tables.VLStringAtom):
+            # pickled summaries written by former versions are not read
+            return None
+        summary = {}
+        resNames = set()
+        try:
+            for record in table:
+                resName, dcId, fields = literal_eval(record)
+                resNames.add(resName)
+                if fields is None:
+                    summary[im_id] = im_summary
+                elif fields == 'walk':
+                    summary[dcId] = self.loadSummary(dcId)
+                else:
+                    summary[dcId] = self._summaryFromFields(dcId, fields)
+        except Exception:
+            _logger.warn("Could not read the summary table of '%s'."
+                         % (self.filename, ))
+            return None
+        if resNames != self._getResultNames():
+            return None
+        return summary
+
+    def _summaryFromFields(self, dcId, fields):
+        """
+        Returns the summary of the DC given by dcId from the fields of
+        its record in the table /summary, see _getSummaryRecord().
+        """
+        longname, shortname, machine, creator, unit, refs, attrs = fields
+        summary = {'id': dcId, 'longname': longname, 'shortname': shortname}
+        summary.update(emd52dict(dcId))
+        summary['machine'] = machine
+        summary['creator'] = creator
+        if summary['type'] == u'field':
+            summary['unit'] = repr2attr(unit)
+            summary['dimensions'] = list(refs)
+        else:
+            summary['columns'] = list(refs)
+        summary['attributes'] = dict([(key, repr2attr(value)) \
+                                          for key, value in attrs])
+        return summary
+
+    def _getSummaryRecord(self, resName):
+        """
+        Returns the row of the table /summary for the given result group,
+        i.e. the repr of a tuple (resName, emd5, fields) of literals that
+        is parsed by ast.literal_eval(), such that reading the table
+        does not evaluate or unpickle anything. fields is None for
+        IndexMarkers, 'walk' for DCs whose unit or attributes are not
+        literals and are read from their group instead, and a tuple
+        (longname, shortname, machine, creator, unit, dimensions or
+        columns, attributes) with unit and attribute values given as
+        their repr otherwise.
+        """
+        dcId = utf82uc(self.handle.getNodeAttr("/results/" + resName,
+                                               "TITLE"))
+        summary = self.loadSummary(dcId)
+        if summary == u'IndexMarker':
+            return repr((resName, dcId, None))
+        literals = [summary.get('unit', 1)] \
+                   + summary['attributes'].values()
+        for value in literals:
+            if value is not None and repr2attr(repr(value)) is None:
+                return repr((resName, dcId, 'walk'))
+        refs = summary.get('dimensions', summary.get('columns'))
+        fields = (summary['longname'], summary['shortname'],
+                  summary['machine'], summary['creator'],
+                  repr(summary.get('unit', 1)),
+                  tuple([utf82uc(ref) for ref in refs]),
+                  tuple([(key, repr(value)) for key, value \
+                             in summary['attributes'].iteritems()]))
+        return repr((resName, dcId, fields))
+
+    def _appendSummaries(self, resNames):
+        """
+        Appends the summaries of the given result groups to the table
+        /summary, which stores one string per group of /results, see
+        _getSummaryRecord(). If the file does not have the table yet or
+        has a table written by a former version, the table is created
+        for all results.
+        """
+        if not resNames:
+            return
+        try:
+            table = self.handle.getNode("/summary")
+        except tables.NoSuchNodeError:
+            table = None
+        if table is not None and not isinstance(table.atom,
+                                                tables.VLStringAtom):
+            self.handle.removeNode("/summary")
+            table = None
+        if table is None:
+            table = self.handle.createVLArray("/", "summary",
+                                              tables.VLStringAtom(),
+                                              "Summaries of the results")
+            resNames = self._getResultNames()
+        for resName in sorted(resNames):
+            table.append(self._getSummaryRecord(resName))
+
     def loadRecipe(self):
         return PyTablesPersister.loadRecipe(self.handle)
 
-    def saveDataContainer(self, result):
+    def getLinkStatistics(self):
+        """
+        Returns a tuple (links, nbytes), where links is the number of
+        arrays in the file that are external links to arrays of other
+        files and nbytes is the size of the linked arrays, i.e. the
+        number of bytes saved by deduplication.
+        """
+        links = 0
+        nbytes = 0
+        try:
+            nodes = self.handle.walkNodes("/results", "ExternalLink")
+            for link in nodes:
+                links += 1
+                try:
+                    nbytes += PyTablesPersister.getArrayNode(
+                        link._v_parent, link._v_name).size_in_memory
+                except (IOError, tables.NoSuchNodeError):
+                    _logger.warn("Dangling link %s in %s."
+                                 % (link._v_pathname, self.filename))
+        except tables.NoSuchNodeError:
+            pass
+        return links, nbytes
+
+    def getLinkTargets(self):
+        """
+        Returns the set of real paths of the files the external links
+        in this file point to.
+        """
+        directory = os.path.dirname(os.path.realpath(self.filename))
+        targets = set()
+        try:
+            for link in self.handle.walkNodes("/results", "ExternalLink"):
+                path = link.target.rsplit(':', 1)[0]
+                targets.add(os.path.realpath(os.path.join(directory, path)))
+        except tables.NoSuchNodeError:
+            pass
+        return targets
+
+    def saveDataContainer(self, result, links=None, profile=None):
         """
         Saves a given DataContainer instance to the HDF5 file.
         The DataContainer has to be sealed or at least provide a valid
@@ -233,9 +449,15 @@ class H5FileHandler(object):
         A HDF5 group path that points to the location the DC was stored at
         is returned.
         result -- sealed DC instance
+        links -- dictionary that maps hashes of FieldContainers to
+                 HDF5 files storing them already, whose arrays are then
+                 saved as external links, see PyTablesPersister.saveField
+        profile -- storage profile of the arrays, see
+                   PyTablesPersister.STORAGE_PROFILES
         """
         dcHash, uriType = DataContainer.parseId(result.id)
         resId = u"result_" + dcHash
+        resIds = self._getResultNames()
         try:
             resultGroup = self.handle.getNode("/results/" + resId)
         except tables.NoSuchNodeError:
@@ -249,36 +471,41 @@ class H5FileHandler(object):
                     "/results", resId, result.id.encode("utf-8")
                     )
             if uriType == 'field':
-                self.saveField(resultGroup, result)
+                self.saveField(resultGroup, result, links, profile)
             elif uriType == 'sample':
-                self.saveSample(resultGroup, result)
+                self.saveSample(resultGroup, result, links, profile)
             else:
                 raise KeyError(
                     "Unknown UriType %s in saving result %s." % (
                         uriType, result.id
                         )
                     )
+            self._appendSummaries(self._getResultNames() - resIds)
         return resId
 
-    def saveSample(self, resultGroup, result):
+    def saveSample(self, resultGroup, result, links=None, profile=None):
         """
         Saves a SampleContainer instance to the given node. This method is
         intended for internal use only.
         resultGroup -- node at which the SampleContainer should be saved
                        in the file.
         result -- SampleContainer instance to be saved
+        links, profile -- see saveDataContainer
         """
-        return PyTablesPersister.saveSample(self.handle, resultGroup, result)
+        return PyTablesPersister.saveSample(self.handle, resultGroup, result,
+                                            links, profile)
 
-    def saveField(self, resultGroup, result):
+    def saveField(self, resultGroup, result, links=None, profile=None):
         """
         Saves a FieldContainer instance to the given node. This method is
         intended for internal use only.
         resultGroup -- node at which the FieldContainer should be saved
                        in the file.
         result -- FieldContainer instance to be saved
+        links, profile -- see saveDataContainer
         """
-        return PyTablesPersister.saveField(self.handle, resultGroup, result)
+        return PyTablesPersister.saveField(self.handle, resultGroup, result,
+                                           links, profile)
 
     def saveRecipe(self, recipe, saveResults=True):
         """
@@ -287,4 +514,6 @@ class H5FileHandler(object):
         recipe -- CompositeWorker to be saved
         saveResults -- Whether to save results of the workers
         """
-        return PyTablesPersister.saveRecipe(self.handle, recipe, saveResults)
+        resIds = self._getResultNames()
+        PyTablesPersister.saveRecipe(self.handle, recipe, saveResults)
+        self._appendSummaries(self._getResultNames() - resIds)
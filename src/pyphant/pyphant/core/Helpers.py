@@ -149,24 +149,31 @@ def batch(recipe, input, plug, longname, dobatch=True, temporary=False):
     from pyphant.core.Emd5Src import Emd5Src
     DummyWorker = Emd5Src()
     socket.insert(DummyWorker.getPlugs()[0])
-    DummyWorker.paramSelectby.value = u"enter emd5"
     from pyphant.core.KnowledgeManager import KnowledgeManager
     km = KnowledgeManager.getInstance()
     if dobatch:
         import copy
         output = copy.deepcopy(input)
-        index = 0
-        for emd5 in input['emd5'].data:
-            DummyWorker.paramEnteremd5.value = emd5
-            resultDC = plug.getResult()
-            km.registerDataContainer(resultDC, temporary=temporary)
-            output['emd5'].data[index] = resultDC.id
-            index += 1
+
+        def results():
+            emd5s = input['emd5'].data
+            # load item N + 1 while computing item N
+            following = km.prefetch(emd5s[:1])
+            for index, emd5 in enumerate(emd5s):
+                current = following
+                following = km.prefetch(emd5s[index + 1:index + 2])
+                # errors are raised by getResult() below
+                current[0].exception()
+                DummyWorker.paramEmd5.value = emd5
+                resultDC = plug.getResult()
+                output['emd5'].data[index] = resultDC.id
+                yield resultDC
+        km.registerDataContainers(results(), temporary=temporary)
         output.longname = longname
         output.seal()
     else:
         km.registerDataContainer(input)
-        DummyWorker.paramEnteremd5.value = input.id
+        DummyWorker.paramEmd5.value = input.id
         output = plug.getResult()
     socket.pullPlug()
     return output
@@ -203,25 +210,28 @@ def makeSC(column_data, longnames, shortnames, longname, shortname,
 
 from threading import Lock
 TIMESTAMP_LOCK = Lock()
-LAST_TIMESTAMP = ''
+LAST_TIMESTAMP = None
 del Lock
 
 
 def getModuleUniqueTimestamp():
+    """
+    Returns the current UTC time as a datetime instance that is larger
+    than all timestamps returned before by this function. If the clock
+    has not advanced since the last call or has been set back, the last
+    timestamp incremented by one microsecond is returned instead of
+    waiting for the clock, hence the timestamps may run ahead of the
+    clock for a short time when many DataContainers are sealed at once.
+    """
     global TIMESTAMP_LOCK
     global LAST_TIMESTAMP
+    from datetime import (datetime, timedelta)
     TIMESTAMP_LOCK.acquire()
-    timestamp = None
     try:
-        from datetime import datetime
-        while True:
-            timestamp = datetime.utcnow()
-            if timestamp != LAST_TIMESTAMP:
-                LAST_TIMESTAMP = timestamp
-                break
-            else:
-                from time import sleep
-                sleep(.001)
+        timestamp = datetime.utcnow()
+        if LAST_TIMESTAMP is not None and timestamp <= LAST_TIMESTAMP:
+            timestamp = LAST_TIMESTAMP + timedelta(microseconds=1)
+        LAST_TIMESTAMP = timestamp
     finally:
         TIMESTAMP_LOCK.release()
     return timestamp
@@ -40,23 +40,88 @@ from pyphant.core.singletonmixin import Singleton
 import os
 import logging
 import re
+import hashlib
+import threading
+import atexit
+import tables
+import weakref
 from pyphant.core.H5FileHandler import (H5FileHandler, im_id)
-from pyphant.core import LoadFMF
-from pyphant.core.SQLiteWrapper import (SQLiteWrapper, AnyValue)
+from pyphant.core import (LoadFMF, PyTablesPersister)
+from pyphant.core.DataContainer import (SampleContainer, IndexMarker)
+from pyphant.core.SQLiteWrapper import (SQLiteWrapper, AnyValue,
+                                        exclusive_access, move_database)
+from pyphant.core.DCCache import (DCCache, rawDataBytes, SingleFlight,
+                                  LoaderPool, SpillCache)
 from pyphant.core.Helpers import getPyphantPath
+from pyphant.quantities import (Quantity, PhysicalUnit)
 from uuid import uuid1
 from urlparse import urlparse
 import urllib
 
-# Limit for sum(DC.rawDataBytes) for DC in cache:
+# Default limit for sum(DC.rawDataBytes) for DC in cache:
 CACHE_MAX_SIZE = 256 * 1024 * 1024
-# Limit for number of stored DCs in cache:
+# Default limit for number of stored DCs in cache:
 CACHE_MAX_NUMBER = 100
+# Default eviction policy of the cache, see DCCache.POLICIES:
+CACHE_POLICY = 'lru'
+# Default limit for the total size of the files of the disk tier of the
+# cache, which keeps DCs evicted from memory in the tmp dir:
+SPILL_MAX_SIZE = 1024 * 1024 * 1024
+# Maximum number of threads loading DCs for prefetch():
+PREFETCH_THREADS = 4
+# Maximum number of DCs written to one shard by registerDataContainers():
+SHARD_MAX_NUMBER = 1000
+# DCs given to registerDataContainers() are written as soon as the sum
+# of their rawDataBytes reaches this limit, such that they need not be
+# kept in memory until SHARD_MAX_NUMBER DCs have been collected:
+SHARD_MAX_BYTES = 256 * 1024 * 1024
+# Number of files registered per transaction by updateIndex():
+INDEX_BATCH_SIZE = 500
+# Minimum number of files to be indexed for which updateIndex() starts
+# a pool of worker processes unless the number of processes is given,
+# since forking does not pay off for a few files, e.g. upon KM startup:
+INDEX_POOL_MIN_FILES = 64
+# Number of search results fetched at once by iterSearch():
+SEARCH_BATCH_SIZE = 1000
+# Limits of the search result cache, the size of a result is the
+# number of its rows:
+SEARCH_CACHE_MAX_ROWS = 100000
+SEARCH_CACHE_MAX_NUMBER = 200
+# FieldContainers with at least this number of data bytes are stored
+# as external links if a FieldContainer with the same hash is stored
+# already:
+DEDUP_MIN_BYTES = 4096
+# Default storage profile of DCs written to the KM storage, see
+# PyTablesPersister.STORAGE_PROFILES:
+STORAGE_PROFILE = PyTablesPersister.DEFAULT_PROFILE
 KM_PATH = 'KMstorage'
 REHDF5 = re.compile(r'..*\.h5$|..*\.hdf$|..*\.hdf5$')
 REFMF = re.compile(r'..*\.fmf$')
 
 
+def searchKey(value):
+    """
+    Returns a hashable representation of the given search argument,
+    which may consist of (nested) dicts, lists and tuples.
+    """
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted([(searchKey(key), searchKey(val)) \
+                                          for key, val in value.iteritems()])))
+    elif isinstance(value, (list, tuple)):
+        return (type(value).__name__,
+                tuple([searchKey(item) for item in value]))
+    elif isinstance(value, AnyValue):
+        return ('any', )
+    elif isinstance(value, (Quantity, PhysicalUnit)):
+        # equal quantities of different units yield different queries
+        return ('repr', repr(value))
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return ('repr', repr(value))
+
+
 def getFilenameFromDcId(dcId, temporary=False):
     """
     Returns a unique filename for the given emd5.
@@ -77,32 +142,138 @@ def getFilenameFromDcId(dcId, temporary=False):
         os.path.join(KM_PATH, subdir, directory)), filename)
 
 
-class DCNotFoundError(Exception):
-    pass
+def getShardFilename(temporary=False):
+    """
+    Returns a new unique filename for a shard, i.e. an HDF5 file
+    containing several DataContainers.
+    """
+    if temporary:
+        subdir = os.path.join('tmp', 'by_shard')
+    else:
+        subdir = 'by_shard'
+    return os.path.join(getPyphantPath(os.path.join(KM_PATH, subdir)),
+                        uuid1().hex + '.h5')
 
 
-class CachedDC(object):
+def iterDataContainers(dc):
     """
-    Class representing a cached DataContainer
+    Yields the given DataContainer and, recursively, its columns and
+    dimensions, omitting IndexMarkers.
     """
-    def __init__(self, dc_ref):
-        self.id = dc_ref.id
-        self.ref = dc_ref
-        self.size = dc_ref.rawDataBytes
+    if isinstance(dc, SampleContainer):
+        yield dc
+        for column in dc.columns:
+            for sub in iterDataContainers(column):
+                yield sub
+    elif not isinstance(dc, IndexMarker):
+        yield dc
+        for dim in dc.dimensions:
+            for sub in iterDataContainers(dim):
+                yield sub
 
-    def __eq__(self, other):
-        return self.id == other.id
+
+def fileChecksum(filename, blocksize=1024 * 1024):
+    """
+    Returns the hex encoded md5 digest of the content of the given file.
+    """
+    digest = hashlib.md5()
+    handle = open(filename, 'rb')
+    try:
+        block = handle.read(blocksize)
+        while block:
+            digest.update(block)
+            block = handle.read(blocksize)
+    finally:
+        handle.close()
+    return digest.hexdigest()
 
 
-class TestCachedDC(object):
+def indexFile(job):
     """
-    Class representing a cache lookup
+    Worker function of the process pool used by
+    KnowledgeManager.updateIndex().
+    job -- tuple (filename, checksum) where checksum is the checksum
+           of the indexed version of the file or None
+    Returns a tuple (filename, size, mtime, checksum, summaryDict).
+    summaryDict is empty if the content of the file has not changed
+    and None if the file could not be read.
     """
-    def __init__(self, dc_id):
-        self.id = dc_id
+    filename, known_checksum = job
+    try:
+        stat = os.stat(filename)
+        checksum = fileChecksum(filename)
+        if checksum == known_checksum:
+            summaryDict = {}
+        else:
+            with H5FileHandler(filename, 'r') as handler:
+                summaryDict = handler.loadSummary()
+    except Exception:
+        return filename, None, None, None, None
+    return filename, stat.st_size, stat.st_mtime, checksum, summaryDict
 
-    def __eq__(self, other):
-        return self.id == other.id
+
+def _initWorker():
+    # The lock might have been held by another thread of the parent
+    # process at the time the worker has been forked.
+    PyTablesPersister.h5Lock = threading.RLock()
+    # HDF5 handles must not be shared with the parent process.
+    PyTablesPersister.handlePool = PyTablesPersister.HandlePool()
+
+
+def iterIndexFiles(jobs, processes=None):
+    """
+    Yields the results of indexFile() for each job in arbitrary order.
+    The files are read by a pool of worker processes.
+    processes -- number of worker processes. If None, the number of
+                 CPUs is used for at least INDEX_POOL_MIN_FILES jobs
+                 and fewer jobs are read in the calling process.
+                 Use 1 in order to read the files in the calling
+                 process.
+    """
+    pool = None
+    if processes is None and len(jobs) < INDEX_POOL_MIN_FILES:
+        processes = 1
+    if processes != 1 and len(jobs) > 1:
+        try:
+            from multiprocessing import Pool
+            pool = Pool(processes, _initWorker)
+        except (ImportError, OSError, NotImplementedError):
+            pool = None
+    if pool is None:
+        for job in jobs:
+            yield indexFile(job)
+        return
+    try:
+        for result in pool.imap_unordered(indexFile, jobs, chunksize=8):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def getWxProgress(maximum):
+    """
+    Returns a tuple (progress, destroy) of callables that update and
+    remove a wx ProgressDialog or (None, None) if wx is not available.
+    """
+    try:
+        from wx import (ProgressDialog, PyNoAppError)
+        try:
+            pdial = ProgressDialog('Updating index...', ' ' * 100,
+                                   maximum=maximum)
+        except PyNoAppError:
+            return None, None
+    except ImportError:
+        return None, None
+
+    def progress(count, total, filename):
+        pdial.Update(count, os.path.basename(filename))
+    return progress, pdial.Destroy
+
+
+class DCNotFoundError(Exception):
+    pass
 
 
 KM_DBASE = u'default'  # modify for debug purposes
@@ -138,9 +309,13 @@ class KnowledgeManager(Singleton):
     How to share Knowledge:
         Hook up the KM to a KnowledgeNode, see documentation in the
         KnowledgeNode module.
-    Known issues:
-    ------------
-    KM is NOT thread-safe yet.
+    Thread safety:
+    --------------
+    The KM may be used from several threads concurrently, e.g. by the
+    Computer threads of CalculatingPlugs. Concurrent requests for the
+    same DC load it only once, concurrent registrations of the same DC
+    write it only once and access to HDF5 files is serialized by
+    PyTablesPersister.h5Lock.
     """
 
     def __init__(self):
@@ -151,8 +326,22 @@ class KnowledgeManager(Singleton):
         """
         super(KnowledgeManager, self).__init__()
         self.logger = logging.getLogger("pyphant")
-        self._cache = []
-        self._cache_size = 0
+        spill = SpillCache(os.path.join(getPyphantPath(KM_PATH), 'tmp',
+                                        'spill'), SPILL_MAX_SIZE)
+        # the tmp dir is cleared upon the next start otherwise
+        atexit.register(spill.clear)
+        self._cache = DCCache(CACHE_MAX_SIZE, CACHE_MAX_NUMBER, CACHE_POLICY,
+                              spill)
+        self._searchCache = DCCache(SEARCH_CACHE_MAX_ROWS,
+                                    SEARCH_CACHE_MAX_NUMBER)
+        self._loading = SingleFlight()
+        self._prefetching = LoaderPool(PREFETCH_THREADS)
+        self._registering = SingleFlight()
+        self._indexLock = threading.Lock()
+        # identity map of loaded FieldContainers, which lets DCs loaded
+        # one after another share their dimensions:
+        self._fields = weakref.WeakValueDictionary()
+        self.storageProfile = STORAGE_PROFILE
         if KM_DBASE == u'default':
             self.dbase = os.path.join(getPyphantPath('sqlite3'),
                                       "km_meta.sqlite3")
@@ -168,57 +357,141 @@ class KnowledgeManager(Singleton):
                 rmtree(tmpdir)
             except OSError:
                 self.logger.warn("Could not delete '%s'." % tmpdir)
-        with SQLiteWrapper(self.dbase) as wrapper:
-            rebuild = wrapper.dbase_broken()
+        with SQLiteWrapper(self.dbase, immediate=True) as wrapper:
+            rebuild = wrapper.dbase_broken() and not wrapper.upgrade_dbase()
         if rebuild:
             self.logger.info("dbase needs rebuild")
             self.rebuildIndex()
         else:
-            with SQLiteWrapper(self.dbase) as wrapper:
+            with SQLiteWrapper(self.dbase, immediate=True) as wrapper:
                 wrapper.setup_sqlite()
+            self.updateIndex()
 
-    def rebuildIndex(self):
+    def rebuildIndex(self, progress=None, processes=None):
+        """
+        Moves the current database to a backup file and creates a new
+        one from the HDF5 files in the KM storage directory. See
+        updateIndex() for the arguments.
+        """
         self.logger.info("rebuilding dbase...")
-        oldname = self.dbase + ".bak"
-        if os.path.exists(oldname):
-            os.remove(oldname)
-        os.rename(self.dbase, oldname)
-        with SQLiteWrapper(self.dbase) as wrapper:
-            wrapper.setup_dbase()
-        self.updateIndex()
+        # other threads wait until the new dbase has been set up:
+        with exclusive_access(self.dbase):
+            move_database(self.dbase, self.dbase + ".bak")
+            with SQLiteWrapper(self.dbase, immediate=True) as wrapper:
+                wrapper.setup_dbase()
+        # the generation of the new dbase starts over:
+        self._searchCache.clear()
+        self.updateIndex(progress, processes)
         self.logger.info("done rebuilding dbase")
 
-    def updateIndex(self):
-        file_list = []
-
-        def accumulate_files(flist, directory, files):
-            for fname in [
-                afname for afname in files if afname.endswith('.h5')
-                ]:
-                flist.append(os.path.realpath(os.path.join(directory, fname)))
+    def updateIndex(self, progress=None, processes=None):
+        """
+        Synchronizes the database with the HDF5 files in the KM storage
+        directory. Files are recognized as changed by their size and
+        modification time. Only new files and changed files whose
+        checksum differs from the indexed version are summarized again.
+        Entries of deleted files are removed from the database.
+        Files in the tmp subdirectory are registered as temporary.
+        The meta data is extracted by a pool of worker processes if
+        there are many files, see iterIndexFiles(), and written to the
+        database by the calling process in transactions of
+        INDEX_BATCH_SIZE files each.
+        progress -- callable progress(count, total, filename) that is
+                    called after each file that had to be checked.
+                    A wx ProgressDialog is used if None is given and wx
+                    is available.
+        processes -- number of worker processes, see iterIndexFiles()
+        """
+        with self._indexLock:
+            self._updateIndex(progress, processes)
 
-        os.path.walk(getPyphantPath(KM_PATH), accumulate_files, file_list)
-        try:
-            from wx import (ProgressDialog, PyNoAppError)
-            try:
-                pdial = ProgressDialog('Rebuilding index...', ' ' * 100,
-                                       maximum=len(file_list))
-            except PyNoAppError:
-                pdial = None
-        except ImportError:
-            pdial = None
-        count = 1
+    def _updateIndex(self, progress, processes):
+        file_list = []
+        tmpdir = os.path.realpath(getPyphantPath(os.path.join(KM_PATH,
+                                                              'tmp')))
+        for directory, dirs, files in os.walk(getPyphantPath(KM_PATH)):
+            file_list.extend([os.path.realpath(os.path.join(directory, fname))
+                              for fname in files if fname.endswith('.h5')])
+        with SQLiteWrapper(self.dbase, immediate=True) as wrapper:
+            known = wrapper.get_files()
+            existing = set(file_list)
+            for path in known.keys():
+                if path not in existing and not os.path.exists(path):
+                    wrapper.delete_file(path)
+        jobs = []
         for realname in file_list:
-            if pdial is not None:
-                pdial.Update(count, os.path.basename(realname))
-                count += 1
             try:
-                self.registerH5(realname)
-            except:
-                self.logger.warn("Could not extract meta data from '%s'."\
-                                 % realname)
-        if pdial is not None:
-            pdial.Destroy()
+                stat = os.stat(realname)
+            except OSError:
+                continue
+            if realname not in known:
+                jobs.append((realname, None))
+            else:
+                size, mtime, checksum = known[realname]
+                if (size, mtime) != (stat.st_size, stat.st_mtime):
+                    jobs.append((realname, checksum))
+        total = len(jobs)
+        if total == 0:
+            return
+        self.logger.info("indexing %d of %d files..." \
+                         % (total, len(file_list)))
+        destroy = None
+        if progress is None:
+            progress, destroy = getWxProgress(total)
+        try:
+            with SQLiteWrapper(self.dbase, immediate=True) as wrapper:
+                count = 0
+                batch = []
+                for result in iterIndexFiles(jobs, processes):
+                    count += 1
+                    realname = result[0]
+                    if result[-1] is None:
+                        self.logger.warn(
+                            "Could not extract meta data from '%s'."\
+                            % realname)
+                    else:
+                        batch.append(result)
+                    if count % INDEX_BATCH_SIZE == 0:
+                        self._indexBatch(wrapper, batch, known, tmpdir)
+                        wrapper.commit()
+                        batch = []
+                    if progress is not None:
+                        progress(count, total, realname)
+                self._indexBatch(wrapper, batch, known, tmpdir)
+        finally:
+            if destroy is not None:
+                destroy()
+
+    def _indexBatch(self, wrapper, batch, known, tmpdir):
+        """
+        Registers the files of the given results of indexFile() with
+        one set_entries() call per temporary flag. If that fails, the
+        files are registered one by one and those that cannot be
+        registered are skipped.
+        """
+        try:
+            with wrapper.savepoint('batch'):
+                self._indexFiles(wrapper, batch, known, tmpdir)
+        except Exception:
+            for result in batch:
+                try:
+                    with wrapper.savepoint():
+                        self._indexFiles(wrapper, [result], known, tmpdir)
+                except Exception:
+                    self.logger.warn(
+                        "Could not extract meta data from '%s'."\
+                        % result[0])
+
+    def _indexFiles(self, wrapper, results, known, tmpdir):
+        files = {False: [], True: []}
+        for realname, size, mtime, checksum, summaryDict in results:
+            if summaryDict and realname in known:
+                wrapper.delete_file(realname)
+            temporary = realname.startswith(tmpdir + os.sep)
+            files[temporary].append((realname, summaryDict))
+            wrapper.set_file(realname, size, mtime, checksum)
+        for temporary, tmpFiles in files.iteritems():
+            self._setEntries(wrapper, tmpFiles, temporary)
 
     def hasDataContainer(self, dcid):
         """
@@ -236,6 +509,16 @@ class KnowledgeManager(Singleton):
             is_tmp = wrapper.is_temporary(dcid)
         return is_tmp
 
+    def areTemporary(self, dcids):
+        """
+        Returns a list of flags that tell for each of the given DCs
+        whether it is stored temporarily.
+        """
+        dcids = list(dcids)
+        with SQLiteWrapper(self.dbase) as wrapper:
+            temporary = wrapper.get_temporary_ids(dcids)
+        return [dcid in temporary for dcid in dcids]
+
     def setTemporary(self, dcid, temporary):
         """
         Sets the given entry to temporary, which means it will be
@@ -243,7 +526,7 @@ class KnowledgeManager(Singleton):
         - dcid: emd5 of DataContainer
         - temporary: boolean
         """
-        with SQLiteWrapper(self.dbase) as wrapper:
+        with SQLiteWrapper(self.dbase, immediate=True) as wrapper:
             wrapper.set_temporary(dcid, temporary)
 
     def getH5FileHandler(self, filename, mode='r'):
@@ -263,15 +546,30 @@ class KnowledgeManager(Singleton):
         temporary -- flag that marks data to be deleted upon next
                      instantiation of a KM Singleton
         """
+        filename = os.path.realpath(filename)
         h5fh = self.getH5FileHandler(filename)
         with h5fh:
             summaryDict = h5fh.loadSummary()
-        with SQLiteWrapper(self.dbase) as wrapper:
-            for dcId, summary in summaryDict.items():
+        stat = os.stat(filename)
+        with SQLiteWrapper(self.dbase, immediate=True) as wrapper:
+            self._setEntries(wrapper, [(filename, summaryDict)], temporary)
+            wrapper.set_file(filename, stat.st_size, stat.st_mtime)
+
+    def _setEntries(self, wrapper, files, temporary):
+        """
+        Registers the DCs of the given files in one go.
+        files -- list of tuples (filename, summaryDict), where
+                 summaryDict is returned by H5FileHandler.loadSummary()
+        temporary -- see registerH5()
+        """
+        entries = []
+        for filename, summaryDict in files:
+            for dcId, summary in summaryDict.iteritems():
                 if dcId == im_id:
-                    wrapper.set_entry(summary, None, temporary)
+                    entries.append((summary, None))
                 else:
-                    wrapper.set_entry(summary, filename, temporary)
+                    entries.append((summary, filename))
+        wrapper.set_entries(entries, temporary)
 
     def registerURL(self, url, temporary=False):
         """
@@ -327,7 +625,7 @@ class KnowledgeManager(Singleton):
             self.logger.error(msg)
             raise ValueError(msg)
 
-    def registerDataContainer(self, dc, temporary=False):
+    def registerDataContainer(self, dc, temporary=False, profile=None):
         """
         Registers a DataContainer located in memory using a given
         reference and stores it in the pyphant directory.
@@ -340,17 +638,281 @@ class KnowledgeManager(Singleton):
                      created. Set this flag to True e.g. for unit tests
                      or whenever you do not want to produce garbage on
                      your hard drive.
+        profile -- storage profile of the arrays, see
+                   PyTablesPersister.STORAGE_PROFILES. The storage
+                   profile of the KM is used if None is given, see
+                   configureStorage().
         """
         if dc.id == None:
             msg = "Missing id for DataContainer. DC has not been sealed."
             self.logger.error(msg)
             raise ValueError(msg)
         if not self.hasDataContainer(dc.id):
-            filename = getFilenameFromDcId(dc.id, temporary)
-            handler = self.getH5FileHandler(filename, 'w')
-            with handler:
-                handler.saveDataContainer(dc)
-            self.registerH5(filename, temporary)
+            self._registering.do(dc.id, self._registerDC, dc, temporary,
+                                 profile)
+
+    def _registerDC(self, dc, temporary, profile=None):
+        if self.hasDataContainer(dc.id):
+            return
+        filename = getFilenameFromDcId(dc.id, temporary)
+        links = self._getLinks([dc], temporary)
+        handler = self.getH5FileHandler(filename, 'w')
+        with handler:
+            handler.saveDataContainer(dc, links,
+                                      profile or self.storageProfile)
+        self.registerH5(filename, temporary)
+
+    def _getLinks(self, dcs, temporary, exclude=()):
+        """
+        Returns a dictionary that maps the hashes of those
+        FieldContainers among the given DCs, their columns and
+        dimensions, which are stored in the KM storage already, to the
+        files storing them. Permanent DCs are never linked to the tmp
+        directory, which is deleted upon restart.
+        See H5FileHandler.saveDataContainer().
+        exclude -- files that must not be linked to
+        """
+        fields = set()
+        for dc in dcs:
+            for sub in iterDataContainers(dc):
+                if not isinstance(sub, SampleContainer) \
+                       and sub.data.nbytes >= DEDUP_MIN_BYTES:
+                    fields.add(sub.hash)
+        if not fields:
+            return {}
+        with SQLiteWrapper(self.dbase) as wrapper:
+            storages = wrapper.get_hash_storages(fields)
+        kmdir = os.path.realpath(getPyphantPath(KM_PATH)) + os.sep
+        tmpdir = os.path.realpath(getPyphantPath(os.path.join(KM_PATH,
+                                                              'tmp'))) + os.sep
+        links = {}
+        for dcHash, paths in storages.iteritems():
+            for path in paths:
+                if path.startswith(kmdir) \
+                       and (temporary or not path.startswith(tmpdir)) \
+                       and path not in exclude and os.path.isfile(path):
+                    links[dcHash] = path
+                    break
+        return links
+
+    def registerDataContainers(self, dcs, temporary=False, profile=None):
+        """
+        Registers many DataContainers at once and returns the list of
+        emd5s that have been stored. The DCs are written to shard files
+        of up to SHARD_MAX_NUMBER DCs or SHARD_MAX_BYTES raw data bytes
+        each using a single file handle and indexed in a single
+        transaction per shard. DCs whose emd5s are known to the
+        KnowledgeManager already are skipped.
+        dcs -- iterable of sealed DataContainers, e.g. a generator
+        temporary, profile -- see registerDataContainer
+        """
+        stored = []
+        chunk = []
+        nbytes = 0
+        for dc in dcs:
+            if dc.id == None:
+                msg = "Missing id for DataContainer. DC has not been sealed."
+                self.logger.error(msg)
+                raise ValueError(msg)
+            chunk.append(dc)
+            nbytes += rawDataBytes(dc)
+            if len(chunk) == SHARD_MAX_NUMBER or nbytes >= SHARD_MAX_BYTES:
+                stored.extend(self._registerShard(chunk, temporary,
+                                                  profile))
+                chunk = []
+                nbytes = 0
+        if chunk:
+            stored.extend(self._registerShard(chunk, temporary, profile))
+        return stored
+
+    def _registerShard(self, dcs, temporary, profile=None):
+        stored = []
+        while dcs:
+            with SQLiteWrapper(self.dbase) as wrapper:
+                known = wrapper.get_known_ids([dc.id for dc in dcs])
+            shardIds = {}
+            new_dcs = []
+            deferred = []
+            for dc in dcs:
+                if dc.id in known:
+                    continue
+                # HDF5 groups are named by hash, so DCs with equal
+                # hashes and different emd5s go to different shards
+                if shardIds.get(dc.hash, dc.id) != dc.id:
+                    deferred.append(dc)
+                    continue
+                for sub in iterDataContainers(dc):
+                    shardIds.setdefault(sub.hash, sub.id)
+                known.add(dc.id)
+                new_dcs.append(dc)
+            if new_dcs:
+                self._writeShard(new_dcs, temporary, profile)
+                stored.extend([dc.id for dc in new_dcs])
+            dcs = deferred
+        return stored
+
+    def _writeShard(self, new_dcs, temporary, profile):
+        filename = os.path.realpath(getShardFilename(temporary))
+        links = self._getLinks(new_dcs, temporary)
+        handler = self.getH5FileHandler(filename, 'w')
+        with handler:
+            for dc in new_dcs:
+                handler.saveDataContainer(dc, links,
+                                          profile or self.storageProfile)
+            summaryDict = handler.loadSummary()
+        stat = os.stat(filename)
+        with SQLiteWrapper(self.dbase, immediate=True) as wrapper:
+            self._setEntries(wrapper, [(filename, summaryDict)], temporary)
+            wrapper.set_file(filename, stat.st_size, stat.st_mtime)
+
+    def getDeduplicationReport(self):
+        """
+        Returns a dictionary that tells the number of indexed 'files',
+        the number of arrays stored as external 'links' to identical
+        arrays in other files and the number of 'saved_bytes' due to
+        those links.
+        """
+        with SQLiteWrapper(self.dbase) as wrapper:
+            filenames = wrapper.get_files().keys()
+        report = {'files': len(filenames), 'links': 0, 'saved_bytes': 0}
+        for filename in filenames:
+            try:
+                with self.getH5FileHandler(filename) as handler:
+                    links, nbytes = handler.getLinkStatistics()
+            except (IOError, tables.HDF5ExtError):
+                self.logger.warn("Could not read '%s'." % filename)
+                continue
+            report['links'] += links
+            report['saved_bytes'] += nbytes
+        return report
+
+    def compactStorage(self, temporary=False, progress=None,
+                       processes=None):
+        """
+        Packs the DCs of the files in the by_emd5 directory, to which
+        registerDataContainer() writes one file per DC, into shard files
+        of up to SHARD_MAX_NUMBER DCs each and deletes the original
+        files. The storage of the packed DCs is updated in a single
+        transaction per shard, the original files are deleted after all
+        shards have been written. Files that are the target of external
+        links in other files are left untouched, see DEDUP_MIN_BYTES.
+        Furthermore temporary DCs stored outside the tmp directory,
+        which are not used by permanent DCs, are removed from the index
+        and files that no entry of the index refers to are deleted.
+        The index is synchronized with the storage directory before,
+        see updateIndex(). Lazy DCs loaded from the original files
+        cannot read their data afterwards.
+        Returns a dictionary that tells the number of 'packed' DCs, the
+        number of new 'shards', the number of 'deleted_files' and the
+        number of 'deleted_dcs'. The shards are written with the storage
+        profile of the KM, see configureStorage().
+        temporary -- compact the tmp directory instead of the permanent
+                     storage
+        progress, processes -- see updateIndex()
+        """
+        with self._indexLock:
+            self._updateIndex(progress, processes)
+            return self._compactStorage(temporary)
+
+    def _compactStorage(self, temporary):
+        tmpdir = os.path.realpath(getPyphantPath(os.path.join(KM_PATH,
+                                                              'tmp'))) + os.sep
+        if temporary:
+            rootdir = tmpdir
+            emd5dir = os.path.join(tmpdir, 'by_emd5')
+        else:
+            rootdir = os.path.realpath(getPyphantPath(KM_PATH)) + os.sep
+            emd5dir = os.path.realpath(
+                getPyphantPath(os.path.join(KM_PATH, 'by_emd5')))
+
+        def managed(path):
+            return path.startswith(rootdir) \
+                   and (temporary or not path.startswith(tmpdir))
+        report = {'packed': 0, 'shards': 0, 'deleted_files': 0,
+                  'deleted_dcs': 0}
+        with SQLiteWrapper(self.dbase, immediate=True) as wrapper:
+            storages = wrapper.get_storage_ids()
+            deleted = set()
+            if not temporary:
+                deleted = wrapper.delete_temporary(wrapper.get_temporary_ids(
+                    [dcId for path, dcIds in storages.iteritems() \
+                         if managed(path) for dcId in dcIds]))
+            filenames = wrapper.get_files().keys()
+        report['deleted_dcs'] = len(deleted)
+        for dcIds in storages.itervalues():
+            dcIds.difference_update(deleted)
+        orphans = set([path for path in filenames \
+                           if managed(path) and not storages.get(path)])
+        sources = set([path for path in filenames \
+                           if path.startswith(emd5dir + os.sep) \
+                           and path not in orphans])
+        for path in filenames:
+            if path in orphans or path in sources:
+                continue
+            try:
+                with self.getH5FileHandler(path) as handler:
+                    targets = handler.getLinkTargets()
+            except (IOError, tables.HDF5ExtError):
+                self.logger.warn("Could not read '%s'." % path)
+                continue
+            orphans.difference_update(targets)
+            sources.difference_update(targets)
+        queue = [(path, dcId) for path in sorted(sources) \
+                     for dcId in sorted(storages[path])]
+        remaining = dict([(path, len(storages[path])) for path in sources])
+        exclude = sources.union(orphans)
+        while queue:
+            filename = os.path.realpath(getShardFilename(temporary))
+            shardIds = {}
+            packed = []
+            deferred = []
+            with self.getH5FileHandler(filename, 'w') as handler:
+                for path, dcId in queue:
+                    if len(packed) == SHARD_MAX_NUMBER:
+                        deferred.append((path, dcId))
+                        continue
+                    with self.getH5FileHandler(path) as source:
+                        dc = source.loadDataContainer(dcId)
+                    # HDF5 groups are named by hash, so DCs with equal
+                    # hashes and different emd5s go to different shards
+                    if shardIds.get(dc.hash, dc.id) != dc.id:
+                        deferred.append((path, dcId))
+                        continue
+                    links = self._getLinks([dc], temporary, exclude)
+                    handler.saveDataContainer(dc, links,
+                                              self.storageProfile)
+                    for sub in iterDataContainers(dc):
+                        shardIds.setdefault(sub.hash, sub.id)
+                    packed.append((path, dcId))
+            stat = os.stat(filename)
+            with SQLiteWrapper(self.dbase, immediate=True) as wrapper:
+                wrapper.set_file(filename, stat.st_size, stat.st_mtime)
+                wrapper.set_storage([dcId for path, dcId in packed],
+                                    filename)
+                for path, dcId in packed:
+                    remaining[path] -= 1
+                    if remaining[path] == 0:
+                        wrapper.delete_file(path)
+            report['packed'] += len(packed)
+            report['shards'] += 1
+            queue = deferred
+        with SQLiteWrapper(self.dbase, immediate=True) as wrapper:
+            for path in orphans:
+                wrapper.delete_file(path)
+        for path in exclude:
+            try:
+                with PyTablesPersister.h5Lock:
+                    PyTablesPersister.handlePool.invalidate(path)
+                os.remove(path)
+                report['deleted_files'] += 1
+            except OSError:
+                self.logger.warn("Could not delete '%s'." % path)
+        for directory, dirs, files in os.walk(emd5dir, topdown=False):
+            if directory != emd5dir and not os.listdir(directory):
+                os.rmdir(directory)
+        # lazy dimensions must not be shared with DCs loaded from now on
+        self._fields.clear()
+        return report
 
     def registerFMF(self, filename, temporary=False):
         """
@@ -364,6 +926,60 @@ class KnowledgeManager(Singleton):
         self.registerDataContainer(sc, temporary)
         return sc.id
 
+    def configureCache(self, max_size=None, max_number=None, policy=None,
+                       spill_max_size=None):
+        """
+        Changes the limits or the eviction policy of the DC cache at
+        runtime. Cached DCs are evicted if they do not fit into the
+        new limits.
+        max_size -- maximum sum of DC.rawDataBytes in bytes
+        max_number -- maximum number of cached DCs
+        policy -- 'lru', 'gdsf' or an instance of
+                  DCCache.EvictionPolicy
+        spill_max_size -- maximum total size of the files of the disk
+                          tier in bytes, 0 disables it
+        """
+        if max_size is not None:
+            self._cache.max_size = max_size
+        if max_number is not None:
+            self._cache.max_number = max_number
+        if policy is not None:
+            self._cache.policy = policy
+        if spill_max_size is not None:
+            self._cache.spill.max_size = spill_max_size
+
+    def configureStorage(self, profile):
+        """
+        Sets the storage profile that is used for the arrays of DCs
+        registered without giving a profile explicitly.
+        profile -- one of PyTablesPersister.STORAGE_PROFILES, e.g.
+                   'compact' for compressed arrays or 'z-stack' for
+                   stacks of images that are read slice by slice
+        """
+        if profile not in PyTablesPersister.STORAGE_PROFILES:
+            raise ValueError("Unknown storage profile '%s'." % (profile, ))
+        self.storageProfile = profile
+
+    def getCacheStatistics(self):
+        """
+        Returns a dictionary with hit, miss and eviction counters and
+        the current utilization of the DC cache. The counters of the
+        disk tier are given as a dictionary of the same kind by the
+        key 'spill'.
+        """
+        stats = self._cache.get_stats()
+        stats['spill'] = self._cache.spill.get_stats()
+        return stats
+
+    def getHandleStatistics(self):
+        """
+        Returns a dictionary with the counters of the pool of read only
+        HDF5 file handles, see PyTablesPersister.HandlePool.get_stats().
+        'hits' is the number of file opens avoided by the pool.
+        """
+        with PyTablesPersister.h5Lock:
+            return PyTablesPersister.handlePool.get_stats()
+
     def getDCFromCache(self, dc_id, filename):
         """
         Returns a DC instance from cache or local storage.
@@ -371,41 +987,33 @@ class KnowledgeManager(Singleton):
         fc_id: emd5 to look for in cache
         filename: alternative source if dc_id not present in cache
         """
-        try:
-            index = self._cache.index(TestCachedDC(dc_id))
-            cached = self._cache.pop(index)
-            self._cache.append(cached)
-            return cached.ref
-        except ValueError:
-            with self.getH5FileHandler(filename) as handler:
-                dc = handler.loadDataContainer(dc_id)
-            self._attemptToCacheDC(dc)
-            return dc
+        dc = self._cache.get(dc_id)
+        if dc is None:
+            dc = self._loading.do(dc_id, self._loadDC, dc_id, filename)
+        return dc
 
-    def _attemptToCacheDC(self, dc):
-        cache_item = CachedDC(dc)
-        if cache_item.size > CACHE_MAX_SIZE:
-            return
-        number_fits = len(self._cache) < CACHE_MAX_NUMBER
-        self._cache.reverse()
-        if not number_fits:
-            self._cache_size -= self._cache.pop().size
-        desired_size = CACHE_MAX_SIZE - cache_item.size
-        not_size_fits = self._cache_size > desired_size
-        while not_size_fits:
-            self._cache_size -= self._cache.pop().size
-            not_size_fits = self._cache_size > desired_size
-        self._cache.reverse()
-        self._cache.append(cache_item)
-        self._cache_size += cache_item.size
-
-    def getDataContainer(self, dc_id, use_cache=True, try_remote=True):
+    def _loadDC(self, dc_id, filename):
+        if dc_id in self._cache:
+            # loaded by a concurrent request that has just finished
+            return self._cache.get(dc_id)
+        with self.getH5FileHandler(filename) as handler:
+            dc = handler.loadDataContainer(dc_id, fields=self._fields)
+        self._cache.put(dc_id, dc, rawDataBytes(dc))
+        return dc
+
+    def getDataContainer(self, dc_id, use_cache=True, try_remote=True,
+                         lazy=False):
         """
         Returns DataContainer matching the given id.
         dc_id -- Unique ID of the DataContainer (emd5)
         use_cache -- Try local cache first and cache DC for further
                      lookups (default: True)
         try_remote -- Try to get DC from remote KMs (default: True)
+        lazy -- Return a sealed DC whose FieldContainers read their
+                data, error and mask from local storage upon first
+                access, while meta data and dimensions are available
+                right away. Lazy DCs are not put into the cache.
+                (default: False)
         """
         filename = None
         with SQLiteWrapper(self.dbase) as wrapper:
@@ -414,20 +1022,77 @@ class KnowledgeManager(Singleton):
             except KeyError:
                 pass
         if filename != None:
+            if lazy:
+                if use_cache:
+                    dc = self._cache.get(dc_id)
+                    if dc is not None:
+                        return dc
+                with self.getH5FileHandler(filename) as handler:
+                    return handler.loadDataContainer(dc_id, lazy=True,
+                                                     fields=self._fields)
             if use_cache:
                 return self.getDCFromCache(dc_id, filename)
             with self.getH5FileHandler(filename) as handler:
-                dc = handler.loadDataContainer(dc_id)
+                dc = handler.loadDataContainer(dc_id, fields=self._fields)
             return dc
         elif try_remote and self.node != None:
+            if use_cache:
+                # e.g. prefetched from a remote node
+                dc = self._cache.get(dc_id)
+                if dc is not None:
+                    return dc
             try:
-                return self.node.get_datacontainer(dc_id)
+                dc = self.node.get_datacontainer(dc_id)
             except DCNotFoundError:
                 pass
+            else:
+                if use_cache:
+                    self._cache.put(dc_id, dc, rawDataBytes(dc))
+                return dc
         msg = "Could not find DC with id '%s'." % dc_id
         self.logger.error(msg)
         raise DCNotFoundError(msg)
 
+    def prefetch(self, dc_ids, try_remote=True):
+        """
+        Loads the given DCs into the cache on background threads, such
+        that subsequent calls of getDataContainer() do not have to wait
+        for disk or network. Returns a list of DCCache.Future instances
+        in the order of dc_ids, whose result() is the respective DC.
+        Errors, e.g. DCNotFoundError, are raised by result() only.
+        dc_ids -- iterable of emd5s
+        try_remote -- see getDataContainer()
+        """
+        return [self._prefetching.submit(self.getDataContainer, dc_id,
+                                         try_remote=try_remote) \
+                    for dc_id in dc_ids]
+
+    def getFieldSlice(self, dc_id, args, use_cache=True, try_remote=True):
+        """
+        Returns the given part of a FieldContainer as a FieldContainer.
+        If the FieldContainer is neither cached nor stored locally, it
+        is retrieved as a whole and sliced afterwards.
+        dc_id -- emd5 of the FieldContainer
+        args -- index arguments, see H5FileHandler.loadFieldSlice()
+        use_cache -- Slice the cached FieldContainer if present
+                     (default: True)
+        try_remote -- see getDataContainer()
+        """
+        if use_cache:
+            dc = self._cache.get(dc_id)
+            if dc is not None:
+                return dc[args]
+        filename = None
+        with SQLiteWrapper(self.dbase) as wrapper:
+            try:
+                filename = wrapper[dc_id]['storage']
+            except KeyError:
+                pass
+        if filename != None:
+            with self.getH5FileHandler(filename) as handler:
+                return handler.loadFieldSlice(dc_id, args)
+        return self.getDataContainer(dc_id, use_cache, try_remote)[args]
+
     def getEmd5List(self):
         """
         returns a list with all locally known DataContainer ids.
@@ -439,13 +1104,46 @@ class KnowledgeManager(Singleton):
                order_asc=True, limit=-1, offset=0, distinct=False):
         """
         see SQLiteWrapper.get_andsearch_result
+        Results are cached until the next change of the database, see
+        SQLiteWrapper.get_generation.
         """
         if search_dict is None:
             search_dict = {}
+        query = searchKey((result_keys, search_dict, order_by, order_asc,
+                           limit, offset, distinct))
         with SQLiteWrapper(self.dbase) as wrapper:
-            return wrapper.get_andsearch_result(
-                result_keys, search_dict, order_by, order_asc,
-                limit, offset, distinct)
+            key = (wrapper.get_generation(), query)
+            result = self._searchCache.get(key)
+            if result is None:
+                result = wrapper.get_andsearch_result(
+                    result_keys, search_dict, order_by, order_asc,
+                    limit, offset, distinct)
+                self._searchCache.put(key, result, len(result))
+        return list(result)
+
+    def iterSearch(self, result_keys, search_dict=None, order_by='id',
+                   order_asc=True, batch_size=SEARCH_BATCH_SIZE):
+        """
+        Generator that yields the same result tuples as search() but
+        fetches them from the database in batches of at most batch_size
+        rows, so that arbitrarily large result sets can be processed in
+        constant memory. Results are ordered by order_by, which is
+        either 'id' or 'date'. Each batch is read in its own transaction,
+        see SQLiteWrapper.get_keyset_result.
+        Usage example:
+           for dc_id, in km.iterSearch(['id'], {'creator':'aheld'}):
+               ...
+        """
+        last = None
+        while True:
+            with SQLiteWrapper(self.dbase) as wrapper:
+                rows, last = wrapper.get_keyset_result(
+                    result_keys, search_dict, order_by, order_asc,
+                    batch_size, last)
+            for row in rows:
+                yield row
+            if last is None:
+                break
 
     def getSummary(self, dc_id):
         """
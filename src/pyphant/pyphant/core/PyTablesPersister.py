@@ -50,14 +50,16 @@ sample:
 #units(unit,name)
 
 field:
-*data
+*data (.ENCODING of UTF-8 encoded strings)
 *error
 .unit = repr(field.unit)
+The arrays of a field may be external links to the arrays of the field
+with the same hash in another file, see saveField().
 UNLESS field.dimensions==INDEX:
 #dimensions(hash, id)
 """
 
-
+from __future__ import with_statement
 import tables
 from tables import StringCol, Col
 import sys
@@ -71,8 +73,150 @@ from pyphant.quantities import Quantity as PhysicalQuantity
 
 import scipy
 import logging
+import os
+import threading
+import atexit
 _logger = logging.getLogger("pyphant")
 
+# PyTables is not thread-safe, hence concurrent access to HDF5 files,
+# e.g. by the KnowledgeManager, has to be serialized using this lock:
+h5Lock = threading.RLock()
+
+# Maximum number of read only file handles kept open by openReadOnly():
+HANDLE_POOL_SIZE = 32
+
+
+class HandlePool(object):
+    """
+    Bounded pool of read only tables.File handles keyed by the real
+    path of the file. Opening an HDF5 file is expensive compared to
+    reading small nodes from it, hence the handles are kept open and
+    reused. The least recently used handle is closed once the pool is
+    full. A handle is reopened if the file has been replaced or
+    modified since it has been opened, nevertheless files written in
+    this process should be invalidated right away, which is done by
+    H5FileHandler. All methods have to be called holding h5Lock.
+    """
+    def __init__(self, size=HANDLE_POOL_SIZE):
+        from collections import OrderedDict
+        self.size = size
+        self._handles = OrderedDict()
+        self._stats = {'opens': 0, 'hits': 0, 'evictions': 0,
+                       'invalidations': 0}
+
+    def _signature(self, path):
+        stat = os.stat(path)
+        return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+    def get(self, filename):
+        """
+        Returns an open read only handle of the given file. The handle
+        must not be closed by the caller.
+        """
+        path = os.path.realpath(filename)
+        try:
+            signature = self._signature(path)
+        except OSError:
+            self.invalidate(path)
+            raise
+        try:
+            handle, known = self._handles.pop(path)
+        except KeyError:
+            pass
+        else:
+            if handle.isopen and known == signature:
+                self._handles[path] = (handle, known)
+                self._stats['hits'] += 1
+                return handle
+            self._close(handle)
+            self._stats['invalidations'] += 1
+        handle = tables.openFile(filename, 'r')
+        self._stats['opens'] += 1
+        self._handles[path] = (handle, signature)
+        self._evict()
+        return handle
+
+    def _close(self, handle):
+        if handle.isopen:
+            try:
+                handle.close()
+            except Exception:
+                _logger.warn("Could not close '%s'." % handle.filename)
+
+    def _evict(self):
+        while len(self._handles) > self.size:
+            handle, signature = self._handles.popitem(last=False)[1]
+            self._close(handle)
+            self._stats['evictions'] += 1
+
+    def owns(self, handle):
+        """
+        Returns whether the given handle is kept open by this pool.
+        """
+        path = os.path.realpath(handle.filename)
+        return path in self._handles and self._handles[path][0] is handle
+
+    def invalidate(self, filename):
+        """
+        Closes the pooled handle of the given file if there is one.
+        This has to happen before the file is written or deleted.
+        """
+        path = os.path.realpath(filename)
+        if path in self._handles:
+            self._close(self._handles.pop(path)[0])
+            self._stats['invalidations'] += 1
+
+    def clear(self):
+        """
+        Closes all pooled handles.
+        """
+        while self._handles:
+            self._close(self._handles.popitem()[1][0])
+            self._stats['invalidations'] += 1
+
+    def resize(self, size):
+        """
+        Sets the maximum number of pooled handles.
+        """
+        self.size = size
+        self._evict()
+
+    def get_stats(self):
+        """
+        Returns a dictionary with the counters of opened files, opens
+        avoided by reusing a pooled handle ('hits'), evictions and
+        invalidations as well as the current number of pooled handles.
+        """
+        stats = dict(self._stats)
+        stats['size'] = len(self._handles)
+        stats['max_size'] = self.size
+        return stats
+
+# Process-wide pool used by H5FileHandler and LazyFieldContainer:
+handlePool = HandlePool()
+
+
+def _closeHandlePool():
+    with h5Lock:
+        handlePool.clear()
+# runs before PyTables closes and reports the remaining open files
+atexit.register(_closeHandlePool)
+
+# Storage profiles for the arrays of FieldContainers, see saveArray():
+# 'fast' -- contiguous and uncompressed
+# 'compact' -- chunked and compressed with shuffling
+# 'z-stack' -- chunked per slice along the first axis, such that single
+#              images of a stack are read without touching the others,
+#              arrays with less than three dimensions are contiguous
+STORAGE_PROFILES = ['fast', 'compact', 'z-stack']
+DEFAULT_PROFILE = 'fast'
+if tables.which_lib_version('blosc') is not None:
+    COMPACT_FILTERS = tables.Filters(complevel=5, complib='blosc',
+                                     shuffle=True)
+else:
+    COMPACT_FILTERS = tables.Filters(complevel=5, complib='zlib',
+                                     shuffle=True)
+
 _reservedAttributes = (
     'longname', 'shortname', 'columns', 'creator', 'machine'
     )
@@ -166,7 +310,7 @@ def saveBaseAttributes(h5, workerGroup, worker):
     h5.setNodeAttr(workerGroup, "Annotations", worker._annotations)
 
 
-def saveResult(result, h5):
+def saveResult(result, h5, links=None, profile=None):
     hash, uriType = DataContainer.parseId(result.id)
     resId = u"result_" + hash
     try:
@@ -176,9 +320,9 @@ def saveResult(result, h5):
             "/results", resId, result.id.encode("utf-8")
             )
         if uriType == 'field':
-            saveField(h5, resultGroup, result)
+            saveField(h5, resultGroup, result, links, profile)
         elif uriType == 'sample':
-            saveSample(h5, resultGroup, result)
+            saveSample(h5, resultGroup, result, links, profile)
         else:
             raise KeyError(
                 "Unknown UriType %s in saving result %s." % (
@@ -188,7 +332,7 @@ def saveResult(result, h5):
     return resId
 
 
-def saveSample(h5, resultGroup, result):
+def saveSample(h5, resultGroup, result, links=None, profile=None):
     h5.setNodeAttr(resultGroup, "longname", result.longname.encode("utf-8"))
     h5.setNodeAttr(resultGroup, "shortname", result.shortname.encode("utf-8"))
     h5.setNodeAttr(resultGroup, "creator", result.creator.encode("utf-8"))
@@ -202,11 +346,98 @@ def saveSample(h5, resultGroup, result):
     #Store fields of sample Container and gather list of field IDs
     columns = []
     for column in result.columns:
-        columns.append(saveResult(column, h5))
+        columns.append(saveResult(column, h5, links, profile))
     h5.setNodeAttr(resultGroup, "columns", columns)
 
 
-def saveField(h5, resultGroup, result):
+def linkArray(h5, resultGroup, name, filename):
+    """
+    Creates an external link resultGroup/name to the array of the same
+    path in the given file. The link is stored relative to the directory
+    of h5, so that both files may be moved together.
+    """
+    path = os.path.relpath(os.path.realpath(filename),
+                           os.path.dirname(os.path.realpath(h5.filename)))
+    target = u"%s:%s/%s" % (path, resultGroup._v_pathname, name)
+    h5.createExternalLink(resultGroup, name, target.encode("utf-8"))
+
+
+def getArrayNode(node, name):
+    """
+    Returns the array 'data', 'error' or 'mask' of the field stored at
+    node, following external links, see saveField(). Raises
+    tables.NoSuchNodeError if the array is not present.
+    """
+    arrayNode = getattr(node, name)
+    while isinstance(arrayNode, tables.link.ExternalLink):
+        arrayNode = arrayNode(mode='r')
+    return arrayNode
+
+
+def saveArray(h5, resultGroup, name, array, title, profile=None):
+    """
+    Creates the array resultGroup/name according to the given storage
+    profile, see STORAGE_PROFILES. Scalars and empty arrays are always
+    stored contiguously, as are arrays with less than three dimensions
+    using the 'z-stack' profile, which would get a chunk per element or
+    row otherwise. Arrays of all profiles are read alike.
+    profile -- name of the storage profile, None means DEFAULT_PROFILE
+    """
+    if profile is None:
+        profile = DEFAULT_PROFILE
+    if profile not in STORAGE_PROFILES:
+        raise ValueError("Unknown storage profile '%s'." % (profile, ))
+    if profile == 'fast' or array.ndim == 0 or array.size == 0 \
+           or array.dtype.char in ['U', 'O'] \
+           or (profile == 'z-stack' and array.ndim < 3):
+        return h5.createArray(resultGroup, name, array, title)
+    if profile == 'compact':
+        filters = COMPACT_FILTERS
+        chunkshape = None
+    else:
+        filters = None
+        chunkshape = (1, ) + array.shape[1:]
+    node = h5.createCArray(resultGroup, name,
+                           tables.Atom.from_dtype(array.dtype), array.shape,
+                           title, filters=filters, chunkshape=chunkshape)
+    node[:] = array
+    return node
+
+
+def encodeStrings(array):
+    """
+    Returns a tuple (byte string array, encoding) for the given string
+    array. Unicode arrays are encoded as UTF-32-LE with a fixed width,
+    which is the memory layout of numpy unicode arrays, such that
+    decodeStrings() just reinterprets the bytes. Byte strings are
+    stored as they are and taken to be UTF-8 encoded.
+    """
+    if array.dtype.char == 'S':
+        return array, 'utf-8'
+    width = array.dtype.itemsize // 4
+    array = scipy.ascontiguousarray(array, dtype='<U%d' % width)
+    return array.view('S%d' % (4 * width)), 'utf-32-le'
+
+
+def decodeStrings(array, encoding):
+    """
+    Returns the unicode array encoded by encodeStrings().
+    """
+    if encoding == 'utf-32-le':
+        return scipy.ascontiguousarray(array).view(
+            '<U%d' % (array.dtype.itemsize // 4))
+    return scipy.char.decode(array, encoding)
+
+
+def saveField(h5, resultGroup, result, links=None, profile=None):
+    """
+    Saves the FieldContainer result to resultGroup.
+    links -- dictionary that maps hashes of FieldContainers to HDF5
+             files that store them already. If result.hash is among
+             them, its arrays are saved as external links to that file
+             instead of copies. The same applies to the dimensions.
+    profile -- storage profile of the arrays, see saveArray()
+    """
     def dump(inputList):
         def conversion(arg):
             if type(arg) == type(u' '):
@@ -217,28 +448,44 @@ def saveField(h5, resultGroup, result):
             return map(conversion, inputList)
         else:
             return map(dump, inputList)
-    if result.data.dtype.char in ['U', 'O']:
+    linked = links is not None and result.hash in links
+    if linked:
+        # the attributes are stored with the linked data array
+        for name in ['data', 'error', 'mask']:
+            if getattr(result, name) is not None:
+                linkArray(h5, resultGroup, name, links[result.hash])
+    elif result.data.dtype.char in ['U', 'S']:
+        stringData, encoding = encodeStrings(result.data)
+        saveArray(h5, resultGroup, "data", stringData,
+                  result.longname.encode("utf-8"), profile)
+        # ENCODING is a system attribute, which distinguishes the
+        # encoded strings from the repr strings of object arrays
+        h5.setNodeAttr(resultGroup.data, "ENCODING", encoding)
+    elif result.data.dtype.char == 'O':
         unicodeData = scipy.array(dump(result.data.tolist()))
         h5.createArray(
             resultGroup, "data", unicodeData, result.longname.encode("utf-8")
             )
     else:
-        h5.createArray(
-            resultGroup, "data", result.data, result.longname.encode("utf-8")
-            )
-    for key, value in result.attributes.iteritems():
-        h5.setNodeAttr(resultGroup.data, key, value)
+        saveArray(h5, resultGroup, "data", result.data,
+                  result.longname.encode("utf-8"), profile)
+    if not linked:
+        for key, value in result.attributes.iteritems():
+            h5.setNodeAttr(resultGroup.data, key, value)
     h5.setNodeAttr(resultGroup, "longname", result.longname.encode("utf-8"))
     h5.setNodeAttr(resultGroup, "shortname", result.shortname.encode("utf-8"))
     h5.setNodeAttr(resultGroup, "creator", result.creator.encode("utf-8"))
     h5.setNodeAttr(resultGroup, "machine", result.machine.encode("utf-8"))
 
-    if result.error != None:
-        h5.createArray(resultGroup, "error", result.error,
-                       (u"Error of " + result.longname).encode("utf-8"))
-    if result.mask != None:
-        h5.createArray(resultGroup, "mask", result.mask,
-                       (u"Mask of " + result.longname).encode("utf-8"))
+    if not linked:
+        if result.error != None:
+            saveArray(h5, resultGroup, "error", result.error,
+                      (u"Error of " + result.longname).encode("utf-8"),
+                      profile)
+        if result.mask != None:
+            saveArray(h5, resultGroup, "mask", result.mask,
+                      (u"Mask of " + result.longname).encode("utf-8"),
+                      profile)
     h5.setNodeAttr(resultGroup, "unit", repr(result.unit).encode("utf-8"))
     if result.dimensions != DataContainer.INDEX:
         idLen = max([len(dim.id.encode("utf-8")) for dim in result.dimensions])
@@ -253,7 +500,7 @@ def saveField(h5, resultGroup, result):
             d["hash"] = dim.hash.encode("utf-8")
             d["id"] = dim.id.encode("utf-8")
             d.append()
-            saveResult(dim, h5)
+            saveResult(dim, h5, links, profile)
         dimTable.flush()
 
 
@@ -367,7 +614,172 @@ def restoreResultsToWorkers(recipeGroup, workers, h5):
                 _logger.info("Exception: " + str(e))
 
 
-def loadField(h5, resNode):
+def _loads(inputList):
+    if type(inputList) == type([]):
+        try:
+            return map(lambda s: eval(s), inputList)
+        except:
+            return map(lambda s: unicode(s, 'utf-8'), inputList)
+    else:
+        return map(_loads, inputList)
+
+
+def _loadArray(node, name, key=None):
+    """
+    Reads the array 'data', 'error' or 'mask' of the field stored at
+    node and returns it or None if it is not present.
+    key -- tuple of slices in order to read a hyperslab only
+    """
+    try:
+        arrayNode = getArrayNode(node, name)
+    except tables.NoSuchNodeError:
+        return None
+    if key is None:
+        array = scipy.array(arrayNode.read())
+    else:
+        array = scipy.array(arrayNode[key])
+    if name == 'data' and array.dtype.char == 'S':
+        if 'ENCODING' in arrayNode._v_attrs:
+            array = decodeStrings(array, arrayNode._v_attrs.ENCODING)
+        else:
+            # object arrays and strings saved by former versions
+            array = scipy.array(_loads(array.tolist()))
+    return array
+
+
+class LazyFieldContainer(DataContainer.FieldContainer):
+    """
+    Sealed FieldContainer returned by loadField(h5, resNode, lazy=True).
+    The meta data and the dimensions are available right away, whereas
+    data, error and mask are read from the HDF5 file upon first access.
+    Slicing an instance whose arrays have not been read yet reads the
+    requested hyperslab only, see FieldContainer.__getitem__().
+    These reads use the file handle the instance has been loaded with
+    as long as it is open and open the file read only otherwise, so the
+    file does not need to be kept open while the instance is in use.
+    Instances loaded from a handle of the HandlePool use the pool
+    instead.
+    """
+    _arrayNames = ('data', 'error', 'mask')
+
+    def __init__(self, h5, resNode, unit, dimensions, longname, shortname,
+                 attributes):
+        DataContainer.DataContainer.__init__(self, longname, shortname,
+                                             attributes)
+        self.unit = unit
+        self.dimensions = dimensions
+        self._h5 = h5
+        self._filename = h5.filename
+        self._pooled = handlePool.owns(h5)
+        self._nodePath = resNode._v_pathname
+        self._storedArrays = []
+        self._nbytes = 0
+        self._shape = getArrayNode(resNode, 'data').shape
+        for name in self._arrayNames:
+            try:
+                node = getArrayNode(resNode, name)
+            except tables.NoSuchNodeError:
+                continue
+            self._storedArrays.append(name)
+            if name == 'data':
+                nbytes = node.atom.itemsize
+                for length in node.shape:
+                    nbytes *= length
+                self._nbytes = nbytes
+
+    def _getArray(self, name):
+        try:
+            return self.__dict__['_' + name]
+        except KeyError:
+            pass
+        with self.lock:
+            if '_' + name not in self.__dict__:
+                array = self._read(name)
+                if array is not None:
+                    array.setflags(write=False)
+                self.__dict__['_' + name] = array
+        return self.__dict__['_' + name]
+
+    def _read(self, name, key=None):
+        if name not in self._storedArrays:
+            return None
+        with h5Lock:
+            if self._h5.isopen:
+                return _loadArray(self._h5.getNode(self._nodePath), name,
+                                  key)
+            if self._pooled:
+                h5 = handlePool.get(self._filename)
+                return _loadArray(h5.getNode(self._nodePath), name, key)
+            h5 = tables.openFile(self._filename, 'r')
+            try:
+                return _loadArray(h5.getNode(self._nodePath), name, key)
+            finally:
+                h5.close()
+
+    data = property(lambda self: self._getArray('data'))
+    error = property(lambda self: self._getArray('error'))
+    mask = property(lambda self: self._getArray('mask'))
+
+    def _getDataShape(self):
+        return self._shape
+
+    def _sliceArrays(self, args):
+        if '_data' in self.__dict__ or False in [
+            isinstance(arg, slice) and (arg.step is None or arg.step > 0) \
+                for arg in args]:
+            return DataContainer.FieldContainer._sliceArrays(self, args)
+        with self.lock:
+            return tuple([self._read(name, tuple(args)) \
+                              for name in self._arrayNames])
+
+    def _getRawDataBytes(self):
+        if '_data' in self.__dict__:
+            nbytes = self._data.nbytes
+        else:
+            nbytes = self._nbytes
+        return nbytes + sum([dim.rawDataBytes for dim in self.dimensions])
+    rawDataBytes = property(_getRawDataBytes)
+
+    def isLoaded(self):
+        """
+        Returns whether data, error and mask have been read already.
+        """
+        return False not in ['_' + name in self.__dict__ \
+                                 for name in self._arrayNames]
+
+    def load(self):
+        """
+        Reads data, error and mask if this has not happened yet.
+        """
+        for name in self._arrayNames:
+            self._getArray(name)
+
+    def seal(self, id=None):
+        DataContainer.DataContainer.seal(self, id)
+
+    def __getstate__(self):
+        self.load()
+        dict = DataContainer.FieldContainer.__getstate__(self)
+        del dict['_h5']
+        return dict
+
+
+def loadField(h5, resNode, lazy=False, fields=None):
+    """
+    Loads the FieldContainer stored at resNode.
+    lazy -- whether to return a LazyFieldContainer that reads its
+            arrays upon first access. The dimensions are loaded lazily
+            as well. Fields stored without emd5 are always loaded
+            completely, since their hash has to be computed.
+    fields -- identity map, i.e. a dictionary or WeakValueDictionary
+              that maps tuples (emd5, lazy) to loaded FieldContainers.
+              Dimensions found in the map are used instead of being
+              loaded again, such that dimensions shared by many fields
+              are read once and the same instance is used by all of
+              them. A map local to this call is used if None is given.
+    """
+    if fields is None:
+        fields = {}
     longname = unicode(h5.getNodeAttr(resNode, "longname"), 'utf-8')
     shortname = unicode(h5.getNodeAttr(resNode, "shortname"), 'utf-8')
     try:
@@ -378,53 +790,56 @@ def loadField(h5, resNode):
         emd5dict = emd52dict(resNode._v_title)
         creator = emd5dict['creator']
         machine = emd5dict['machine']
-    data = scipy.array(resNode.data.read())
-
-    def loads(inputList):
-        if type(inputList) == type([]):
-            try:
-                return map(lambda s: eval(s), inputList)
-            except:
-                return map(lambda s: unicode(s, 'utf-8'), inputList)
-        else:
-            return map(loads, inputList)
-    if data.dtype.char == 'S':
-        data = scipy.array(loads(data.tolist()))
     attributes = {}
-    for key in resNode.data._v_attrs._v_attrnamesuser:
-        attributes[key] = h5.getNodeAttr(resNode.data, key)
-    try:
-        error = scipy.array(resNode.error.read())
-    except tables.NoSuchNodeError:
-        error = None
-    try:
-        mask = scipy.array(resNode.mask.read())
-    except tables.NoSuchNodeError:
-        mask = None
+    dataNode = getArrayNode(resNode, 'data')
+    for key in dataNode._v_attrs._v_attrnamesuser:
+        attributes[key] = dataNode._v_attrs[key]
     unit = eval(unicode(h5.getNodeAttr(resNode, "unit"), 'utf-8'))
     try:
         dimTable = resNode.dimensions
-        dimensions = [
-            loadField(
-                h5,
-                h5.getNode(
-                    "/results/result_" + DataContainer.parseId(row['id'])[0]
+        dimensions = []
+        for row in dimTable.iterrows():
+            dimension = fields.get((row['id'], lazy))
+            if dimension is None:
+                dimension = loadField(
+                    h5,
+                    h5.getNode(
+                        "/results/result_" \
+                            + DataContainer.parseId(row['id'])[0]
+                        ),
+                    lazy, fields
                     )
-                )
-            for row in dimTable.iterrows()
-            ]
+            dimensions.append(dimension)
     except tables.NoSuchNodeError:
         dimensions = DataContainer.INDEX
-    result = DataContainer.FieldContainer(data, unit, error, mask,
-                                          dimensions, longname, shortname,
-                                          attributes)
+    if lazy and resNode._v_title:
+        result = LazyFieldContainer(h5, resNode, unit, dimensions, longname,
+                                    shortname, attributes)
+    else:
+        data = _loadArray(resNode, 'data')
+        error = _loadArray(resNode, 'error')
+        mask = _loadArray(resNode, 'mask')
+        result = DataContainer.FieldContainer(data, unit, error, mask,
+                                              dimensions, longname,
+                                              shortname, attributes)
     result.creator = creator
     result.machine = machine
     result.seal(resNode._v_title)
+    if resNode._v_title:
+        fields[(resNode._v_title, lazy)] = result
     return result
 
 
-def loadSample(h5, resNode):
+def loadSample(h5, resNode, lazy=False, fields=None):
+    """
+    Loads the SampleContainer stored at resNode.
+    lazy -- whether to load the FieldContainer columns lazily,
+            see loadField()
+    fields -- identity map shared by the columns and their dimensions,
+              see loadField()
+    """
+    if fields is None:
+        fields = {}
     result = DataContainer.SampleContainer.__new__(
         DataContainer.SampleContainer
         )
@@ -452,7 +867,7 @@ def loadSample(h5, resNode):
                     uriType, result.id
                     )
                 )
-        columns.append(loader(h5, h5.getNode(nodename)))
+        columns.append(loader(h5, h5.getNode(nodename), lazy, fields))
     result.columns = columns
     result.seal(resNode._v_title)
     return result
@@ -473,3 +888,6 @@ def loadExecutionOrders(h5):
 def pruneResults(h5):
     h5.removeNode("/results", recursive=True)
     h5.createGroup("/", "results")
+    if "/summary" in h5:
+        # see H5FileHandler.loadSummary()
+        h5.removeNode("/summary")
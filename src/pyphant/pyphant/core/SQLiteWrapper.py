@@ -38,14 +38,233 @@ to an SQLite3 database.
 """
 
 import sqlite3
+import threading
+import weakref
+import os
+from contextlib import contextmanager
+from copy import deepcopy
 import time  # needed for eval ??
+from ast import literal_eval
+import re
 from pyphant.core.Helpers import (utf82uc, emd52dict)
 from pyphant.quantities import (Quantity, PhysicalUnit, _base_units)
 PhysicalQuantity = Quantity
 from types import (FloatType, IntType, LongType, StringTypes)
 
 # increment if there have been structural changes to the dbase!
-DBASE_VERSION = 2
+DBASE_VERSION = 7
+# secondary indexes (index name, table name, columns) supporting the
+# queries generated by SQLiteWrapper.get_andsearch_query() and
+# SQLiteWrapper.delete_file():
+INDEXES = [('idx_fc_longname', 'km_fc', ['longname']),
+           ('idx_fc_shortname', 'km_fc', ['shortname']),
+           ('idx_fc_machine', 'km_fc', ['machine']),
+           ('idx_fc_creator', 'km_fc', ['creator']),
+           ('idx_fc_date', 'km_fc', ['date']),
+           ('idx_fc_hash', 'km_fc', ['hash']),
+           ('idx_fc_storage', 'km_fc', ['storage']),
+           ('idx_fc_bu_id', 'km_fc', ['bu_id']),
+           ('idx_sc_longname', 'km_sc', ['longname']),
+           ('idx_sc_shortname', 'km_sc', ['shortname']),
+           ('idx_sc_machine', 'km_sc', ['machine']),
+           ('idx_sc_creator', 'km_sc', ['creator']),
+           ('idx_sc_date', 'km_sc', ['date']),
+           ('idx_sc_hash', 'km_sc', ['hash']),
+           ('idx_sc_storage', 'km_sc', ['storage']),
+           ('idx_attributes_key_value', 'km_attributes', ['key', 'value']),
+           ('idx_attributes_key_num', 'km_attributes',
+            ['key', 'bu_id', 'num']),
+           ('idx_fc_dimensions_dim_id', 'km_fc_dimensions',
+            ['dim_id', 'dim_index']),
+           ('idx_sc_columns_fc_id', 'km_sc_columns', ['fc_id', 'fc_index'])]
+# versions of the dbase that can be upgraded in place by creating the
+# secondary indexes:
+UPGRADABLE_VERSIONS = [3, 4, 5, 6]
+# matches the __repr__() of Quantities:
+QUANTITY_REPR = re.compile(r"^Quantity(\(.*\))$")
+# relational operators for numerical attribute searches:
+ATTR_OPERATORS = {'==': '=', '!=': '!=', '<': '<', '<=': '<=',
+                  '>': '>', '>=': '>='}
+# size of the prepared statement cache of each pooled connection:
+CACHED_STATEMENTS = 256
+
+
+class PooledConnection(object):
+    """
+    Connection that is kept open by the per thread connection pool.
+    depth counts the nested SQLiteWrapper scopes using the connection,
+    generation is compared against the pool generation of the database
+    in order to detect connections that have been invalidated.
+    """
+    def __init__(self, connection, generation):
+        self.connection = connection
+        self.generation = generation
+        self.depth = 0
+        self.pending_bu_ids = {}
+
+
+_pool = threading.local()
+_pool_generations = {}
+# guards the pool state shared by all threads and is notified whenever
+# a pooled connection becomes idle or exclusive_access() ends:
+_pool_lock = threading.Condition()
+# database -> pooled connections of all threads, see exclusive_access():
+_pool_members = {}
+# database -> thread within exclusive_access():
+_pool_owners = {}
+# database -> {base unit powers: bu_id}, see SQLiteWrapper.get_bu_ids():
+_bu_id_cache = {}
+_bu_id_lock = threading.Lock()
+
+
+def connect(database, timeout):
+    """
+    Returns a new sqlite3 connection to the given database with WAL
+    journaling enabled, so that readers do not block the writer.
+    Transactions are not started implicitly by the sqlite3 module
+    but by SQLiteWrapper, see SQLiteWrapper.__enter__().
+    The connection is used by a single thread at a time but may be
+    closed by any thread, see exclusive_access().
+    """
+    connection = sqlite3.connect(database, timeout,
+                                 detect_types=sqlite3.PARSE_COLNAMES,
+                                 cached_statements=CACHED_STATEMENTS,
+                                 isolation_level=None,
+                                 check_same_thread=False)
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+    except sqlite3.DatabaseError:
+        pass  # e.g. read only file system, use default journal
+    return connection
+
+
+def _get_pool():
+    try:
+        return _pool.connections
+    except AttributeError:
+        _pool.connections = {}
+        return _pool.connections
+
+
+def acquire_connection(database, timeout):
+    """
+    Returns the PooledConnection of the calling thread for the given
+    database and increments its depth. A new connection is opened if
+    there is none yet or if it has been invalidated by
+    close_connections(). Outside of nested scopes, this waits while
+    another thread has exclusive access to the database.
+    """
+    connections = _get_pool()
+    current = threading.current_thread()
+    with _pool_lock:
+        pooled = connections.get(database)
+        if pooled is None or pooled.depth == 0:
+            while _pool_owners.get(database, current) is not current:
+                _pool_lock.wait()
+            generation = _pool_generations.get(database, 0)
+            if pooled is not None and pooled.generation != generation:
+                pooled.connection.close()
+                pooled = None
+            if pooled is None:
+                pooled = PooledConnection(connect(database, timeout),
+                                          generation)
+                connections[database] = pooled
+                _pool_members.setdefault(database,
+                                         weakref.WeakSet()).add(pooled)
+        pooled.depth += 1
+        return pooled
+
+
+def release_connection(pooled):
+    """
+    Decrements the depth of the given PooledConnection and returns
+    whether the outermost scope has been left.
+    """
+    with _pool_lock:
+        pooled.depth -= 1
+        if pooled.depth == 0:
+            _pool_lock.notify_all()
+            return True
+        return False
+
+
+@contextmanager
+def exclusive_access(database):
+    """
+    Closes the pooled connections of all threads to the given database
+    and keeps other threads from opening new ones until the with-block
+    has been left, e.g. in order to move or replace the database file.
+    Connections that are in use by other threads are waited for. The
+    calling thread may use the database within the with-block.
+    """
+    current = threading.current_thread()
+    own = _get_pool().get(database)
+    assert own is None or own.depth == 0
+    with _pool_lock:
+        while database in _pool_owners:
+            _pool_lock.wait()
+        _pool_owners[database] = current
+        _pool_generations[database] = _pool_generations.get(database, 0) + 1
+        members = _pool_members.pop(database, weakref.WeakSet())
+        while [pooled for pooled in members if pooled.depth > 0]:
+            _pool_lock.wait()
+        for pooled in list(members):
+            pooled.connection.close()
+    _get_pool().pop(database, None)
+    try:
+        yield
+    finally:
+        with _pool_lock:
+            del _pool_owners[database]
+            _pool_lock.notify_all()
+
+
+def close_connections(database):
+    """
+    Closes the pooled connections of all threads to the given database,
+    see exclusive_access().
+    """
+    with exclusive_access(database):
+        pass
+
+
+def move_database(database, destination, timeout=60.0):
+    """
+    Moves the given database file to destination after its write-ahead
+    log has been checkpointed, along with the -wal and -shm files that
+    remain if other processes still use the database. Files at the
+    destination are replaced. This has to be called within
+    exclusive_access(database).
+    """
+    connection = connect(database, timeout)
+    try:
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        connection.close()
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(destination + suffix):
+            os.remove(destination + suffix)
+        if os.path.exists(database + suffix):
+            os.rename(database + suffix, destination + suffix)
+
+
+def get_cached_bu_ids(database):
+    """
+    Returns a copy of the committed base unit ids of the given database.
+    """
+    with _bu_id_lock:
+        return _bu_id_cache.get(database, {}).copy()
+
+
+def cache_bu_ids(database, bu_ids):
+    with _bu_id_lock:
+        _bu_id_cache.setdefault(database, {}).update(bu_ids)
+
+
+def clear_bu_id_cache(database):
+    with _bu_id_lock:
+        _bu_id_cache.pop(database, None)
 
 
 def quantity2powers(quantity):
@@ -169,6 +388,107 @@ def create_table(table_name, columns, cursor, ignore_exists=False):
     cursor.execute(query)
 
 
+def bump_generation(cursor):
+    cursor.execute("UPDATE db_info SET generation=generation+1")
+
+
+def create_index(index_name, table_name, columns, cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" \
+                       % (index_name, table_name, ", ".join(columns)))
+
+
+def attr2number(value):
+    """
+    Returns a tuple (number, powers) for numerical attribute values,
+    where number is the value in base units and powers are the base unit
+    powers as returned by quantity2powers(). Returns None for all other
+    values.
+    """
+    if isinstance(value, Quantity):
+        value = value.inBaseUnits()
+        try:
+            return (float(value.value), quantity2powers(value))
+        except TypeError:
+            return None  # array valued quantity
+    elif isinstance(value, (FloatType, IntType, LongType)) \
+             and not isinstance(value, bool):
+        return (float(value), quantity2powers(value))
+    return None
+
+
+def repr2attr(value):
+    """Inverse of value.__repr__() for attribute values that are
+    literals or Quantities, returns None for all other values."""
+    match = QUANTITY_REPR.match(value)
+    try:
+        if match is not None:
+            return Quantity(*literal_eval(match.group(1)))
+        return literal_eval(value)
+    except (ValueError, SyntaxError, TypeError):
+        return None
+
+
+def get_attr_constraints(value):
+    """
+    Returns the list of tuples (operator, operand) of an attribute
+    search value that is either one such tuple or a list of them, where
+    operator is a key of ATTR_OPERATORS. Returns None for any other
+    value.
+    """
+    if isinstance(value, tuple):
+        value = [value]
+    if not isinstance(value, list) or value == []:
+        return None
+    for constraint in value:
+        if not (isinstance(constraint, tuple) and len(constraint) == 2 \
+                    and constraint[0] in ATTR_OPERATORS):
+            return None
+    return value
+
+
+def attr2text(value):
+    """Returns the text of an attribute value for the full-text index."""
+    if isinstance(value, StringTypes):
+        return utf82uc(value)
+    return unicode(value)
+
+
+def text2match(text):
+    """
+    Translates the given text to an FTS5 query that matches all
+    documents containing each of its words. Words ending with '*' match
+    all words starting with the same characters. Any other FTS5 syntax
+    is quoted.
+    """
+    terms = []
+    for word in utf82uc(text).split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word != u'':
+            term = u'"%s"' % word.replace(u'"', u'""')
+            if prefix:
+                term += u'*'
+            terms.append(term)
+    return u' '.join(terms)
+
+
+def text2like(text):
+    """
+    Translates the given text to a list of LIKE patterns, one for each
+    of its words, for databases without full-text index. A trailing
+    '*' is dropped since the patterns match any part of a word anyway.
+    The escape character of the patterns is '\\'.
+    """
+    patterns = []
+    for word in utf82uc(text).split():
+        word = word.rstrip('*')
+        if word != u'':
+            for char in u'\\%_':
+                word = word.replace(char, u'\\' + char)
+            patterns.append(u'%%%s%%' % word)
+    return patterns
+
+
 def create_trigger(trigger_name, action, table_name,
                   statements, cursor):
     query = "CREATE TRIGGER %s AFTER %s ON %s "\
@@ -202,44 +522,137 @@ class SQLiteWrapper(object):
                               'creator', 'hash', 'storage']
     one_to_one_result_keys = one_to_one_search_keys + ['date', 'id', 'type']
     common_search_keys = one_to_one_search_keys + \
-                         ['id', 'attributes', 'date_from', 'date_to', 'col_of']
+                         ['id', 'attributes', 'date_from', 'date_to',
+                          'col_of', 'text']
     fc_search_keys = common_search_keys + ['unit', 'dimensions',
                                            'dim_of', 'has_dim']
     sc_search_keys = common_search_keys + ['columns', 'has_col']
-    sortable_keys = common_keys + ['storage', 'type']
+    sortable_keys = common_keys + ['storage', 'type', 'rank']
+    # result keys that require a 'text' search key:
+    text_result_keys = ['rank']
     any_value = AnyValue()
 
-    def __init__(self, database, timeout=60.0):
+    def __init__(self, database, timeout=60.0, pooled=True, immediate=False):
         """
         Arguments:
         - database: database to connect to
+        - timeout: seconds to wait for a lock on the database
+        - pooled: whether to use the long-lived connection of the calling
+                  thread instead of opening a new one
+        - immediate: whether to acquire the write lock of the database
+                     at the beginning of the transaction. Use this for
+                     transactions that read before they write, otherwise
+                     concurrent writers may fail with 'database is locked'.
+                     Only applies to the outermost block.
+        Each with-block is a transaction scope: Changes are committed when
+        the outermost block using the same pooled connection is left
+        and rolled back if it is left by an exception. Nested blocks
+        share the transaction of the outermost block. Use commit() to
+        split long running write operations into several transactions
+        and savepoint() to make a group of statements atomic within the
+        current transaction.
         """
         self.database = database
         self.timeout = timeout
+        self.pooled = pooled
+        self.immediate = immediate
         self.connection = None
         self.cursor = None
+        self._pooled_connection = None
+        self._pending_bu_ids = {}
 
     def __enter__(self):
         assert self.connection == None
         assert self.cursor == None
-        self.connection = sqlite3.connect(self.database, self.timeout,
-                                          detect_types=sqlite3.PARSE_COLNAMES)
+        if self.pooled:
+            self._pooled_connection = acquire_connection(self.database,
+                                                         self.timeout)
+            self.connection = self._pooled_connection.connection
+            outermost = self._pooled_connection.depth == 1
+        else:
+            self.connection = connect(self.database, self.timeout)
+            outermost = True
         self.cursor = self.connection.cursor()
+        if outermost:
+            self._begin()
         return self
 
+    def _begin(self):
+        if self.immediate:
+            self.cursor.execute("BEGIN IMMEDIATE")
+        else:
+            self.cursor.execute("BEGIN")
+
     def __exit__(self, type, value, traceback):
-        if type == None:
-            try:
-                self.connection.commit()
-            except:
-                print "Could not commit changes to database."
         if hasattr(self.cursor, 'close'):
             self.cursor.close()
-        if hasattr(self.connection, 'close'):
+        pending = self._get_pending_bu_ids()
+        if self.pooled:
+            # the connection is released after the commit, since idle
+            # connections may be closed by exclusive_access()
+            outermost = self._pooled_connection.depth == 1
+        else:
+            outermost = True
+        if outermost:
+            if type == None:
+                try:
+                    self.connection.execute("COMMIT")
+                    cache_bu_ids(self.database, pending)
+                except sqlite3.Error:
+                    print "Could not commit changes to database."
+                    self._rollback()
+            else:
+                self._rollback()
+            pending.clear()
+        if self.pooled:
+            release_connection(self._pooled_connection)
+            self._pooled_connection = None
+        else:
             self.connection.close()
         self.cursor = None
         self.connection = None
 
+    def _rollback(self):
+        try:
+            self.connection.execute("ROLLBACK")
+        except sqlite3.OperationalError:
+            pass  # transaction has already been rolled back by sqlite
+
+    def commit(self):
+        """
+        Commits all changes made so far, including those of enclosing
+        with-blocks, and starts a new transaction.
+        """
+        self.cursor.execute("COMMIT")
+        pending = self._get_pending_bu_ids()
+        cache_bu_ids(self.database, pending)
+        pending.clear()
+        self._begin()
+
+    def _get_pending_bu_ids(self):
+        # base unit ids inserted by the current transaction, they are
+        # cached only after the transaction has been committed
+        if self._pooled_connection is not None:
+            return self._pooled_connection.pending_bu_ids
+        return self._pending_bu_ids
+
+    @contextmanager
+    def savepoint(self, name='sp'):
+        """
+        Context manager that rolls back the changes made within its
+        block if the block is left by an exception. The exception is
+        reraised and the enclosing transaction stays intact.
+        """
+        self.cursor.execute("SAVEPOINT %s" % name)
+        try:
+            yield self
+        except:
+            self.cursor.execute("ROLLBACK TO %s" % name)
+            self.cursor.execute("RELEASE %s" % name)
+            self._get_pending_bu_ids().clear()
+            raise
+        self.cursor.execute("RELEASE %s" % name)
+
     def __getitem__(self, emd5):
         if self.has_entry(emd5):
             if emd5.endswith('field'):
@@ -253,8 +666,10 @@ class SQLiteWrapper(object):
         sqlite3.register_converter('LATEX', dbase2latex)
         #clean tmp:
         self.cursor.execute("DELETE FROM km_temporary")
+        self.bump_generation()
 
     def setup_dbase(self):
+        clear_bu_id_cache(self.database)
         #create tables:
         columns = [('sc_id', 'TEXT PRIMARY KEY UNIQUE NOT NULL'),
                    ('longname', 'TEXT'),
@@ -284,6 +699,8 @@ class SQLiteWrapper(object):
         columns = [('dc_id', 'TEXT NOT NULL'),
                    ('key', 'TEXT NOT NULL'),
                    ('value', 'TEXT'),
+                   ('num', 'REAL'),
+                   ('bu_id', 'INT'),
                    ('', 'UNIQUE(dc_id, key)'),
                    ('', 'PRIMARY KEY(dc_id, key)')]
         create_table('km_attributes', columns, self.cursor)
@@ -304,7 +721,13 @@ class SQLiteWrapper(object):
                    ('bit', 'INT'),
                    ('', 'UNIQUE(m, g, s, A, K, mol, cd, rad, sr, EUR,bit)')]
         create_table('km_base_units', columns, self.cursor)
-        columns = [('version', 'INT')]
+        columns = [('path', 'TEXT PRIMARY KEY UNIQUE NOT NULL'),
+                   ('size', 'INT'),
+                   ('mtime', 'REAL'),
+                   ('checksum', 'TEXT')]
+        create_table('km_files', columns, self.cursor)
+        columns = [('version', 'INT'),
+                   ('generation', 'INT NOT NULL DEFAULT 0')]
         create_table('db_info', columns, self.cursor)
         self.cursor.execute("INSERT INTO db_info (version) VALUES (?)",
                             (DBASE_VERSION, ))
@@ -321,15 +744,140 @@ class SQLiteWrapper(object):
                       ['DELETE FROM km_fc WHERE fc_id=OLD.dc_id',
                        'DELETE FROM km_sc WHERE sc_id=OLD.dc_id'],
                       self.cursor)
+        self.create_indexes()
+        self.create_fulltext()
         self.setup_sqlite()
 
-    def dbase_broken(self):
+    def create_indexes(self):
+        for index_name, table_name, columns in INDEXES:
+            create_index(index_name, table_name, columns, self.cursor)
+
+    def create_fulltext(self):
+        """Creates the full-text index of longnames, shortnames and
+        attributes and returns True, or returns False if sqlite3 has
+        been compiled without FTS5. Rows of km_fulltext are mapped to
+        emd5s by km_text.
+        """
         try:
-            self.cursor.execute("SELECT version FROM db_info")
-            version = self.cursor.fetchone()[0]
-            return version is not DBASE_VERSION
+            self.cursor.execute("CREATE VIRTUAL TABLE km_fulltext USING "\
+                                    "fts5(longname, shortname, attributes, "\
+                                    "prefix='2 3')")
         except sqlite3.OperationalError:
-            return True
+            return False
+        columns = [('text_id', 'INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL'),
+                   ('dc_id', 'TEXT UNIQUE NOT NULL')]
+        create_table('km_text', columns, self.cursor)
+        for type in ['fc', 'sc']:
+            create_trigger('trigger_del_%s_text' % type, 'DELETE',
+                           'km_%s' % type,
+                           ['DELETE FROM km_fulltext WHERE rowid IN '\
+                                '(SELECT text_id FROM km_text '\
+                                'WHERE dc_id=OLD.%s_id)' % type,
+                            'DELETE FROM km_text WHERE dc_id=OLD.%s_id' \
+                                % type],
+                           self.cursor)
+        return True
+
+    def has_fulltext(self):
+        self.cursor.execute("SELECT name FROM sqlite_master "\
+                                "WHERE type='table' AND name='km_fulltext'")
+        return self.cursor.fetchone() is not None
+
+    def set_fulltext(self, summaries):
+        """Adds the given summaries to the full-text index."""
+        self.cursor.executemany("INSERT OR IGNORE INTO km_text (dc_id) "\
+                                    "VALUES (?)",
+                                [(summary['id'], ) for summary in summaries])
+        rows = []
+        for summary in summaries:
+            attributes = u' '.join([u'%s %s' % (utf82uc(key), attr2text(value))
+                                    for key, value \
+                                        in summary['attributes'].iteritems()])
+            rows.append((utf82uc(summary.get('longname') or u''),
+                         utf82uc(summary.get('shortname') or u''),
+                         attributes, summary['id']))
+        self.cursor.executemany("INSERT INTO km_fulltext "\
+                                    "(rowid, longname, shortname, attributes) "\
+                                    "SELECT text_id, ?, ?, ? FROM km_text "\
+                                    "WHERE dc_id=?", rows)
+
+    def fill_attr_numbers(self):
+        """Sets the numerical columns of km_attributes from the values."""
+        self.cursor.execute("SELECT dc_id, key, value FROM km_attributes")
+        numbers = []
+        for dc_id, key, value in self.cursor.fetchall():
+            number = attr2number(repr2attr(value))
+            if number is not None:
+                numbers.append((dc_id, key, number))
+        bu_ids = self.get_bu_ids([powers for dc_id, key, (num, powers) \
+                                      in numbers])
+        self.cursor.executemany("UPDATE km_attributes SET num=?, bu_id=? "\
+                                    "WHERE dc_id=? AND key=?",
+                                [(num, bu_ids[powers], dc_id, key) \
+                                     for dc_id, key, (num, powers) \
+                                     in numbers])
+
+    def fill_fulltext(self):
+        """Adds all entries of the dbase to the full-text index."""
+        summaries = {}
+        for type in ['fc', 'sc']:
+            self.cursor.execute("SELECT %s_id, longname, shortname "\
+                                    "FROM km_%s" % (type, type))
+            for dc_id, longname, shortname in self.cursor.fetchall():
+                summaries[dc_id] = {'id': dc_id, 'longname': longname,
+                                    'shortname': shortname, 'attributes': {}}
+        self.cursor.execute("SELECT dc_id, key, value FROM km_attributes")
+        for dc_id, key, value in self.cursor.fetchall():
+            attr = repr2attr(value)
+            if attr is not None:
+                value = attr
+            if dc_id in summaries:
+                summaries[dc_id]['attributes'][key] = value
+        self.set_fulltext(summaries.values())
+
+    def get_dbase_version(self):
+        try:
+            self.cursor.execute("SELECT version FROM db_info")
+            return self.cursor.fetchone()[0]
+        except (sqlite3.OperationalError, TypeError):
+            return None
+
+    def dbase_broken(self):
+        return self.get_dbase_version() != DBASE_VERSION
+
+    def upgrade_dbase(self):
+        """Upgrades the dbase to DBASE_VERSION in place and returns True
+        if its version is listed in UPGRADABLE_VERSIONS, returns False
+        otherwise. In the latter case the dbase has to be rebuilt."""
+        if self.get_dbase_version() not in UPGRADABLE_VERSIONS:
+            return False
+        self.cursor.execute("PRAGMA table_info(db_info)")
+        if not 'generation' in [row[1] for row in self.cursor.fetchall()]:
+            self.cursor.execute("ALTER TABLE db_info ADD COLUMN "\
+                                    "generation INT NOT NULL DEFAULT 0")
+        self.cursor.execute("PRAGMA table_info(km_attributes)")
+        if not 'num' in [row[1] for row in self.cursor.fetchall()]:
+            self.cursor.execute("ALTER TABLE km_attributes "\
+                                    "ADD COLUMN num REAL")
+            self.cursor.execute("ALTER TABLE km_attributes "\
+                                    "ADD COLUMN bu_id INT")
+            self.fill_attr_numbers()
+        self.create_indexes()
+        if not self.has_fulltext() and self.create_fulltext():
+            self.fill_fulltext()
+        self.cursor.execute("UPDATE db_info SET version=?", (DBASE_VERSION, ))
+        self.bump_generation()
+        return True
+
+    def get_generation(self):
+        """Returns the generation of the dbase, which is incremented by
+        every transaction that changes search results. Search results
+        may be cached as long as the generation stays the same."""
+        self.cursor.execute("SELECT generation FROM db_info")
+        return self.cursor.fetchone()[0]
+
+    def bump_generation(self):
+        bump_generation(self.cursor)
 
     def has_entry(self, id):
         exe = self.cursor.execute
@@ -341,35 +889,57 @@ class SQLiteWrapper(object):
             (id, ))
         return self.cursor.fetchone() != None
 
+    def get_known_ids(self, ids):
+        """Returns the set of those of the given emd5s that already have
+        an entry in the database."""
+        ids = list(ids)
+        known = set()
+        chunk_size = 400  # sqlite allows 999 parameters per statement
+        for start in xrange(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            marks = ", ".join(["?"] * len(chunk))
+            self.cursor.execute("SELECT fc_id FROM km_fc WHERE fc_id IN (%s) "\
+                                    "UNION SELECT sc_id FROM km_sc "\
+                                    "WHERE sc_id IN (%s)" % (marks, marks),
+                                chunk + chunk)
+            known.update([row[0] for row in self.cursor.fetchall()])
+        return known
+
     def is_temporary(self, id):
         exe = self.cursor.execute
         exe("SELECT dc_id FROM km_temporary WHERE dc_id=?", (id, ))
         return self.cursor.fetchone() != None
 
-    def _set_fc_keys(self, insert_dict, summary):
-        exe = self.cursor.execute
-        insert_dict['fc_id'] = summary['id']
-        insert_dict['unit'] = quantity2dbase(summary['unit'])
-        try:
-            exe("INSERT OR ABORT INTO km_base_units "\
+    def get_bu_ids(self, powers_list):
+        """Returns a dictionary that maps each of the given tuples of
+        base unit powers (see quantity2powers()) to its bu_id, inserting
+        missing base units into the database. The ids are cached per
+        database, see _bu_id_cache.
+        """
+        cached = get_cached_bu_ids(self.database)
+        pending = self._get_pending_bu_ids()
+        bu_ids = {}
+        missing = []
+        for powers in set(powers_list):
+            bu_id = cached.get(powers, pending.get(powers))
+            if bu_id is None:
+                missing.append(powers)
+            else:
+                bu_ids[powers] = bu_id
+        if missing:
+            self.cursor.executemany(
+                "INSERT OR IGNORE INTO km_base_units "\
                     "(m, g, s, A, K, mol, cd, rad, sr, EUR, bit) "\
-                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                quantity2powers(summary['unit']))
-            l_row_id = self.cursor.lastrowid
-        except sqlite3.IntegrityError:
-            exe("SELECT bu_id FROM km_base_units WHERE m=? AND g=? "
-                "AND s=? AND A=? AND K=? AND mol=? AND cd=? AND rad=? "
-                "AND sr=? AND EUR=? AND bit=?",
-                quantity2powers(summary['unit'])
-                )
-            tmp = self.cursor.fetchone()
-            assert tmp != None
-            l_row_id = tmp[0]
-        insert_dict['bu_id'] = l_row_id
-        dimension_query = "INSERT INTO km_fc_dimensions VALUES (?, ?, ?)"
-        for dim_id, dim_index in zip(summary['dimensions'],
-                                     range(len(summary['dimensions']))):
-            exe(dimension_query, (summary['id'], dim_id, dim_index))
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", missing)
+            for powers in missing:
+                self.cursor.execute(
+                    "SELECT bu_id FROM km_base_units WHERE m=? AND g=? "
+                    "AND s=? AND A=? AND K=? AND mol=? AND cd=? AND rad=? "
+                    "AND sr=? AND EUR=? AND bit=?", powers)
+                bu_id = self.cursor.fetchone()[0]
+                bu_ids[powers] = bu_id
+                pending[powers] = bu_id
+        return bu_ids
 
     def set_entry(self, summary, storage, temporary=False):
         """Sets the meta data in the database according to the
@@ -382,44 +952,81 @@ class SQLiteWrapper(object):
         - temporary: Flag that marks data to be deleted upon next
                      call to setup_dbase().
         """
-        if self.has_entry(summary['id']):
+        self.set_entries([(summary, storage)], temporary)
+
+    def set_entries(self, entries, temporary=False):
+        """Same as set_entry() for an iterable of tuples (summary,
+        storage), such that the entries of several files are set in one
+        go. The rows of all new entries are inserted with one
+        executemany() call per table. Of several entries with the same
+        emd5, the first one is set.
+        """
+        summaries = {}
+        storages = {}
+        for summary, storage in entries:
+            if summary['id'] not in summaries:
+                summaries[summary['id']] = summary
+                storages[summary['id']] = storage
+        known = self.get_known_ids(summaries.keys())
+        new = [summary for dc_id, summary in summaries.iteritems() \
+                   if dc_id not in known]
+        if not new:
             return
-        exe = self.cursor.execute
+        fcs = [summary for summary in new if emd52type(summary['id']) == 'fc']
+        scs = [summary for summary in new if emd52type(summary['id']) == 'sc']
+        attr_rows = []
+        for summary in new:
+            for key, value in summary['attributes'].iteritems():
+                assert isinstance(key, StringTypes)
+                if isinstance(value, StringTypes):
+                    value = utf82uc(value)
+                attr_rows.append([summary['id'], key, value.__repr__(),
+                                  attr2number(value)])
+        bu_ids = self.get_bu_ids([quantity2powers(summary['unit']) \
+                                      for summary in fcs] \
+                                     + [row[3][1] for row in attr_rows \
+                                            if row[3] is not None])
+        for row in attr_rows:
+            if row[3] is None:
+                row[3:] = [None, None]
+            else:
+                row[3:] = [row[3][0], bu_ids[row[3][1]]]
+        keys = "longname, shortname, machine, creator, date, hash, storage"
+
+        def common_rows(summary):
+            return [summary.get('longname'), summary.get('shortname'),
+                    summary.get('machine'), summary.get('creator'),
+                    date2dbase(summary['date']), summary.get('hash'),
+                    storages[summary['id']]]
+        fc_rows = [tuple([summary['id']] + common_rows(summary) \
+                             + [quantity2dbase(summary['unit']),
+                                bu_ids[quantity2powers(summary['unit'])]]) \
+                       for summary in fcs]
+        sc_rows = [tuple([summary['id']] + common_rows(summary)) \
+                       for summary in scs]
+        dim_rows = [(summary['id'], dim_id, dim_index) \
+                        for summary in fcs for dim_index, dim_id \
+                        in enumerate(summary['dimensions'])]
+        col_rows = [(summary['id'], fc_id, fc_index) \
+                        for summary in scs for fc_index, fc_id \
+                        in enumerate(summary['columns'])]
+        exe = self.cursor.executemany
         if temporary:
-            exe("INSERT INTO km_temporary VALUES (?)",
-                (summary['id'],))
-        insert_dict = dict([(key, value) for key, value in \
-                                summary.iteritems() if key in \
-                                SQLiteWrapper.common_keys])
-        insert_dict['storage'] = storage
-        insert_dict['date'] = date2dbase(insert_dict['date'])
-        type = emd52type(summary['id'])
-        attr_query = "INSERT INTO km_attributes VALUES (?, ?, ?)"
-        for key, value in summary['attributes'].iteritems():
-            assert isinstance(key, StringTypes)
-            if isinstance(value, StringTypes):
-                value = utf82uc(value)
-            exe(attr_query, (summary['id'], key, value.__repr__()))
-        if type == 'fc':
-            self._set_fc_keys(insert_dict, summary)
-        else:
-            insert_dict['sc_id'] = summary['id']
-            column_query = "INSERT INTO km_sc_columns VALUES (?, ?, ?)"
-            for fc_id, fc_index in zip(summary['columns'],
-                                       range(len(summary['columns']))):
-                exe(column_query, (summary['id'], fc_id, fc_index))
-        insert_query = "INSERT INTO km_%s %s VALUES %s"
-        value_list = []
-        key_query = "("
-        value_query = "("
-        for key, value in insert_dict.iteritems():
-            value_query += "?, "
-            key_query += key + ", "
-            value_list.append(value)
-        key_query = key_query[:-2] + ")"
-        value_query = value_query[:-2] + ")"
-        insert_query = insert_query % (type, key_query, value_query)
-        exe(insert_query, tuple(value_list))
+            exe("INSERT OR IGNORE INTO km_temporary VALUES (?)",
+                [(summary['id'], ) for summary in new])
+        exe("INSERT OR IGNORE INTO km_attributes VALUES (?, ?, ?, ?, ?)",
+            attr_rows)
+        exe("INSERT OR IGNORE INTO km_fc_dimensions VALUES (?, ?, ?)",
+            dim_rows)
+        exe("INSERT OR IGNORE INTO km_sc_columns VALUES (?, ?, ?)",
+            col_rows)
+        exe("INSERT OR IGNORE INTO km_fc (fc_id, %s, unit, bu_id) "\
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)" % keys, fc_rows)
+        exe("INSERT OR IGNORE INTO km_sc (sc_id, %s) "\
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)" % keys, sc_rows)
+        if self.has_fulltext():
+            self.set_fulltext(new)
+        self.bump_generation()
 
     def set_temporary(self, entry_id, temporary):
         """Sets the given entry to temporary, which means it will be
@@ -430,14 +1037,132 @@ class SQLiteWrapper(object):
             return
         exe = self.cursor.execute
         if temporary:
-            try:
-                exe("INSERT OR ABORT INTO km_temporary VALUES (?)",
-                    (entry_id,))
-            except sqlite3.IntegrityError:
-                pass  # Already set to temporary!
+            exe("INSERT OR IGNORE INTO km_temporary VALUES (?)",
+                (entry_id,))
         else:
             exe("DELETE FROM km_temporary WHERE dc_id=?",
                 (entry_id,))
+        self.bump_generation()
+
+    def get_temporary_ids(self, ids):
+        """Returns the set of those of the given emd5s that are marked
+        as temporary."""
+        ids = list(ids)
+        temporary = set()
+        chunk_size = 900  # sqlite allows 999 parameters per statement
+        for start in xrange(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            self.cursor.execute("SELECT dc_id FROM km_temporary "\
+                                    "WHERE dc_id IN (%s)" \
+                                    % ", ".join(["?"] * len(chunk)), chunk)
+            temporary.update([row[0] for row in self.cursor.fetchall()])
+        return temporary
+
+    def get_hash_storages(self, hashes):
+        """Returns a dictionary that maps each of the given hashes of
+        FieldContainers to the list of files storing FieldContainers
+        with that hash, in order of registration. Hashes that are not
+        stored in any file are omitted."""
+        hashes = list(hashes)
+        storages = {}
+        chunk_size = 900  # sqlite allows 999 parameters per statement
+        for start in xrange(0, len(hashes), chunk_size):
+            chunk = hashes[start:start + chunk_size]
+            self.cursor.execute("SELECT hash, storage FROM km_fc "\
+                                    "WHERE hash IN (%s) "\
+                                    "AND storage IS NOT NULL ORDER BY rowid" \
+                                    % ", ".join(["?"] * len(chunk)), chunk)
+            for hash, storage in self.cursor.fetchall():
+                paths = storages.setdefault(hash, [])
+                if storage not in paths:
+                    paths.append(storage)
+        return storages
+
+    def get_storage_ids(self):
+        """Returns a dictionary that maps each file that is the storage
+        of some entries to the set of emd5s of those entries."""
+        self.cursor.execute("SELECT storage, fc_id FROM km_fc "\
+                                "WHERE storage IS NOT NULL "\
+                                "UNION ALL SELECT storage, sc_id FROM km_sc "\
+                                "WHERE storage IS NOT NULL")
+        storages = {}
+        for storage, dc_id in self.cursor.fetchall():
+            storages.setdefault(storage, set()).add(dc_id)
+        return storages
+
+    def set_storage(self, ids, storage):
+        """Sets the storage of the given entries to the given file.
+        - ids: emd5s of entries that are stored in the file
+        - storage: path of the file"""
+        ids = list(ids)
+        chunk_size = 900  # sqlite allows 999 parameters per statement
+        for start in xrange(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            marks = ", ".join(["?"] * len(chunk))
+            self.cursor.execute("UPDATE km_fc SET storage=? "\
+                                    "WHERE fc_id IN (%s)" % marks,
+                                [storage] + chunk)
+            self.cursor.execute("UPDATE km_sc SET storage=? "\
+                                    "WHERE sc_id IN (%s)" % marks,
+                                [storage] + chunk)
+        self.bump_generation()
+
+    def delete_temporary(self, ids):
+        """Deletes those of the given entries from the database that are
+        marked as temporary and are neither a dimension nor a column of
+        an entry that is not temporary. Returns the set of emd5s of the
+        deleted entries."""
+        ids = list(ids)
+        deleted = set()
+        chunk_size = 900  # sqlite allows 999 parameters per statement
+        for start in xrange(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            self.cursor.execute(
+                "SELECT dc_id FROM km_temporary AS t WHERE dc_id IN (%s) "\
+                    "AND NOT EXISTS (SELECT * FROM km_fc_dimensions AS d "\
+                    "WHERE d.dim_id=t.dc_id AND d.fc_id NOT IN "\
+                    "(SELECT dc_id FROM km_temporary)) "\
+                    "AND NOT EXISTS (SELECT * FROM km_sc_columns AS c "\
+                    "WHERE c.fc_id=t.dc_id AND c.sc_id NOT IN "\
+                    "(SELECT dc_id FROM km_temporary))" \
+                    % ", ".join(["?"] * len(chunk)), chunk)
+            deleted.update([row[0] for row in self.cursor.fetchall()])
+        # deleting from km_temporary deletes the entries by trigger_del_tmp
+        self.cursor.executemany("DELETE FROM km_temporary WHERE dc_id=?",
+                                [(dc_id, ) for dc_id in deleted])
+        self.bump_generation()
+        return deleted
+
+    def get_files(self):
+        """Returns a dictionary that maps the path of each indexed
+        file to a tuple (size, mtime, checksum)."""
+        self.cursor.execute("SELECT path, size, mtime, checksum "\
+                                "FROM km_files")
+        return dict([(row[0], tuple(row[1:])) \
+                         for row in self.cursor.fetchall()])
+
+    def set_file(self, path, size, mtime, checksum=None):
+        """Records the state of an indexed file.
+        - path: path of the file, as used for the storage of its entries
+        - size: file size in bytes
+        - mtime: modification time as returned by os.stat()
+        - checksum: checksum of the file content or None if unknown"""
+        self.cursor.execute("INSERT OR REPLACE INTO km_files "\
+                                "VALUES (?, ?, ?, ?)",
+                            (path, size, mtime, checksum))
+
+    def delete_file(self, path):
+        """Removes the given file and all entries stored in it
+        from the database."""
+        exe = self.cursor.execute
+        exe("DELETE FROM km_temporary WHERE dc_id IN "\
+                "(SELECT fc_id FROM km_fc WHERE storage=? "\
+                "UNION SELECT sc_id FROM km_sc WHERE storage=?)",
+            (path, path))
+        exe("DELETE FROM km_fc WHERE storage=?", (path, ))
+        exe("DELETE FROM km_sc WHERE storage=?", (path, ))
+        exe("DELETE FROM km_files WHERE path=?", (path, ))
+        self.bump_generation()
 
     def get_emd5_list(self):
         self.cursor.execute("SELECT fc_id FROM km_fc")
@@ -460,6 +1185,13 @@ class SQLiteWrapper(object):
             return 'unit AS "unit [QUANTITY]"'
         elif key == 'latex_unit':
             return 'unit AS "latex_unit [LATEX]"'
+        elif key == 'rank' and not self.has_fulltext():
+            # all matches of the LIKE search rank equally
+            return '0 AS rank'
+        elif key == 'rank':
+            return '(SELECT rank FROM km_fulltext WHERE km_fulltext MATCH ? '\
+                'AND rowid=(SELECT text_id FROM km_text WHERE dc_id=%s)) '\
+                'AS rank' % replace_type('%s_id', type)
         else:
             return key
 
@@ -477,15 +1209,53 @@ class SQLiteWrapper(object):
             'AND cd=? AND rad=? AND sr=? AND EUR=? AND bit=?))'
         return (expr, value, True)
 
+    def translate_text_search(self, value, type):
+        if not self.has_fulltext():
+            return self.translate_like_search(value, type)
+        match = text2match(value)
+        if match == u'':
+            return ('1', [], True)
+        expr = '(%s IN (SELECT dc_id FROM km_text WHERE text_id IN '\
+            '(SELECT rowid FROM km_fulltext WHERE km_fulltext MATCH ?)))' \
+            % replace_type('%s_id', type)
+        return (expr, [match], True)
+
+    def translate_like_search(self, value, type):
+        """Translates a 'text' search for databases without full-text
+        index, i.e. if sqlite3 has been compiled without FTS5: Each word
+        has to occur in the longname, shortname or in the key or value
+        of an attribute, where words also match parts of longer words.
+        """
+        patterns = text2like(value)
+        if patterns == []:
+            return ('1', [], True)
+        id_column = replace_type('%s_id', type)
+        word_expr = "(%s IN (SELECT %s FROM %s WHERE longname LIKE ? "\
+            "ESCAPE '\\' OR shortname LIKE ? ESCAPE '\\') "\
+            "OR %s IN (SELECT dc_id FROM km_attributes WHERE "\
+            "key LIKE ? ESCAPE '\\' OR value LIKE ? ESCAPE '\\'))" \
+            % (id_column, id_column, replace_type('km_%s', type), id_column)
+        expr = '(%s)' % ' AND '.join([word_expr] * len(patterns))
+        new_value = []
+        for pattern in patterns:
+            new_value.extend([pattern] * 4)
+        return (expr, new_value, True)
+
     def translate_attr_search(self, value, type):
         if value == {}:
             return ('1', [], True)
         expr = '('
         new_value = []
         for attr_key, attr_value in value.iteritems():
+            constraints = get_attr_constraints(attr_value)
             if isinstance(attr_value, AnyValue):
                 value_expr = ''
                 new_value.append(attr_key)
+            elif constraints is not None:
+                value_expr, values = self.translate_attr_constraints(
+                    constraints)
+                new_value.append(attr_key)
+                new_value.extend(values)
             else:
                 value_expr = ' AND value=?'
                 if isinstance(attr_value, StringTypes):
@@ -498,6 +1268,24 @@ class SQLiteWrapper(object):
         expr = expr[:-5] + ')'
         return (expr, new_value, True)
 
+    def translate_attr_constraints(self, constraints):
+        powers = None
+        value_expr = ' AND bu_id=(SELECT bu_id FROM km_base_units WHERE '\
+            'm=? AND g=? AND s=? AND A=? AND K=? AND mol=? AND cd=? '\
+            'AND rad=? AND sr=? AND EUR=? AND bit=?)'
+        values = []
+        for operator, operand in constraints:
+            number = attr2number(operand)
+            if number is None:
+                raise ValueError(operand)
+            if powers is None:
+                powers = number[1]
+            elif powers != number[1]:
+                raise ValueError("Incompatible units: %s" % (constraints, ))
+            value_expr += ' AND num%s?' % ATTR_OPERATORS[operator]
+            values.append(number[0])
+        return value_expr, list(powers) + values
+
     def translate_list_search(self, key, value, type):
         id_str = replace_type('%s_id', type)
         if key == 'columns':
@@ -594,6 +1382,8 @@ class SQLiteWrapper(object):
                 expr, value, extend = self.translate_unit_search(value)
             elif key == 'attributes':
                 expr, value, extend = self.translate_attr_search(value, type)
+            elif key == 'text':
+                expr, value, extend = self.translate_text_search(value, type)
             elif key == 'columns' or key == 'dimensions':
                 expr, value, extend = self.translate_list_search(
                     key, value, type)
@@ -633,6 +1423,9 @@ class SQLiteWrapper(object):
         if search_dict != {}:
             where, values = self.translate_search_dict(type, search_dict)
             qry += where
+        if 'rank' in result_keys and self.has_fulltext():
+            values = [text2match(search_dict['text'])] \
+                * list(result_keys).count('rank') + values
         return qry, values
 
     def get_andsearch_result(self, result_keys, search_dict=None,
@@ -659,7 +1452,14 @@ class SQLiteWrapper(object):
           'type': 'field' or 'sample' (==)
           'attributes': dict mapping attr. key to attr. value (==)
                         use (SQLiteWrapper instance).any_value
-                        or (KM instance).any_value to skip value check
+                        or (KM instance).any_value to skip value check.
+                        Numerical attributes (numbers and Quantities) may
+                        be compared by a tuple (operator, value) or a list
+                        of such tuples with operators ==, !=, <, <=, >, >=,
+                        e.g. {'T':[('>=', Quantity('300 K')),
+                                   ('<', Quantity('350 K'))]}.
+                        Quantities are compared in base units and only
+                        match attributes of the same dimension.
           'storage': str types (==)
           'unit': PhysicalUnit or number or Quantity (==, FC only)
           'dimensions': list of FC search dicts
@@ -669,6 +1469,14 @@ class SQLiteWrapper(object):
           'columns': list of FC search dicts (see above definitions, SC only)
           'has_col': DC search dict (see above defs, SC only)
           'had_dim': FC search dict (see above definitions, FC only)
+          'text': str types: words that have to occur in the longname,
+                  shortname or attributes, a trailing '*' matches any
+                  word starting with the given characters (full-text
+                  search). Adds 'rank' to the allowed result keys, order
+                  by 'rank' ascending to get the best matches first.
+                  If sqlite3 lacks FTS5, words match any part of the
+                  longname, shortname or attributes and all results
+                  have the same rank.
         - order_by: element of result_keys to order the results by
                     or None for no special ordering
         - order_asc: whether to order ascending
@@ -700,49 +1508,130 @@ class SQLiteWrapper(object):
                     % (order_by, {True: 'ASC', False: 'DESC'}[order_asc])
         assert isinstance(limit, int)
         assert isinstance(offset, int)
-        if not search_dict.has_key('type'):
-            self.verify_keys(result_keys, self.common_result_keys)
-            self.verify_keys(search_dict.keys(), self.common_search_keys)
-            fc_query, fc_values \
-                = self.get_andsearch_query('field', result_keys,
-                                           search_dict, distinct)
-            sc_query, sc_values \
-                = self.get_andsearch_query('sample', result_keys,
-                                           search_dict, distinct)
-            if distinct:
-                dist_str = ''
-            else:
-                dist_str = ' ALL'
-            query = "%s UNION%s %s%s LIMIT %d OFFSET %d"
-            query = query % (
-                fc_query, dist_str, sc_query, order, limit, offset
-                )
-            if search_dict != {}:
-                values = fc_values + sc_values
-            else:
-                values = None
-            mod_search_dict = search_dict
+        if distinct:
+            dist_str = ''
         else:
-            if search_dict['type'] == 'field':
-                allowed_search_keys = self.fc_search_keys
-                allowed_result_keys = self.common_result_keys \
-                    + ['unit', 'latex_unit']
-            elif search_dict['type'] == 'sample':
-                allowed_search_keys = self.sc_search_keys
-                allowed_result_keys = self.common_result_keys
-            mod_search_dict = search_dict.copy()
-            mod_search_dict.pop('type')
-            self.verify_keys(mod_search_dict.keys(), allowed_search_keys)
-            self.verify_keys(result_keys, allowed_result_keys)
-            query, values = self.get_andsearch_query(
-                search_dict['type'], result_keys, mod_search_dict, distinct)
-            query = "%s%s LIMIT %d OFFSET %d" % (query, order, limit, offset)
-        if values is not None and len(values) > 0:
+            dist_str = ' ALL'
+        queries = []
+        values = []
+        for type, type_search_dict in self.get_search_types(result_keys,
+                                                            search_dict):
+            type_query, type_values = self.get_andsearch_query(
+                type, result_keys, type_search_dict, distinct)
+            queries.append(type_query)
+            values.extend(type_values or [])
+        query = "%s%s LIMIT %d OFFSET %d" % (
+            (" UNION%s " % dist_str).join(queries), order, limit, offset)
+        if len(values) > 0:
             self.cursor.execute(query, values)
         else:
             self.cursor.execute(query)
         return self.cursor.fetchall()
 
+    def get_search_types(self, result_keys, search_dict):
+        """Returns a list of tuples (type, search_dict) with one entry
+        for each DC type to be searched, where the 'type' key has been
+        removed from search_dict. Raises KeyError if result_keys or
+        search_dict contain keys that are not allowed for the type. The
+        'rank' result key is allowed only if search_dict has a 'text' key.
+        """
+        common_result_keys = self.common_result_keys
+        if search_dict.has_key('text'):
+            common_result_keys = common_result_keys + self.text_result_keys
+        if not search_dict.has_key('type'):
+            self.verify_keys(result_keys, common_result_keys)
+            self.verify_keys(search_dict.keys(), self.common_search_keys)
+            return [('field', search_dict), ('sample', search_dict)]
+        if search_dict['type'] == 'field':
+            allowed_search_keys = self.fc_search_keys
+            allowed_result_keys = common_result_keys + ['unit', 'latex_unit']
+        elif search_dict['type'] == 'sample':
+            allowed_search_keys = self.sc_search_keys
+            allowed_result_keys = common_result_keys
+        else:
+            raise ValueError(search_dict['type'])
+        mod_search_dict = search_dict.copy()
+        mod_search_dict.pop('type')
+        self.verify_keys(mod_search_dict.keys(), allowed_search_keys)
+        self.verify_keys(result_keys, allowed_result_keys)
+        return [(search_dict['type'], mod_search_dict)]
+
+    def get_keyset_query(self, result_keys, search_dict, order_by,
+                         order_asc, batch_size, last=None):
+        """Returns a tuple (query, values) for the batch of at most
+        batch_size search results following the keyset last, see
+        iter_andsearch_result(). The keyset, i.e. the values of the
+        order_by keys of the last row of the previous batch, is appended
+        to each result row.
+        """
+        sort_keys = {'id': ['id'], 'date': ['date', 'id']}[order_by]
+        if order_asc:
+            rel = '>'
+        else:
+            rel = '<'
+        # the translate_*_search methods modify nested search dicts:
+        search_dict = deepcopy(search_dict)
+        queries = []
+        values = []
+        for type, type_search_dict in self.get_search_types(result_keys,
+                                                            search_dict):
+            query, type_values = self.get_andsearch_query(
+                type, list(result_keys) + sort_keys, type_search_dict, False)
+            values.extend(type_values or [])
+            if last is not None:
+                id_str = replace_type('%s_id', type)
+                if order_by == 'id':
+                    expr = '%s%s?' % (id_str, rel)
+                    values.extend(last)
+                else:
+                    expr = '(date%s? OR (date=? AND %s%s?))' \
+                        % (rel, id_str, rel)
+                    values.extend([last[0], last[0], last[1]])
+                if type_search_dict == {}:
+                    query += 'WHERE ' + expr
+                else:
+                    query += ' AND ' + expr
+            queries.append(query)
+        order = ', '.join(['%d %s' % (len(result_keys) + index + 1,
+                                      {True: 'ASC', False: 'DESC'}[order_asc]) \
+                               for index in range(len(sort_keys))])
+        query = '%s ORDER BY %s LIMIT %d' % (' UNION ALL '.join(queries),
+                                             order, batch_size)
+        return query, values
+
+    def get_keyset_result(self, result_keys, search_dict=None,
+                          order_by='id', order_asc=True,
+                          batch_size=1000, last=None):
+        """Returns a tuple (rows, last) where rows is the list of at most
+        batch_size result tuples following the keyset last. Instead of
+        LIMIT/OFFSET, batches are selected by the order_by keys of the
+        last row of the previous batch (keyset pagination), which keeps
+        the cost of each batch independent of its position in the result
+        set. last is None if there are no further results.
+        Arguments:
+        - result_keys, search_dict: see get_andsearch_result()
+        - order_by: 'id' or 'date', rows with equal dates are ordered by
+          their ids
+        - order_asc: whether to order ascending
+        - batch_size: maximum number of rows to return
+        - last: keyset of the last row of the previous batch, i.e. (id, )
+          or (date, id), None to start at the beginning
+        """
+        if search_dict is None:
+            search_dict = {}
+        assert order_by in ['id', 'date']
+        assert isinstance(batch_size, int) and batch_size > 0
+        query, values = self.get_keyset_query(
+            result_keys, search_dict, order_by, order_asc, batch_size, last)
+        self.cursor.execute(query, values)
+        rows = self.cursor.fetchall()
+        num_keys = len(result_keys)
+        if len(rows) < batch_size:
+            last = None
+        else:
+            last = rows[-1][num_keys:]
+        return [row[:num_keys] for row in rows], last
+
 
 class RowWrapper(object):
     def __init__(self, emd5, cursor, type):
@@ -776,6 +1665,7 @@ class RowWrapper(object):
         else:
             self.cursor.execute(self.update_query % (key, ),
                                 (value, self.emd5))
+            bump_generation(self.cursor)
 
 
 class FCRowWrapper(RowWrapper):
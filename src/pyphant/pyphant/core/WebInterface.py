@@ -512,7 +512,7 @@ class WebInterface(object):
         complete = dict([(key, self.anystr) for key in common_keys])
         complete.update(
             {'order_by': 'date', 'order_asc': 'True', 'offset': '0',
-             'jump': 'False', 'date_from': '', 'date_to': '',
+             'jump': 'False', 'date_from': '', 'date_to': '', 'text': '',
              'shorten': 'False', 'add_attr': 'False',
              'rem_attr': 'None'}
             )
@@ -535,6 +535,8 @@ class WebInterface(object):
             search_dict['date_from'] = qry['date_from']
         if qry['date_to'] != '':
             search_dict['date_to'] = qry['date_to']
+        if qry['text'].strip() != '':
+            search_dict['text'] = qry['text']
         attr_post = [key[8:] for key in qry if key.startswith('attr_key')]
         attr_post.sort(key=lambda x: int(x))
         if qry['rem_attr'] != 'None':
@@ -587,6 +589,15 @@ class WebInterface(object):
               HTMLTextInput('date_to', 26, 26, qry['date_to'],
                             "document.search_form.submit();")]])
         date = date_table.getHTML()
+        # --- full-text search key ---
+        text_table = HTMLTable(
+            [["full-text search (longname, shortname, attributes; "\
+                  "use word* for prefixes)"],
+             [HTMLTextInput('text', 80, 1000, qry['text'],
+                            "document.search_form.order_by.value='rank';"\
+                            "document.search_form.order_asc.value='True';"\
+                            "document.search_form.submit();")]])
+        text = text_table.getHTML()
         # --- attribute search keys
         rows = [['attribute', 'value',
                  HTMLJSButton('--add--', 'add_attribute();')]]
@@ -603,6 +614,7 @@ class WebInterface(object):
         missing_keys = ['date'] \
                        + [key for key in common_keys \
                           if qry[key] == self.anystr] \
+                       + cond('text' in search_dict, (['rank'], [])) \
                        + ['id']
         if not order_by in missing_keys:
             order_by = 'date'
@@ -611,15 +623,17 @@ class WebInterface(object):
             order_asc=order_asc, limit=limit, offset=offset)
         rows = [order_bar(missing_keys[:-1], order_by, order_asc)\
                 + ['details', 'tmp']]
+        temporary = self.kn.km.areTemporary([srow[-1] \
+                                             for srow in search_result])
         rows.extend([nice(srow[:-1], missing_keys[:-1], do_shorten) \
-                     + (HTMLSummaryLink((srow[-1], 'click')),
-                        self.kn.km.isTemporary(srow[-1])) \
-                     for srow in search_result])
+                     + (HTMLSummaryLink((srow[-1], 'click')), is_tmp) \
+                     for srow, is_tmp in zip(search_result, temporary)])
         bbar = HTMLBrowseBar(offset, limit).getHTML()
         result = bbar + "<br />" + HTMLTable(rows).getHTML() + "<br />" + bbar
         return template('search',
                         common=common,
                         date=date,
+                        text=text,
                         attributes=attributes,
                         special='special...',
                         result=result,
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2006-2014, Rectorate of the University of Freiburg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the Freiburg Materials Research Center,
+#   University of Freiburg nor the names of its contributors may be used to
+#   endorse or promote products derived from this software without specific
+#   prior written permission.
+#
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+u"""Provides unittest classes for DCCache.
+"""
+
+
+import unittest
+import os
+import numpy
+from pyphant.core.DCCache import (DCCache, LRUPolicy, GDSFPolicy,
+                                  rawDataBytes, SingleFlight, LoaderPool,
+                                  SpillCache)
+from pyphant.core.DataContainer import (FieldContainer, SampleContainer)
+
+
+class LRUTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = DCCache(max_size=100, max_number=3)
+
+    def testHitMiss(self):
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertTrue(self.cache.put('a', 'A', 10))
+        self.assertEqual(self.cache.get('a'), 'A')
+        stats = self.cache.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 10)
+        self.assertEqual(stats['number'], 1)
+
+    def testNumberLimit(self):
+        for key in 'abc':
+            self.cache.put(key, key.upper(), 10)
+        self.cache.get('a')
+        self.cache.put('d', 'D', 10)
+        self.assertFalse('b' in self.cache)
+        for key in 'acd':
+            self.assertTrue(key in self.cache)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def testSizeLimit(self):
+        self.cache.put('a', 'A', 60)
+        self.cache.put('b', 'B', 30)
+        self.cache.put('c', 'C', 20)
+        self.assertFalse('a' in self.cache)
+        self.assertEqual(self.cache.size, 50)
+        self.assertFalse(self.cache.put('d', 'D', 101))
+        self.assertEqual(self.cache.rejections, 1)
+
+    def testRuntimeLimits(self):
+        for key in 'abc':
+            self.cache.put(key, key.upper(), 30)
+        self.cache.max_number = 1
+        self.assertEqual(len(self.cache), 1)
+        self.assertTrue('c' in self.cache)
+        self.cache.max_number = 3
+        self.cache.put('d', 'D', 30)
+        self.cache.max_size = 40
+        self.assertEqual(len(self.cache), 1)
+        self.assertTrue('d' in self.cache)
+
+    def testRemoveClear(self):
+        self.cache.put('a', 'A', 10)
+        self.cache.put('b', 'B', 10)
+        self.cache.remove('a')
+        self.cache.remove('a')
+        self.assertEqual(self.cache.size, 10)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.size, 0)
+
+
+class GDSFTestCase(unittest.TestCase):
+    def testPrefersSmallAndFrequent(self):
+        cache = DCCache(max_size=100, max_number=100, policy='gdsf')
+        cache.put('large', 'L', 60)
+        cache.put('small', 'S', 10)
+        cache.put('new', 'N', 35)
+        self.assertFalse('large' in cache)
+        self.assertTrue('small' in cache)
+        cache = DCCache(max_size=100, max_number=100, policy=GDSFPolicy())
+        cache.put('a', 'A', 50)
+        cache.put('b', 'B', 50)
+        for i in xrange(5):
+            cache.get('a')
+        cache.put('c', 'C', 50)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+
+    def testSwitchPolicy(self):
+        cache = DCCache(max_size=100, max_number=2)
+        cache.put('a', 'A', 10)
+        cache.put('b', 'B', 10)
+        cache.policy = 'gdsf'
+        cache.put('c', 'C', 10)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get_stats()['policy'], 'gdsf')
+        cache.policy = LRUPolicy()
+        cache.put('d', 'D', 10)
+        self.assertEqual(len(cache), 2)
+        self.assertRaises(ValueError, setattr, cache, 'policy', 'bogus')
+
+    def testSwitchPolicyKeepsOrder(self):
+        cache = DCCache(max_size=100, max_number=3)
+        for key in ['a', 'b', 'c']:
+            cache.put(key, key.upper(), 10)
+        cache.get('a')
+        self.assertEqual(cache.policy.keys(), ['b', 'c', 'a'])
+        cache.policy = 'gdsf'
+        self.assertEqual(cache.policy.keys(), ['b', 'c', 'a'])
+        cache.get('b')
+        cache.get('b')
+        cache.get('c')
+        self.assertEqual(cache.policy.keys(), ['a', 'c', 'b'])
+        cache.policy = 'lru'
+        self.assertEqual(cache.policy.keys(), ['a', 'c', 'b'])
+        cache.put('d', 'D', 10)
+        self.assertFalse('a' in cache)
+
+
+class RawDataBytesTestCase(unittest.TestCase):
+    def testSampleContainer(self):
+        fc1 = FieldContainer(numpy.ones(10))
+        fc2 = FieldContainer(numpy.ones(10))
+        sc = SampleContainer([fc1, SampleContainer([fc2])])
+        self.assertEqual(rawDataBytes(sc),
+                         rawDataBytes(fc1) + rawDataBytes(fc2))
+
+
+class SpillCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        from tempfile import mkdtemp
+        self.directory = mkdtemp(prefix='pyphantSpillTest')
+        self.fcs = []
+        for num in xrange(3):
+            fc = FieldContainer(numpy.arange(1000.0) + num,
+                                error=numpy.ones(1000) * 0.1)
+            fc.seal()
+            self.fcs.append(fc)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def testPutGet(self):
+        spill = SpillCache(self.directory, 100000)
+        self.assertEqual(spill.get('a'), None)
+        self.assertTrue(spill.put('a', self.fcs[0], 16000))
+        value, size = spill.get('a')
+        self.assertEqual(size, 16000)
+        self.assertEqual(value, self.fcs[0])
+        self.assertEqual(value.id, self.fcs[0].id)
+        self.assertTrue(isinstance(value.data, numpy.memmap))
+        self.assertFalse(value.data.flags.writeable)
+        sample = SampleContainer(self.fcs[1:], longname=u'table')
+        sample.seal()
+        self.assertTrue(spill.put('b', sample, 32000))
+        self.assertEqual(spill.get('b')[0], sample)
+        stats = spill.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+    def testEviction(self):
+        spill = SpillCache(self.directory, 1000000)
+        spill.put(0, self.fcs[0], 16000)
+        limit = spill.size * 5 / 2
+        spill.max_size = limit
+        self.assertTrue(spill.put(1, self.fcs[1], 16000))
+        spill.get(0)
+        self.assertTrue(spill.put(2, self.fcs[2], 16000))
+        self.assertEqual(spill.get_stats()['evictions'], 1)
+        self.assertFalse(1 in spill)
+        self.assertTrue(0 in spill and 2 in spill)
+        self.assertTrue(spill.size <= limit)
+        spill.max_size = limit / 3
+        self.assertEqual(len(spill), 0)
+        self.assertFalse(spill.put(0, self.fcs[0], 16000))
+        self.assertEqual(spill.get_stats()['rejections'], 1)
+        spill.max_size = limit
+        spill.put(0, self.fcs[0], 16000)
+        spill.clear()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def testRejectLarge(self):
+        spill = SpillCache(self.directory, 10000)
+        for num in xrange(3):
+            self.assertFalse(spill.put('a', self.fcs[0], 16000))
+        self.assertEqual(spill.get_stats()['rejections'], 3)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def testSecondTier(self):
+        cache = DCCache(max_size=20000, max_number=1,
+                        spill=SpillCache(self.directory, 100000))
+        self.assertTrue(cache.put('a', self.fcs[0], 16000))
+        self.assertFalse(cache.put('big', self.fcs[2], 32000))
+        self.assertTrue(cache.put('b', self.fcs[1], 16000))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(len(cache.spill), 2)
+        self.assertTrue('a' in cache and 'big' in cache)
+        self.assertEqual(cache.get('a'), self.fcs[0])
+        self.assertEqual(cache.get('big'), self.fcs[2])
+        self.assertEqual(cache.get_stats()['rejections'], 2)
+        self.assertEqual(cache.spill.get_stats()['hits'], 2)
+        cache.clear()
+        self.assertEqual(cache.get('a'), None)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def testSingleCall(self):
+        import threading
+        import time
+        flights = SingleFlight()
+        calls = []
+        results = []
+
+        def load(key):
+            calls.append(key)
+            time.sleep(0.2)
+            return key.upper()
+
+        def request():
+            results.append(flights.do('a', load, 'a'))
+        threads = [threading.Thread(target=request) for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, ['a'])
+        self.assertEqual(results, ['A'] * 8)
+        self.assertEqual(len(flights), 0)
+
+    def testException(self):
+        flights = SingleFlight()
+
+        def fail():
+            raise KeyError('a')
+        self.assertRaises(KeyError, flights.do, 'a', fail)
+        self.assertEqual(flights.do('a', lambda: 'A'), 'A')
+
+
+class LoaderPoolTestCase(unittest.TestCase):
+    def testSubmit(self):
+        import threading
+        import time
+        pool = LoaderPool(2)
+        names = []
+
+        def load(key):
+            names.append(threading.currentThread().getName())
+            time.sleep(0.1)
+            return key.upper()
+        futures = [pool.submit(load, key) for key in 'abcd']
+        self.assertEqual([future.result(5.0) for future in futures],
+                         ['A', 'B', 'C', 'D'])
+        self.assertTrue(False not in [future.done() for future in futures])
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(len(set(names)), 2)
+
+    def testException(self):
+        pool = LoaderPool(1)
+
+        def fail():
+            raise KeyError('a')
+        future = pool.submit(fail)
+        self.assertTrue(isinstance(future.exception(5.0), KeyError))
+        self.assertRaises(KeyError, future.result)
+        self.assertEqual(pool.submit(lambda: 'A').result(5.0), 'A')
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) == 1:
+        unittest.main()
+    else:
+        suite = unittest.TestLoader().loadTestsFromTestCase(
+            eval(sys.argv[1:][0]))
+        unittest.TextTestRunner().run(suite)
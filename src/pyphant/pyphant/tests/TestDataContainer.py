@@ -1384,6 +1384,66 @@ class FieldContainerSlicing2dDim(FieldContainerSlicing2d):
         self.assertEqual(section, afoot)
 
 
+class HashTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = numpy.arange(3000.0).reshape((30, 100))
+
+    def testFormat(self):
+        from pyphant.core.DataContainer import (hashVersion, HASH_VERSION)
+        field = FieldContainer(self.data, error=self.data / 10.0)
+        field.seal()
+        self.assertTrue(field.hash.startswith(u'v%d_' % HASH_VERSION))
+        self.assertEqual(hashVersion(field.hash), HASH_VERSION)
+        self.assertTrue(field.verifyHash())
+        sample = SampleContainer([field], longname=u'table')
+        sample.seal()
+        self.assertTrue(sample.verifyHash())
+
+    def testLegacyHash(self):
+        from pyphant.core.DataContainer import hashVersion
+        field = FieldContainer(self.data)
+        field.seal()
+        legacy = field.generateHash(version=1)
+        self.assertEqual(len(legacy), 32)
+        self.assertEqual(hashVersion(legacy), 1)
+        old = FieldContainer(self.data, dimensions=field.dimensions)
+        old.seal(u'emd5://pc/user/2009-01-01_00:00:00.000000/%s.field' \
+                     % legacy)
+        self.assertTrue(old.verifyHash())
+        other = FieldContainer(self.data + 1, dimensions=field.dimensions)
+        other.seal(old.id)
+        self.assertFalse(other.verifyHash())
+
+    def testNonContiguous(self):
+        field = FieldContainer(self.data.T)
+        field.seal()
+        copied = FieldContainer(self.data.T.copy())
+        copied.seal()
+        self.assertEqual(field.hash, copied.hash)
+        transposed = FieldContainer(self.data)
+        transposed.seal()
+        self.assertNotEqual(field.hash, transposed.hash)
+
+    def testChunks(self):
+        from pyphant.core import DataContainer as DCModule
+        field = FieldContainer(self.data)
+        field.seal()
+        data = self.data.copy()
+        data[-1, -1] = 0.5
+        other = FieldContainer(data, dimensions=field.dimensions)
+        chunkBytes = DCModule.HASH_CHUNK_BYTES
+        DCModule.HASH_CHUNK_BYTES = 1000
+        try:
+            chunked = field.generateHash()
+            other.seal()
+            self.assertTrue(field.verifyHash() is False)
+        finally:
+            DCModule.HASH_CHUNK_BYTES = chunkBytes
+        self.assertNotEqual(field.hash, chunked)
+        self.assertNotEqual(other.hash, chunked)
+        self.assertTrue(field.verifyHash())
+
+
 if __name__ == "__main__":
     #suite = unittest.TestLoader().loadTestsFromTestCase(IsValidFieldContainer)
     #unittest.TextTestRunner().run(suite)
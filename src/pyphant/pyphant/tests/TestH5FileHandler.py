@@ -41,6 +41,9 @@ from pyphant.quantities import Quantity as PQ
 from pyphant.core.DataContainer import FieldContainer, SampleContainer
 from pyphant.core.H5FileHandler import H5FileHandler as H5FH
 from numpy import array as NPArray
+from numpy import (arange, linspace)
+from tables import ObjectAtom
+from ast import literal_eval
 import os
 from tempfile import mkstemp
 
@@ -85,6 +88,88 @@ class FCSaveLoadTestCase(FieldContainerTestCase):
         self.assertEqual(self.fc, fcLoaded)
 
 
+    def testSummaryTable(self):
+        fcs = [self.fc]
+        for num in range(3):
+            fc = FieldContainer(arange(num + 3.0), PQ('1m'),
+                                longname=u'summary %d' % num,
+                                attributes={'num': num})
+            fc.seal()
+            fcs.append(fc)
+        sc = SampleContainer(fcs[1:3], u'summary sample', u'S')
+        sc.seal()
+        handler = H5FH(self.fcFilename, 'w')
+        with handler:
+            for dc in fcs + [sc]:
+                handler.saveDataContainer(dc)
+            assert handler._readSummaryTable() is not None
+            summary = handler.loadSummary()
+            handler.handle.removeNode('/summary')
+            self.assertEqual(handler.loadSummary(), summary)
+            for dc in fcs + [sc]:
+                self.assertEqual(summary[dc.id], handler.loadSummary(dc.id))
+        handler = H5FH(self.fcFilename, 'a')
+        with handler:
+            # files without table are completed upon the next save
+            fc = FieldContainer(arange(7.0), longname=u'appended')
+            fc.seal()
+            handler.saveDataContainer(fc)
+            summary[fc.id] = handler.loadSummary(fc.id)
+            self.assertEqual(handler._readSummaryTable(), summary)
+            # stale tables are ignored
+            handler.handle.removeNode('/results/result_' + fc.hash,
+                                      recursive=True)
+            del summary[fc.id]
+            assert handler._readSummaryTable() is None
+            self.assertEqual(handler.loadSummary(), summary)
+
+    def assertSummaryEqual(self, first, second):
+        # numpy arrays are compared by their elements
+        def listed(summary):
+            return dict([(dcId, dict(tmp, attributes=dict(
+                [(key, getattr(value, 'tolist', lambda: value)()) \
+                 for key, value in tmp['attributes'].iteritems()]))) \
+                         for dcId, tmp in summary.iteritems()])
+        self.assertEqual(listed(first), listed(second))
+
+    def testSummaryTableFallbacks(self):
+        fc = FieldContainer(arange(3.0), longname=u'array attribute',
+                            attributes={'array': arange(2)})
+        fc.seal()
+        handler = H5FH(self.fcFilename, 'w')
+        with handler:
+            handler.saveDataContainer(self.fc)
+            handler.saveDataContainer(fc)
+            summary = handler.loadSummary()
+            # non-literal attributes are read from the result group
+            records = [literal_eval(record) for record \
+                       in handler.handle.getNode('/summary')]
+            self.assertEqual([record[2] for record in records \
+                              if record[1] == fc.id], ['walk'])
+            self.assertSummaryEqual(handler._readSummaryTable(), summary)
+            self.assertEqual(summary[fc.id]['attributes']['array'].tolist(),
+                             [0, 1])
+            # corrupt rows are ignored
+            handler.handle.getNode('/summary').append("(u'")
+            assert handler._readSummaryTable() is None
+            self.assertSummaryEqual(handler.loadSummary(), summary)
+            # pickled tables are neither read nor extended
+            handler.handle.removeNode('/summary')
+            legacy = handler.handle.createVLArray('/', 'summary', ObjectAtom())
+            legacy.append((self.fc.id, summary[self.fc.id]))
+            assert handler._readSummaryTable() is None
+            fc2 = FieldContainer(arange(4.0), longname=u'replacing')
+            fc2.seal()
+            handler.saveDataContainer(fc2)
+            summary[fc2.id] = handler.loadSummary(fc2.id)
+            self.assertSummaryEqual(handler._readSummaryTable(), summary)
+            # tables are matched with the results by name, not by count
+            handler.handle.removeNode('/results/result_' + fc2.hash,
+                                      recursive=True)
+            handler.handle.createGroup('/results', 'result_unlisted')
+            assert handler._readSummaryTable() is None
+
+
 class FCReadOnlyTestCase(FieldContainerTestCase):
     def setUp(self):
         FieldContainerTestCase.setUp(self)
@@ -104,6 +189,73 @@ class FCReadOnlyTestCase(FieldContainerTestCase):
             fcLoaded = handler.loadDataContainer(self.fc.id)
         self.assertEqual(self.fc, fcLoaded)
 
+    def testHandlePool(self):
+        import copy
+        from pyphant.core.PyTablesPersister import handlePool
+        handlePool.invalidate(self.rofcFilename)
+        before = handlePool.get_stats()
+        for i in xrange(3):
+            with H5FH(self.rofcFilename, 'r') as handler:
+                handle = handler.handle
+                self.assertEqual(handler.loadDataContainer(self.fc.id),
+                                 self.fc)
+        self.assertTrue(handle.isopen)
+        stats = handlePool.get_stats()
+        self.assertEqual(stats['opens'] - before['opens'], 1)
+        self.assertEqual(stats['hits'] - before['hits'], 2)
+        with H5FH(self.rofcFilename, 'a') as handler:
+            self.assertFalse(handle.isopen)
+            fc = copy.deepcopy(self.fc)
+            fc.data = fc.data * 2
+            fc.seal()
+            handler.saveDataContainer(fc)
+        with H5FH(self.rofcFilename, 'r') as handler:
+            self.assertEqual(handler.loadDataContainer(fc.id), fc)
+        stats = handlePool.get_stats()
+        self.assertEqual(stats['opens'] - before['opens'], 2)
+        self.assertEqual(stats['invalidations'] - before['invalidations'], 1)
+        handlePool.invalidate(self.rofcFilename)
+
+
+class FCSliceTestCase(unittest.TestCase):
+    def setUp(self):
+        xdim = FieldContainer(linspace(0, 0.9, 10), PQ('1m'),
+                              longname=u'x', shortname=u'x')
+        ydim = FieldContainer(linspace(0, 1.9, 20), PQ('1s'),
+                              longname=u'y', shortname=u'y')
+        data = arange(200.0).reshape((20, 10))
+        self.fc = FieldContainer(data, PQ('1V'), data * 0.1, data > 150.0,
+                                 [ydim, xdim], u'voltage', u'U')
+        self.fc.seal()
+        osHandle, self.filename = mkstemp(
+            suffix = '.h5', prefix = 'pyphantH5FileHandlerTest')
+        os.close(osHandle)
+        handler = H5FH(self.filename, 'w')
+        with handler:
+            handler.saveDataContainer(self.fc)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def testLoadFieldSlice(self):
+        for args in [3, slice(2, 5), (slice(2, 5), slice(1, 8)),
+                     ('0.5s:1.0s', '0.2m:0.5m'), (4, '0.2m:0.5m'),
+                     (slice(None), 3)]:
+            handler = H5FH(self.filename, 'r')
+            with handler:
+                fcSlice = handler.loadFieldSlice(self.fc.id, args)
+            self.assertEqual(fcSlice, self.fc[args])
+
+    def testHyperslab(self):
+        handler = H5FH(self.filename, 'r')
+        with handler:
+            resNode, uriType = handler.getNodeAndTypeFromId(self.fc.id)
+            lazyFC = handler.loadField(resNode, lazy=True)
+            fcSlice = lazyFC[('0.5s:1.0s', 2)]
+        assert not lazyFC.isLoaded()
+        self.assertEqual(fcSlice.data.shape, (5, ))
+        self.assertEqual(fcSlice, self.fc[('0.5s:1.0s', 2)])
+
 
 class SampleContainerTestCase(unittest.TestCase):
     def setUp(self):
@@ -36,8 +36,10 @@ u"""Provides unittest classes
 import unittest
 from pyphant.core.KnowledgeManager import (KnowledgeManager,
                                            CACHE_MAX_SIZE,
-                                           CACHE_MAX_NUMBER)
+                                           CACHE_MAX_NUMBER,
+                                           getFilenameFromDcId)
 import pyphant.core.PyTablesPersister as ptp
+from pyphant.core.PyTablesPersister import LazyFieldContainer
 from pyphant.core.DataContainer import (FieldContainer, SampleContainer)
 import numpy as N
 import tables
@@ -97,6 +99,166 @@ class KnowledgeManagerTestCase(unittest.TestCase):
         km_fc = km.getDataContainer(self._fc.id)
         self.assertEqual(self._fc, km_fc)
 
+    def testPrefetch(self):
+        from pyphant.core.KnowledgeManager import DCNotFoundError
+        km = KnowledgeManager.getInstance()
+        fcs = []
+        for num in xrange(5):
+            fc = FieldContainer(N.arange(num, num + 10))
+            fc.seal()
+            fcs.append(fc)
+        km.registerDataContainers(fcs, temporary=True)
+        km._cache.clear()
+        futures = km.prefetch([fc.id for fc in fcs])
+        self.assertEqual([future.result(10.0) for future in futures], fcs)
+        for fc in fcs:
+            self.assertTrue(fc.id in km._cache)
+        missing = km.prefetch([u'emd5://nowhere/nobody/'
+                               u'2000-01-01_00:00:00.000000/0123.field'],
+                              try_remote=False)
+        self.assertRaises(DCNotFoundError, missing[0].result, 10.0)
+
+    def testPrefetchRemote(self):
+        km = KnowledgeManager.getInstance()
+        fc = FieldContainer(N.arange(42.0))
+        fc.seal()
+
+        class StubNode(object):
+            requests = []
+
+            def get_datacontainer(self, dc_id):
+                self.requests.append(dc_id)
+                return fc
+        node = km.node
+        km.node = StubNode()
+        try:
+            self.assertEqual(km.prefetch([fc.id])[0].result(10.0), fc)
+            hits = km.getCacheStatistics()['hits']
+            self.assertEqual(km.getDataContainer(fc.id), fc)
+            self.assertEqual(km.getCacheStatistics()['hits'], hits + 1)
+            self.assertEqual(StubNode.requests, [fc.id])
+        finally:
+            km.node = node
+            km._cache.remove(fc.id)
+
+    def testSpillCache(self):
+        km = KnowledgeManager.getInstance()
+        fc = FieldContainer(N.random.randn(300, 300))
+        fc.seal()
+        km.registerDataContainer(fc, temporary=True)
+        km._cache.clear()
+        before = km.getCacheStatistics()['spill']
+        km.configureCache(max_size=fc.rawDataBytes / 2)
+        try:
+            self.assertEqual(km.getDataContainer(fc.id), fc)
+            spilled = km.getDataContainer(fc.id)
+        finally:
+            km.configureCache(max_size=CACHE_MAX_SIZE)
+        self.assertTrue(isinstance(spilled.data, N.memmap))
+        self.assertEqual(spilled, fc)
+        stats = km.getCacheStatistics()['spill']
+        self.assertEqual(stats['hits'] - before['hits'], 1)
+        self.assertTrue(stats['size'] >= fc.data.nbytes)
+        km._cache.clear()
+        self.assertEqual(km.getCacheStatistics()['spill']['size'], 0)
+
+    def testGetLazyDataContainer(self):
+        km = KnowledgeManager.getInstance()
+        dim = FieldContainer(N.linspace(0, 1, 1000), unit='1 s',
+                             longname='time')
+        fc = FieldContainer(N.ones((1000, )), unit='1 V',
+                            dimensions=[dim], longname='voltage')
+        sc = SampleContainer(longname='lazy_sc', columns=[fc])
+        sc.seal()
+        km.registerDataContainer(sc, temporary=True)
+        lazy_fc = km.getDataContainer(fc.id, use_cache=False, lazy=True)
+        assert isinstance(lazy_fc, LazyFieldContainer)
+        self.assertEqual(lazy_fc.longname, 'voltage')
+        self.assertEqual(lazy_fc.dimensions[0].longname, 'time')
+        self.assertEqual(lazy_fc.rawDataBytes, fc.rawDataBytes)
+        assert not lazy_fc.isLoaded()
+        assert not lazy_fc.dimensions[0].isLoaded()
+        self.assertEqual(lazy_fc, fc)
+        lazy_sc = km.getDataContainer(sc.id, use_cache=False, lazy=True)
+        assert not lazy_sc.columns[0].isLoaded()
+        self.assertEqual(lazy_sc, sc)
+        cached_fc = km.getDataContainer(fc.id)
+        assert km.getDataContainer(fc.id, lazy=True) is cached_fc
+
+    def testGetFieldSlice(self):
+        km = KnowledgeManager.getInstance()
+        dim = FieldContainer(N.linspace(0, 0.99, 100), unit='1 mm',
+                             longname='position')
+        fc = FieldContainer(N.arange(100.0), unit='1 V',
+                            dimensions=[dim], longname='voltage')
+        fc.seal()
+        km.registerDataContainer(fc, temporary=True)
+        for use_cache in [False, True]:
+            fc_slice = km.getFieldSlice(fc.id, '0.2mm:0.5mm',
+                                        use_cache=use_cache)
+            self.assertEqual(fc_slice, fc['0.2mm:0.5mm'])
+            self.assertEqual(fc_slice.data.shape, (30, ))
+        km.getDataContainer(fc.id)
+        self.assertEqual(km.getFieldSlice(fc.id, slice(10, 20)),
+                         fc[slice(10, 20)])
+
+    def testThreadSafety(self):
+        import threading
+        km = KnowledgeManager.getInstance()
+        fcs = []
+        for num in xrange(10):
+            fc = FieldContainer(N.ones((100, 100)) * num)
+            fc.seal()
+            fcs.append(fc)
+        for fc in fcs[:5]:
+            km.registerDataContainer(fc, temporary=True)
+        km._cache.clear()
+        errors = []
+
+        def work(seed):
+            rand = random.Random(seed)
+            try:
+                for rep in xrange(30):
+                    fc = rand.choice(fcs)
+                    action = rand.randint(0, 3)
+                    if action == 0 or not km.hasDataContainer(fc.id):
+                        km.registerDataContainer(fc, temporary=True)
+                    elif action == 1:
+                        km_fc = km.getDataContainer(fc.id, use_cache=False)
+                        assert km_fc == fc
+                    elif action == 2:
+                        assert km.getDataContainer(fc.id) == fc
+                    else:
+                        assert km.getFieldSlice(fc.id, 3) == fc[3]
+            except Exception, e:
+                import traceback
+                errors.append(traceback.format_exc())
+        threads = [threading.Thread(target=work, args=(seed, )) \
+                       for seed in xrange(16)]
+        t1 = time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print "%d threads did %d KM requests in %0.3f s" \
+              % (len(threads), 30 * len(threads), time() - t1)
+        self.assertEqual(errors, [])
+        for fc in fcs:
+            assert km.hasDataContainer(fc.id)
+        km._cache.clear()
+        results = []
+
+        def get():
+            results.append(km.getDataContainer(fcs[-1].id))
+        threads = [threading.Thread(target=get) for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(results) == 8
+        for result in results:
+            assert result is results[0]
+
     def testSCwithSCColumn(self):
         fc_child1 = FieldContainer(longname='fc_child1', data=N.ones((10, 10)))
         fc_child2 = FieldContainer(longname='fc_child2', data=N.ones((20, 20)))
@@ -145,6 +307,283 @@ current: I(V) [A]
         os.remove(filename)
         km.getDataContainer(dc_id)
 
+    def testUpdateIndex(self):
+        km = KnowledgeManager.getInstance()
+        km.registerDataContainer(self._fc, temporary=True)
+        filename = os.path.realpath(
+            getFilenameFromDcId(self._fc.id, temporary=True))
+        calls = []
+
+        def progress(count, total, filename):
+            calls.append((count, total, filename))
+        km.updateIndex(progress=progress)
+        assert filename not in [call[2] for call in calls]
+        mtime = os.stat(filename).st_mtime
+        os.utime(filename, (mtime + 10.0, mtime + 10.0))
+        calls = []
+        km.updateIndex(progress=progress, processes=2)
+        self.assertEqual([call[0] for call in calls],
+                         range(1, len(calls) + 1))
+        assert calls[-1][0] == calls[-1][1]
+        assert filename in [call[2] for call in calls]
+        assert km.hasDataContainer(self._fc.id)
+        assert km.isTemporary(self._fc.id)
+        os.utime(filename, (mtime + 20.0, mtime + 20.0))
+        calls = []
+        km.updateIndex(progress=progress, processes=1)
+        assert filename in [call[2] for call in calls]
+        assert km.hasDataContainer(self._fc.id)
+        os.remove(filename)
+        km.updateIndex(progress=progress)
+        assert not km.hasDataContainer(self._fc.id)
+
+    def testIterIndexFiles(self):
+        import multiprocessing
+        from pyphant.core.KnowledgeManager import (iterIndexFiles,
+                                                   INDEX_POOL_MIN_FILES)
+        pools = []
+        Pool = multiprocessing.Pool
+
+        def recordPool(*args):
+            pools.append(args)
+            return Pool(*args)
+        jobs = [(os.path.join(tempfile.gettempdir(), 'missing%d.h5' % num),
+                 None) for num in xrange(3)]
+        multiprocessing.Pool = recordPool
+        try:
+            # few files are read in the calling process by default
+            results = sorted(iterIndexFiles(jobs))
+            self.assertEqual(pools, [])
+            results2 = sorted(iterIndexFiles(jobs, processes=2))
+            self.assertEqual(len(pools), 1)
+        finally:
+            multiprocessing.Pool = Pool
+        self.assertEqual(results, results2)
+        self.assertEqual(results, [(filename, None, None, None, None) \
+                                   for filename, checksum in jobs])
+        assert len(jobs) < INDEX_POOL_MIN_FILES
+
+    def testRebuildIndex(self):
+        import threading
+        km = KnowledgeManager.getInstance()
+        km.registerDataContainer(self._fc, temporary=True)
+        # pooled connection of another thread to the old dbase:
+        thread = threading.Thread(target=km.hasDataContainer,
+                                  args=(self._fc.id, ))
+        thread.start()
+        thread.join()
+        km.rebuildIndex(processes=1)
+        from pyphant.core.SQLiteWrapper import SQLiteWrapper
+        with SQLiteWrapper(km.dbase + '.bak', pooled=False) as wrapper:
+            assert wrapper.has_entry(self._fc.id)
+        assert km.hasDataContainer(self._fc.id)
+        assert km.isTemporary(self._fc.id)
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(km.hasDataContainer(self._fc.id)))
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [True])
+
+    def testRegisterDataContainers(self):
+        km = KnowledgeManager.getInstance()
+        km.registerDataContainer(self._fc, temporary=True)
+        fcs = []
+        for num in xrange(50):
+            fc = FieldContainer(N.arange(num + 1))
+            fc.seal()
+            fcs.append(fc)
+        sc = SampleContainer(longname='bulk_sc', columns=fcs[:2])
+        sc.seal()
+        dcs = [self._fc] + fcs + [fcs[0], sc]
+        stored = km.registerDataContainers(iter(dcs), temporary=True)
+        self.assertEqual(stored, [fc.id for fc in fcs] + [sc.id])
+        for dc in fcs + [sc]:
+            assert km.hasDataContainer(dc.id)
+            assert km.isTemporary(dc.id)
+        self.assertEqual(km.getDataContainer(fcs[-1].id, use_cache=False),
+                         fcs[-1])
+        self.assertEqual(km.getDataContainer(sc.id, use_cache=False), sc)
+        storage = km.search(['storage'], {'type': 'field',
+                                          'id': fcs[0].id})[0][0]
+        assert len(km.search(['id'], {'type': 'field',
+                                      'storage': storage})) == 50
+        self.assertEqual(km.registerDataContainers(dcs, temporary=True), [])
+        fcs = []
+        for num in xrange(200):
+            fc = FieldContainer(N.ones((10, )) * num)
+            fc.seal()
+            fcs.append(fc)
+        t1 = time()
+        for fc in fcs[:100]:
+            km.registerDataContainer(fc, temporary=True)
+        t2 = time()
+        km.registerDataContainers(fcs[100:], temporary=True)
+        t3 = time()
+        print "Registered 100 FCs in %0.3f s one by one and in "\
+              "%0.3f s in bulk" % (t2 - t1, t3 - t2)
+
+    def testRegisterEqualHashes(self):
+        km = KnowledgeManager.getInstance()
+        fcs = []
+        for num in xrange(3):
+            fc = FieldContainer(N.arange(7.0) * 3)
+            fc.seal()
+            fcs.append(fc)
+        assert fcs[0].hash == fcs[1].hash and fcs[0].id != fcs[1].id
+        stored = km.registerDataContainers(fcs, temporary=True)
+        self.assertEqual(sorted(stored), sorted([fc.id for fc in fcs]))
+        storages = set()
+        for fc in fcs:
+            assert km.hasDataContainer(fc.id)
+            self.assertEqual(km.getDataContainer(fc.id, use_cache=False), fc)
+            storages.add(km.search(['storage'], {'id': fc.id})[0][0])
+        self.assertEqual(len(storages), 3)
+
+    def testRegisterShardBytes(self):
+        from pyphant.core import KnowledgeManager as KMModule
+        km = KnowledgeManager.getInstance()
+        fcs = []
+        for num in xrange(4):
+            fc = FieldContainer(N.ones((100, )) * num)
+            fc.seal()
+            fcs.append(fc)
+        maxBytes = KMModule.SHARD_MAX_BYTES
+        KMModule.SHARD_MAX_BYTES = 2 * fcs[0].rawDataBytes
+        try:
+            km.registerDataContainers(fcs, temporary=True)
+        finally:
+            KMModule.SHARD_MAX_BYTES = maxBytes
+        storages = set([km.search(['storage'], {'id': fc.id})[0][0] \
+                            for fc in fcs])
+        self.assertEqual(len(storages), 2)
+
+    def testDeduplication(self):
+        km = KnowledgeManager.getInstance()
+        dim = FieldContainer(N.arange(1000.0), longname='dedup_dim')
+        dim.seal()
+        fcs = []
+        for num in xrange(3):
+            fc = FieldContainer(N.linspace(0.0, 1.0, 1000),
+                                error=N.ones((1000, )), dimensions=[dim],
+                                longname='dedup', attributes={'num': 1})
+            fc.seal()
+            fcs.append(fc)
+        assert fcs[0].hash == fcs[1].hash and fcs[0].id != fcs[1].id
+        km.registerDataContainer(fcs[0], temporary=True)
+        report = km.getDeduplicationReport()
+        km.registerDataContainer(fcs[1], temporary=True)
+        km.registerDataContainers(fcs[2:], temporary=True)
+        for fc in fcs[1:]:
+            filename = km.search(['storage'], {'id': fc.id})[0][0]
+            with km.getH5FileHandler(filename) as handler:
+                links, nbytes = handler.getLinkStatistics()
+                self.assertEqual(handler.loadSummary(fc.id)['attributes'],
+                                 {'num': 1})
+            self.assertEqual(links, 3)
+            self.assertEqual(nbytes, 3 * 8000)
+            self.assertEqual(km.getDataContainer(fc.id, use_cache=False), fc)
+            lazy = km.getDataContainer(fc.id, use_cache=False, lazy=True)
+            assert N.all(lazy.error == fc.error)
+        newReport = km.getDeduplicationReport()
+        self.assertEqual(newReport['links'] - report['links'], 6)
+        self.assertEqual(newReport['saved_bytes'] - report['saved_bytes'],
+                         6 * 8000)
+
+    def testCompactStorage(self):
+        km = KnowledgeManager.getInstance()
+        fcs = []
+        for num in xrange(3):
+            fc = FieldContainer(N.arange(num + 5), longname='compact')
+            fc.seal()
+            km.registerDataContainer(fc, temporary=True)
+            fcs.append(fc)
+        sc = SampleContainer(longname='compact_sc', columns=fcs[:2])
+        sc.seal()
+        km.registerDataContainer(sc, temporary=True)
+        originals = [km.search(['storage'], {'id': dc.id})[0][0] \
+                         for dc in fcs + [sc]]
+        orphan = os.path.join(os.path.dirname(originals[0]), 'orphan.h5')
+        with km.getH5FileHandler(orphan, 'w') as handler:
+            handler.saveDataContainer(fcs[0])
+        km.updateIndex()
+        report = km.compactStorage(temporary=True)
+        assert report['packed'] >= 4
+        assert report['shards'] >= 1
+        assert report['deleted_files'] >= 5
+        for filename in originals + [orphan]:
+            assert not os.path.exists(filename)
+        for dc in fcs + [sc]:
+            storage = km.search(['storage'], {'id': dc.id})[0][0]
+            assert os.path.dirname(storage).endswith('by_shard')
+            assert km.isTemporary(dc.id)
+            self.assertEqual(km.getDataContainer(dc.id, use_cache=False), dc)
+        self.assertEqual(km.compactStorage(temporary=True),
+                         {'packed': 0, 'shards': 0, 'deleted_files': 0,
+                          'deleted_dcs': 0})
+
+    def testSharedDimensions(self):
+        km = KnowledgeManager.getInstance()
+        dim = FieldContainer(N.arange(10.0), longname='shared_dim')
+        fcs = [FieldContainer(N.ones((10, )) * num, dimensions=[dim],
+                              longname='shared') for num in xrange(2)]
+        for fc in fcs:
+            fc.seal()
+        km.registerDataContainers(fcs, temporary=True)
+        for lazy in [False, True]:
+            first = km.getDataContainer(fcs[0].id, use_cache=False,
+                                        lazy=lazy)
+            second = km.getDataContainer(fcs[1].id, use_cache=False,
+                                         lazy=lazy)
+            self.assertEqual(second, fcs[1])
+            assert first.dimensions[0] is second.dimensions[0]
+
+    def testIterSearch(self):
+        km = KnowledgeManager.getInstance()
+        fcs = []
+        for num in xrange(30):
+            fc = FieldContainer(N.arange(num + 2), longname='iter_search')
+            fc.seal()
+            fcs.append(fc)
+        sc = SampleContainer(longname='iter_search', columns=fcs[:2])
+        sc.seal()
+        km.registerDataContainers(fcs + [sc], temporary=True)
+        search_dict = {'longname': 'iter_search'}
+        expected = sorted(km.search(['id'], search_dict))
+        assert len(expected) == 31
+        result = list(km.iterSearch(['id'], search_dict, batch_size=7))
+        self.assertEqual(result, expected)
+        result = list(km.iterSearch(['id'], search_dict, order_asc=False,
+                                    batch_size=31))
+        self.assertEqual(result, expected[::-1])
+        result = list(km.iterSearch(['date', 'id'], search_dict,
+                                    order_by='date', batch_size=4))
+        self.assertEqual(result, sorted(result))
+        self.assertEqual(sorted([row[1:] for row in result]), expected)
+        search_dict = {'type': 'field', 'longname': 'iter_search',
+                       'col_of': {'type': 'sample', 'id': sc.id}}
+        result = list(km.iterSearch(['id'], search_dict, batch_size=1))
+        self.assertEqual(result, sorted([(fc.id, ) for fc in fcs[:2]]))
+
+    def testSearchCache(self):
+        km = KnowledgeManager.getInstance()
+        fc = FieldContainer(N.arange(3), longname='search_cache')
+        fc.seal()
+        search_dict = {'longname': 'search_cache', 'attributes': {}}
+        assert km.search(['id'], search_dict) == []
+        km._searchCache.reset_stats()
+        assert km.search(['id'], {'attributes': {},
+                                  'longname': 'search_cache'}) == []
+        assert km._searchCache.get_stats()['hits'] == 1
+        km.registerDataContainer(fc, temporary=True)
+        self.assertEqual(km.search(['id'], search_dict), [(fc.id, )])
+        km.search(['id'], search_dict).append(None)
+        self.assertEqual(km.search(['id'], search_dict), [(fc.id, )])
+        self.assertEqual(km.areTemporary([fc.id, self._fc.id, fc.id]),
+                         [True, km.isTemporary(self._fc.id), True])
+        km.setTemporary(fc.id, False)
+        self.assertEqual(km.areTemporary([fc.id]), [False])
+
     def testCache(self):
         print "Preparing FCs for cache test (cache size: %d MB)..."\
               % (CACHE_MAX_SIZE / 1024 / 1024)
@@ -175,8 +614,7 @@ current: I(V) [A]
                 km.getDataContainer(id, use_cache=False)
                 t2 = time()
                 uc_acc_time += t2 - t1
-            km._cache = []
-            km._cache_size = 0
+            km._cache.clear()
             for rep in xrange(reps):
                 t1 = time()
                 km.getDataContainer(id)
@@ -187,12 +625,10 @@ current: I(V) [A]
             print "Avr. access time for %0.2f kB sequential read: "\
                   "%0.3f ms unchached, %0.3f ms cached" % (float(bytes) / 1024,
                                                            uc_avr, c_avr)
-        km._cache = []
-        km._cache_size = 0
+        km._cache.clear()
         rand_ids = []
         reps = 500
-        import pyphant.core.KnowledgeManager
-        pyphant.core.KnowledgeManager.CACHE_MAX_NUMBER = 20
+        km.configureCache(max_number=20)
         for run in xrange(reps):
             rand_ids.append(rand_id_pool[
                 random.randint(0, len(rand_id_pool) - 1)])
@@ -208,10 +644,14 @@ current: I(V) [A]
             fc = km.getDataContainer(id)
             t2 = time()
             c_acc_time += t2 - t1
-            assert km._cache_size >= 0
-            assert km._cache_size <= CACHE_MAX_SIZE
-            assert len(km._cache) <= CACHE_MAX_NUMBER
+            assert km._cache.size >= 0
+            assert km._cache.size <= CACHE_MAX_SIZE
+            assert len(km._cache) <= 20
             assert assert_dict[id] == fc.data.flat[0]
+        stats = km.getCacheStatistics()
+        assert stats['hits'] > 0
+        assert stats['evictions'] > 0
+        km.configureCache(max_number=CACHE_MAX_NUMBER)
         uc_avr = 1000.0 * uc_acc_time / reps
         c_avr = 1000.0 * c_acc_time / reps
         bytes = float(500 * 500 * 8) / 1024
@@ -42,9 +42,13 @@ from pyphant.quantities import Quantity
 from pyphant.core.DataContainer import FieldContainer, SampleContainer
 from pyphant.core.PyTablesPersister import (saveField, loadField, saveSample,
                                             loadSample, saveExecutionOrder,
-                                            loadExecutionOrders)
+                                            loadExecutionOrders,
+                                            LazyFieldContainer,
+                                            STORAGE_PROFILES)
 import numpy
 import tables
+import os, tempfile
+from time import time
 
 class ContainerTestCase(unittest.TestCase):
     def setUp(self):
@@ -82,6 +86,29 @@ class FieldContainerTestCase(ContainerTestCase):
         restoredField = loadField(self.eln,self.eln.root.testSaveRestoreField)
         self.assertEqual(restoredField,self.field)
 
+    def testLazyRestore(self):
+        self.field.seal()
+        self.eln.createGroup(self.eln.root,'testLazyRestoreField',
+                             self.field.id.encode('utf-8'))
+        saveField(self.eln,self.eln.root.testLazyRestoreField,self.field)
+        restoredField = loadField(self.eln,self.eln.root.testLazyRestoreField,
+                                  lazy=True)
+        self.assertEqual(restoredField.id,self.field.id)
+        self.assertEqual(restoredField.longname,self.field.longname)
+        self.assertEqual(restoredField.unit,self.field.unit)
+        self.assertEqual(len(restoredField.dimensions),2)
+        self.assertEqual(restoredField.rawDataBytes,self.field.rawDataBytes)
+        assert not restoredField.isLoaded()
+        self.assertEqual(restoredField,self.field)
+        assert restoredField.isLoaded()
+        self.assertRaises(ValueError,restoredField.data.__setitem__,0,1.)
+        self.eln.close()
+        h5 = tables.openFile('FieldContainerTestCase.h5','r')
+        restoredField = loadField(h5,h5.root.testLazyRestoreField,lazy=True)
+        h5.close()
+        assert isinstance(restoredField,LazyFieldContainer)
+        self.assertEqual(restoredField,self.field)
+
     def testUnicodeFields(self):
         self.field.seal()
         unicodeArray = numpy.array([u'Hallo World!',u'Hallo Wörld!'])
@@ -97,6 +124,63 @@ class FieldContainerTestCase(ContainerTestCase):
         self.assertEqual(restoredField,unicodeField,
                          "Restored unicode string is %s (%s) but is expected to be %s (%s)." % (restoredField.data,restoredField.data.dtype,unicodeField.data,unicodeField.data.dtype))
 
+class StringFieldTestCase(ContainerTestCase):
+    def testEncodedFields(self):
+        for data in [numpy.array([u'Hallo W\xf6rld!',u'1',u'']),
+                     numpy.array([['a','bc'],['d','']])]:
+            for profile in STORAGE_PROFILES:
+                stringField = FieldContainer(data,longname=u"strings")
+                stringField.seal()
+                group = self.eln.createGroup(self.eln.root,
+                                             'testEncodedFields%s%s' % (
+                                                 data.dtype.char,
+                                                 profile.replace('-','_')),
+                                             stringField.id.encode('utf-8'))
+                saveField(self.eln,group,stringField,profile=profile)
+                restoredField = loadField(self.eln,group)
+                self.assertEqual(restoredField.data.tolist(),
+                                 [[unicode(s) for s in row] for row in data] \
+                                 if data.ndim == 2 else data.tolist())
+                assert restoredField.data.dtype.char == 'U'
+
+    def testLegacyUnicodeFields(self):
+        unicodeField = FieldContainer(numpy.array([u'Hallo W\xf6rld!',u'1']),
+                                      longname=u"legacy")
+        unicodeField.seal()
+        group = self.eln.createGroup(self.eln.root,'testLegacyUnicodeFields',
+                                     unicodeField.id.encode('utf-8'))
+        saveField(self.eln,group,unicodeField)
+        assert 'ENCODING' in group.data._v_attrs
+        self.assertEqual(loadField(self.eln,group),unicodeField)
+        self.assertEqual(loadField(self.eln,group,lazy=True),unicodeField)
+        self.eln.removeNode(group.data)
+        self.eln.createArray(group,'data',
+                             numpy.array([u'Hallo W\xf6rld!'.encode('utf-8'),
+                                          'Hallo']))
+        self.assertEqual(loadField(self.eln,group).data.tolist(),
+                         [u'Hallo W\xf6rld!',u'Hallo'])
+
+    def testStringBenchmark(self):
+        data = numpy.array([u'Entry %d \xe4' % i for i in xrange(100000)])
+        stringField = FieldContainer(data,longname=u"strings")
+        stringField.seal()
+        group = self.eln.createGroup(self.eln.root,'testStringBenchmark',
+                                     stringField.id.encode('utf-8'))
+        saveField(self.eln,group,stringField)
+        t1 = time()
+        restoredField = loadField(self.eln,group)
+        t2 = time()
+        self.eln.removeNode(group.data)
+        self.eln.createArray(group,'data',
+                             numpy.array([s.encode('utf-8') for s in data]))
+        t3 = time()
+        legacyField = loadField(self.eln,group)
+        t4 = time()
+        self.assertEqual(restoredField.data.tolist(),data.tolist())
+        self.assertEqual(legacyField.data.tolist(),data.tolist())
+        print "Loaded 100000 strings in %0.3f s, in %0.3f s from the "\
+              "legacy format" % (t2-t1,t4-t3)
+
 class ObjectArrayTestCase(ContainerTestCase):
     def testDateTime(self):
         """Test the correct saving and  restoring of object arrays composed from datetime objects."""
@@ -144,6 +228,25 @@ class SampleContainerTestCase(ContainerTestCase):
         restoredSample = loadSample(self.eln,self.eln.root.testSaveRestoreSample)
         self.assertEqual(restoredSample,self.sample)
 
+    def testSharedDimensions(self):
+        self.eln.createGroup(self.eln.root,'testSharedDimensions')
+        columns = [FieldContainer(self.independent.data*i,
+                                  dimensions=[self.independent],
+                                  longname='column %d' % i) for i in range(5)]
+        sample = SampleContainer(columns,longname='Shared')
+        sample.seal()
+        saveSample(self.eln,self.eln.root.testSharedDimensions,sample)
+        for lazy in [False,True]:
+            fields = {}
+            restoredSample = loadSample(self.eln,
+                                        self.eln.root.testSharedDimensions,
+                                        lazy,fields)
+            self.assertEqual(restoredSample,sample)
+            dims = [column.dimensions[0] for column in restoredSample.columns]
+            for dim in dims[1:]:
+                assert dim is dims[0]
+            assert fields[(self.independent.id,lazy)] is dims[0]
+
 class SampleContainerInSampleContainerTestCase(SampleContainerTestCase):
     def setUp(self):
         super(SampleContainerInSampleContainerTestCase,self).setUp()
@@ -167,6 +270,79 @@ class SampleContainerInSampleContainerTestCase(SampleContainerTestCase):
                                       attributes = copy.copy(self.attributes).update({'isSample':'It seems so.'}))
         self.sample.seal()
 
+class StorageProfileTestCase(ContainerTestCase):
+    def setUp(self):
+        super(StorageProfileTestCase,self).setUp()
+        data = numpy.arange(4*30*20,dtype='float').reshape((4,30,20))
+        self.field = FieldContainer(data,error=numpy.ones(data.shape),
+                                    mask=data>1000,longname=u'stack',
+                                    unit=self.unit,attributes=self.attributes)
+        self.field.seal()
+
+    def testSaveRestore(self):
+        for profile in STORAGE_PROFILES:
+            group = self.eln.createGroup(self.eln.root,profile.replace('-','_'),
+                                         self.field.id.encode('utf-8'))
+            saveField(self.eln,group,self.field,profile=profile)
+            if profile == 'fast':
+                self.assertEqual(type(group.data),tables.Array)
+            else:
+                self.assertEqual(type(group.mask),tables.CArray)
+            if profile == 'compact':
+                assert group.data.filters.complevel > 0
+                assert group.data.filters.shuffle
+            elif profile == 'z-stack':
+                self.assertEqual(group.error.chunkshape,(1,30,20))
+            self.assertEqual(loadField(self.eln,group),self.field)
+            restoredField = loadField(self.eln,group,lazy=True)
+            self.assertEqual(restoredField.rawDataBytes,self.field.rawDataBytes)
+            self.assertEqual(restoredField[2],self.field[2])
+        self.assertRaises(ValueError,saveField,self.eln,self.eln.root.results,
+                          self.field,profile='unknown')
+
+    def testZStackContiguous(self):
+        group = self.eln.createGroup(self.eln.root,'z_stack',
+                                     self.field.id.encode('utf-8'))
+        saveField(self.eln,group,self.field,profile='z-stack')
+        self.assertEqual(group.data.chunkshape,(1,30,20))
+        for dim in self.field.dimensions:
+            node = self.eln.getNode('/results/result_'+dim.hash)
+            self.assertEqual(type(node.data),tables.Array)
+            self.assertEqual(node.data.chunkshape,None)
+        image = FieldContainer(numpy.ones((30,20)),longname=u'image')
+        image.seal()
+        group = self.eln.createGroup(self.eln.root,'image',
+                                     image.id.encode('utf-8'))
+        saveField(self.eln,group,image,profile='z-stack')
+        self.assertEqual(group.data.chunkshape,None)
+
+    def testBenchmark(self):
+        data = numpy.random.random_sample((32,256,256))
+        field = FieldContainer(data,mask=data>0.99,longname=u'z-stack')
+        field.seal()
+        for profile in STORAGE_PROFILES:
+            path = tempfile.mktemp('.h5')
+            try:
+                h5 = tables.openFile(path,'w')
+                h5.createGroup(h5.root,'results')
+                t1 = time()
+                group = h5.createGroup(h5.root,'field',field.id.encode('utf-8'))
+                saveField(h5,group,field,profile=profile)
+                h5.close()
+                t2 = time()
+                h5 = tables.openFile(path,'r')
+                t3 = time()
+                for index in xrange(data.shape[0]):
+                    h5.root.field.data[index]
+                    h5.root.field.mask[index]
+                t4 = time()
+                h5.close()
+                print "Profile %s: written in %0.3f s, %d bytes, slice read "\
+                      "in %0.3f ms" % (profile,t2-t1,os.path.getsize(path),
+                                       (t4-t3)*1000./data.shape[0])
+            finally:
+                os.remove(path)
+
 class ExecutionOrderTestCase(unittest.TestCase):
     def setUp(self):
         import tempfile
@@ -40,6 +40,20 @@ import unittest
 import pyphant.core.SQLiteWrapper
 from pyphant.quantities import Quantity
 from pyphant.core.H5FileHandler import (im_id, im_summary)
+import sqlite3
+
+
+def hasFTS5():
+    """Returns whether sqlite3 has been compiled with FTS5."""
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute("CREATE VIRTUAL TABLE test USING fts5(text)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+
 
 class TestQuantity2powers(unittest.TestCase):
     def testPowersOfUnits(self):
@@ -91,6 +105,7 @@ class SQLiteWrapperTestCase(unittest.TestCase):
 
     def tearDown(self):
         import os
+        pyphant.core.SQLiteWrapper.close_connections(self.dbase)
         os.remove(self.dbase)
         os.removedirs(self.dir)
 
@@ -194,6 +209,414 @@ class SQLiteWrapperTestCase(unittest.TestCase):
             assert search_result == [(self.summary['shortname'], )]
 
 
+    def testSetEntries(self):
+        columns = []
+        for i in xrange(200):
+            summary = self.summary.copy()
+            summary['hash'] = '%05i' % i
+            summary['id'] = summary['id'].replace('12345678910',
+                                                  summary['hash'])
+            summary['attributes'] = dict([('attr%i' % j, j) \
+                                              for j in xrange(10)])
+            if i % 2:
+                summary['unit'] = Quantity('1.0 s')
+            columns.append(summary)
+        sc_summary = self.sc_summary.copy()
+        sc_summary['columns'] = [summary['id'] for summary in columns]
+        with self.wrapper:
+            self.wrapper.set_entry(im_summary, None)
+            self.wrapper.set_entries([(summary, 'storage') for summary \
+                                          in columns + [sc_summary] + columns],
+                                     temporary=True)
+            self.wrapper.set_entries([(summary, 'storage2') \
+                                          for summary in columns])
+            rowwrapper = self.wrapper[sc_summary['id']]
+            assert rowwrapper['columns'] == sc_summary['columns']
+            for summary in columns:
+                rowwrapper = self.wrapper[summary['id']]
+                for key, value in summary.iteritems():
+                    assert value == rowwrapper[key]
+                assert rowwrapper['storage'] == 'storage'
+                assert self.wrapper.is_temporary(summary['id'])
+            search_result = self.wrapper.get_andsearch_result(
+                ['id'], {'type':'field', 'unit':Quantity('1.0 s')})
+            assert len(search_result) == 100
+            self.wrapper.cursor.execute("SELECT COUNT(*) FROM km_base_units")
+            assert self.wrapper.cursor.fetchone()[0] == 3
+            # entries of several files are set at once
+            mixed = []
+            for i, summary in enumerate(columns[:10]):
+                summary = summary.copy()
+                summary['id'] = summary['id'].replace(summary['hash'],
+                                                      'mixed%02i' % i)
+                mixed.append((summary, 'file%i' % (i % 2)))
+            self.wrapper.set_entries(mixed + [(mixed[0][0], 'file2')])
+            for summary, storage in mixed:
+                rowwrapper = self.wrapper[summary['id']]
+                assert rowwrapper['storage'] == storage
+                assert not self.wrapper.is_temporary(summary['id'])
+
+    def testBaseUnitCache(self):
+        SQLiteWrapper = pyphant.core.SQLiteWrapper.SQLiteWrapper
+        get_cached = pyphant.core.SQLiteWrapper.get_cached_bu_ids
+        powers = pyphant.core.SQLiteWrapper.quantity2powers(Quantity('1 s'))
+        try:
+            with SQLiteWrapper(self.dbase) as wrapper:
+                wrapper.set_entry(self.summary, 'storage')
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        assert get_cached(self.dbase) == {}
+        with SQLiteWrapper(self.dbase) as wrapper:
+            bu_id = wrapper.get_bu_ids([powers])[powers]
+            assert powers not in get_cached(self.dbase)
+        assert get_cached(self.dbase)[powers] == bu_id
+        with SQLiteWrapper(self.dbase) as wrapper:
+            assert wrapper.get_bu_ids([powers]) == {powers:bu_id}
+
+
+    def testQueryPlans(self):
+        fc_dict = {'longname':'name'}
+        sc_dict = {'longname':'name2'}
+        searches = [('field', {'longname':'name'}),
+                    ('field', {'shortname':'sn'}),
+                    ('field', {'machine':'PC'}),
+                    ('field', {'creator':'aheld'}),
+                    ('field', {'hash':'12345678910'}),
+                    ('field', {'storage':'storage1'}),
+                    ('field', {'id':self.summary['id']}),
+                    ('field', {'date_from':'2009'}),
+                    ('field', {'date_to':'2010'}),
+                    ('field', {'unit':Quantity('1 m')}),
+                    ('field', {'attributes':{'attribute1':'bla1'}}),
+                    ('field', {'attributes':
+                                   {'attribute1':self.wrapper.any_value}}),
+                    ('field', {'dimensions':[fc_dict]}),
+                    ('field', {'dim_of':fc_dict}),
+                    ('field', {'col_of':sc_dict}),
+                    ('field', {'has_dim':fc_dict}),
+                    ('sample', {'longname':'name2'}),
+                    ('sample', {'date_from':'2009'}),
+                    ('sample', {'columns':[fc_dict]}),
+                    ('sample', {'col_of':sc_dict}),
+                    ('sample', {'has_col':fc_dict}),
+                    ('sample', {'has_col':{'type':'field',
+                                           'longname':'name'}}),
+                    ('field', {'text':'name'}),
+                    ('field', {'attributes':
+                                   {'T':[('>', Quantity('300 K')),
+                                         ('<=', Quantity('350 K'))]}}),
+                    ('sample', {'text':'bla*'})]
+        if not hasFTS5():
+            # words are searched by LIKE patterns, which scan the tables
+            searches = [(type, search_dict) for type, search_dict \
+                            in searches if not 'text' in search_dict]
+        with self.wrapper:
+            for type, search_dict in searches:
+                query, values = self.wrapper.get_andsearch_query(
+                    type, ['id'], search_dict, False)
+                self.wrapper.cursor.execute("EXPLAIN QUERY PLAN " + query,
+                                            values)
+                plan = [row[-1] for row in self.wrapper.cursor.fetchall()]
+                for detail in plan:
+                    # full-text matches show up as virtual table scans
+                    self.assertFalse(detail.startswith('SCAN') and \
+                                         not 'VIRTUAL TABLE' in detail,
+                                     "%s: %s" % (search_dict, plan))
+
+    def testUpgrade(self):
+        SQLiteWrapper = pyphant.core.SQLiteWrapper.SQLiteWrapper
+        with self.wrapper:
+            self.wrapper.cursor.execute("DROP INDEX idx_fc_longname")
+            self.wrapper.cursor.execute("UPDATE db_info SET version=3")
+        with SQLiteWrapper(self.dbase) as wrapper:
+            assert wrapper.dbase_broken()
+            assert wrapper.upgrade_dbase()
+            assert not wrapper.dbase_broken()
+            wrapper.cursor.execute("SELECT name FROM sqlite_master "\
+                                       "WHERE type='index'")
+            names = [row[0] for row in wrapper.cursor.fetchall()]
+            for index_name, table_name, columns \
+                    in pyphant.core.SQLiteWrapper.INDEXES:
+                assert index_name in names
+            wrapper.cursor.execute("UPDATE db_info SET version=2")
+            assert not wrapper.upgrade_dbase()
+
+    def testAttributeRanges(self):
+        SQLiteWrapper = pyphant.core.SQLiteWrapper.SQLiteWrapper
+        temperatures = [Quantity('290 K'), Quantity('300 K'),
+                        Quantity('32 degC'), Quantity('350000 mK'), 400,
+                        '320 K']
+        ids = []
+        with self.wrapper:
+            self.wrapper.set_entry(im_summary, None)
+            for num, temperature in enumerate(temperatures):
+                summary = self.summary.copy()
+                summary['hash'] = '%05i' % num
+                summary['id'] = summary['id'].replace('12345678910',
+                                                      summary['hash'])
+                summary['attributes'] = {'T':temperature, 'n':num}
+                self.wrapper.set_entry(summary, 'storage')
+                ids.append(summary['id'])
+        searches = [(('>=', Quantity('300 K')), [1, 2, 3]),
+                    ([('>', Quantity('300 K')), ('<', Quantity('350 K'))],
+                     [2]),
+                    (('==', Quantity('350 K')), [3]),
+                    (('!=', Quantity('300 K')), [0, 2, 3]),
+                    (('>', 0), [4]),
+                    ([('<', Quantity('0.3 kK'))], [0])]
+        for i in range(2):
+            with SQLiteWrapper(self.dbase) as wrapper:
+                for constraints, expected in searches:
+                    search_result = wrapper.get_andsearch_result(
+                        ['id'], {'attributes':{'T':constraints}})
+                    self.assertEqual(sorted(search_result),
+                                     sorted([(ids[num], ) \
+                                                 for num in expected]))
+                search_result = wrapper.get_andsearch_result(
+                    ['id'], {'attributes':{'T':Quantity('290 K'),
+                                           'n':('<', 10)}})
+                assert search_result == [(ids[0], )]
+                self.assertRaises(ValueError, wrapper.get_andsearch_result,
+                                  ['id'], {'attributes':
+                                               {'T':[('>', 1),
+                                                     ('<', Quantity('1 K'))]}})
+                # dbase of version 5 has no numerical attribute columns:
+                wrapper.cursor.execute("DROP INDEX idx_attributes_key_num")
+                wrapper.cursor.execute("ALTER TABLE km_attributes "\
+                                           "DROP COLUMN num")
+                wrapper.cursor.execute("ALTER TABLE km_attributes "\
+                                           "DROP COLUMN bu_id")
+                wrapper.cursor.execute("UPDATE db_info SET version=5")
+                assert wrapper.upgrade_dbase()
+
+    def testGeneration(self):
+        SQLiteWrapper = pyphant.core.SQLiteWrapper.SQLiteWrapper
+        with self.wrapper:
+            generation = self.wrapper.get_generation()
+            self.wrapper.set_entry(self.summary, 'storage1')
+        with SQLiteWrapper(self.dbase) as wrapper:
+            assert wrapper.get_generation() == generation + 1
+            wrapper.set_entry(self.summary, 'storage1')
+            assert wrapper.get_generation() == generation + 1
+            wrapper.set_temporary(self.summary['id'], True)
+            assert wrapper.get_generation() == generation + 2
+            self.assertEqual(wrapper.get_temporary_ids(
+                    [self.summary['id'], self.sc_summary['id']]),
+                             set([self.summary['id']]))
+            wrapper[self.summary['id']]['storage'] = 'storage2'
+            assert wrapper.get_generation() == generation + 3
+            wrapper.delete_file('storage2')
+            assert wrapper.get_generation() == generation + 4
+
+    def testFullText(self):
+        if not hasFTS5():
+            self.skipTest("sqlite3 has been compiled without FTS5")
+        SQLiteWrapper = pyphant.core.SQLiteWrapper.SQLiteWrapper
+        self.summary['longname'] = 'Absorption measurement'
+        self.summary['attributes'] = {'sample':'B12', 'T':300}
+        self.sc_summary['attributes'] = {'sample':'B13'}
+        with self.wrapper:
+            self.wrapper.set_entry(im_summary, None)
+            self.wrapper.set_entry(self.summary, 'storage1')
+            self.wrapper.set_entry(self.sc_summary, 'storage2')
+        id = self.summary['id']
+        sc_id = self.sc_summary['id']
+        searches = [('absorption b12', [id]),
+                    ('absorp*', [id]),
+                    ('B1', []),
+                    ('B1*', [id, sc_id]),
+                    ('sample 300', [id]),
+                    ('"B12 OR', [])]
+        for i in range(2):
+            with SQLiteWrapper(self.dbase) as wrapper:
+                for text, expected in searches:
+                    search_result = wrapper.get_andsearch_result(
+                        ['id'], {'text':text})
+                    assert sorted(search_result) == [(dc_id, ) for dc_id \
+                                                         in sorted(expected)]
+                search_result = wrapper.get_andsearch_result(
+                    ['id', 'rank'], {'text':'B12*', 'type':'field'},
+                    order_by='rank')
+                assert search_result[0][0] == id
+                self.assertRaises(KeyError, wrapper.get_andsearch_result,
+                                  ['rank'], {'longname':'name2'})
+                # dbase of version 4 has no full-text index:
+                for name in ['trigger_del_fc_text', 'trigger_del_sc_text']:
+                    wrapper.cursor.execute("DROP TRIGGER %s" % name)
+                wrapper.cursor.execute("DROP TABLE km_text")
+                wrapper.cursor.execute("DROP TABLE km_fulltext")
+                wrapper.cursor.execute("UPDATE db_info SET version=4")
+                assert wrapper.upgrade_dbase()
+        with self.wrapper:
+            self.wrapper.cursor.execute("DELETE FROM km_fc WHERE fc_id=?",
+                                        (id, ))
+            search_result = self.wrapper.get_andsearch_result(
+                ['id'], {'text':'B1*'})
+            assert search_result == [(sc_id, )]
+
+    def testTextWithoutFullText(self):
+        self.summary['longname'] = 'Absorption measurement'
+        self.summary['attributes'] = {'sample':'B12', 'T':300}
+        self.sc_summary['attributes'] = {'sample':'B13_%'}
+        with self.wrapper:
+            self.wrapper.set_entry(im_summary, None)
+            self.wrapper.set_entry(self.summary, 'storage1')
+            self.wrapper.set_entry(self.sc_summary, 'storage2')
+            # e.g. sqlite3 compiled without FTS5:
+            for name in ['trigger_del_fc_text', 'trigger_del_sc_text']:
+                self.wrapper.cursor.execute("DROP TRIGGER IF EXISTS %s"
+                                            % name)
+            self.wrapper.cursor.execute("DROP TABLE IF EXISTS km_text")
+            self.wrapper.cursor.execute("DROP TABLE IF EXISTS km_fulltext")
+            assert not self.wrapper.has_fulltext()
+        id = self.summary['id']
+        sc_id = self.sc_summary['id']
+        searches = [('absorption b12', [id]),
+                    ('absorp*', [id]),
+                    ('B1', [id, sc_id]),
+                    ('B13_%', [sc_id]),
+                    ('B1%', []),
+                    ('sample 300', [id]),
+                    ('"B12 OR', []),
+                    ('', [im_id, id, sc_id])]
+        with self.wrapper:
+            for text, expected in searches:
+                search_result = self.wrapper.get_andsearch_result(
+                    ['id'], {'text':text})
+                self.assertEqual(sorted(search_result),
+                                 [(dc_id, ) for dc_id in sorted(expected)])
+            search_result = self.wrapper.get_andsearch_result(
+                ['id', 'rank'], {'text':'B12*', 'type':'field'},
+                order_by='rank')
+            self.assertEqual(search_result, [(id, 0)])
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        import os
+        self.dir = tempfile.mkdtemp()
+        self.dbase = self.dir + os.path.sep + "testcase.sqlite3"
+        with pyphant.core.SQLiteWrapper.SQLiteWrapper(self.dbase) as wrapper:
+            wrapper.setup_dbase()
+            wrapper.set_entry(im_summary, None)
+
+    def tearDown(self):
+        import os
+        pyphant.core.SQLiteWrapper.close_connections(self.dbase)
+        os.remove(self.dbase)
+        os.removedirs(self.dir)
+
+    def testReuse(self):
+        SQLiteWrapper = pyphant.core.SQLiteWrapper.SQLiteWrapper
+        with SQLiteWrapper(self.dbase) as wrapper:
+            connection = wrapper.connection
+        with SQLiteWrapper(self.dbase) as wrapper:
+            assert wrapper.connection is connection
+        pyphant.core.SQLiteWrapper.close_connections(self.dbase)
+        with SQLiteWrapper(self.dbase) as wrapper:
+            assert wrapper.connection is not connection
+        connections = []
+
+        def get_connection():
+            with SQLiteWrapper(self.dbase) as wrapper:
+                connections.append(wrapper.connection)
+                assert wrapper.has_entry(im_id)
+            pyphant.core.SQLiteWrapper.close_connections(self.dbase)
+        import threading
+        thread = threading.Thread(target=get_connection)
+        thread.start()
+        thread.join()
+        assert len(connections) == 1
+        assert connections[0] is not connection
+
+    def testExclusiveAccess(self):
+        import threading
+        import os
+        import sqlite3
+        SQLiteWrapper = pyphant.core.SQLiteWrapper.SQLiteWrapper
+        exclusive_access = pyphant.core.SQLiteWrapper.exclusive_access
+        connections = []
+        opened = threading.Event()
+        finish = threading.Event()
+        waited = []
+
+        def hold_connection():
+            with SQLiteWrapper(self.dbase) as wrapper:
+                connections.append(wrapper.connection)
+            opened.set()
+            finish.wait(10.0)
+            with SQLiteWrapper(self.dbase) as wrapper:
+                waited.append(wrapper.has_entry(im_id))
+        thread = threading.Thread(target=hold_connection)
+        thread.start()
+        assert opened.wait(10.0)
+        backup = self.dbase + '.bak'
+        with exclusive_access(self.dbase):
+            # idle connections of other threads are closed
+            self.assertRaises(sqlite3.ProgrammingError,
+                              connections[0].execute, "SELECT 1")
+            finish.set()
+            thread.join(0.2)
+            # and new ones wait until the with-block has been left
+            assert thread.isAlive()
+            assert waited == []
+            pyphant.core.SQLiteWrapper.move_database(self.dbase, backup)
+            for suffix in ['', '-wal', '-shm']:
+                assert not os.path.exists(self.dbase + suffix)
+            with SQLiteWrapper(backup) as wrapper:
+                assert wrapper.has_entry(im_id)
+            pyphant.core.SQLiteWrapper.close_connections(backup)
+            pyphant.core.SQLiteWrapper.move_database(backup, self.dbase)
+        thread.join(10.0)
+        assert waited == [True]
+
+    def testTransactionScope(self):
+        SQLiteWrapper = pyphant.core.SQLiteWrapper.SQLiteWrapper
+        try:
+            with SQLiteWrapper(self.dbase) as wrapper:
+                wrapper.set_temporary(im_id, True)
+                with SQLiteWrapper(self.dbase) as inner:
+                    assert inner.is_temporary(im_id)
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        with SQLiteWrapper(self.dbase) as wrapper:
+            assert not wrapper.is_temporary(im_id)
+            wrapper.set_temporary(im_id, True)
+        with SQLiteWrapper(self.dbase, pooled=False) as wrapper:
+            assert wrapper.is_temporary(im_id)
+
+    def testSavepoint(self):
+        SQLiteWrapper = pyphant.core.SQLiteWrapper.SQLiteWrapper
+        with SQLiteWrapper(self.dbase) as wrapper:
+            wrapper.set_temporary(im_id, True)
+            wrapper.commit()
+            try:
+                with wrapper.savepoint():
+                    wrapper.set_temporary(im_id, False)
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+            assert wrapper.is_temporary(im_id)
+            with SQLiteWrapper(self.dbase, pooled=False) as other:
+                assert other.is_temporary(im_id)
+
+    def testLookupsPerSecond(self):
+        from time import time
+        SQLiteWrapper = pyphant.core.SQLiteWrapper.SQLiteWrapper
+        reps = 2000
+        for pooled in [False, True]:
+            t1 = time()
+            for rep in xrange(reps):
+                with SQLiteWrapper(self.dbase, pooled=pooled) as wrapper:
+                    assert wrapper.has_entry(im_id)
+            t2 = time()
+            print "%d lookups per second (pooled=%s)" \
+                  % (reps / (t2 - t1), pooled)
+
+
 if __name__ == "__main__":
     import sys
     if len(sys.argv) == 1:
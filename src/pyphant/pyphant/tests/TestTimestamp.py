@@ -44,6 +44,45 @@ class TestModuleUniqueTimestamp(unittest.TestCase):
                 getModuleUniqueTimestamp(),
                 getModuleUniqueTimestamp())
 
+    def testOrderedWithoutWaiting(self):
+        from pyphant.core.Helpers import getModuleUniqueTimestamp
+        from time import time
+        start = time()
+        timestamps = [getModuleUniqueTimestamp() for x in xrange(10000)]
+        # waiting for the clock would take at least 10 s
+        self.assertTrue(time() - start < 5.0)
+        self.assertEqual(timestamps, sorted(set(timestamps)))
+
+    def testThreads(self):
+        import threading
+        from pyphant.core.Helpers import getModuleUniqueTimestamp
+        timestamps = []
+
+        def collect():
+            timestamps.extend(
+                [getModuleUniqueTimestamp() for x in xrange(2000)])
+        threads = [threading.Thread(target=collect) for x in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(timestamps)), 8000)
+
+    def testParseIds(self):
+        import numpy
+        from pyphant.core.Helpers import emd52dict
+        from pyphant.core.DataContainer import (FieldContainer, parseId)
+        fields = [FieldContainer(numpy.arange(x, x + 3)) for x in xrange(50)]
+        for field in fields:
+            field.seal()
+        self.assertEqual(len(set([field.id for field in fields])), 50)
+        for field in fields:
+            self.assertEqual(parseId(field.id), [field.hash, u'field'])
+            emd5dict = emd52dict(field.id)
+            self.assertEqual(emd5dict['hash'], field.hash)
+            self.assertEqual(emd5dict['date'],
+                             field.timestamp.isoformat('_'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -15,6 +15,8 @@
       <br />
 {{date}}
       <br />
+{{text}}
+      <br />
 {{attributes}}
     </p>
     <input type="submit" value=" update " />